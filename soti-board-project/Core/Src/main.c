@@ -34,6 +34,12 @@
 
 /* Private define ------------------------------------------------------------*/
 /* USER CODE BEGIN PD */
+// Layout of a message frame sent to the ground station over UART:
+// [sync 0xA5 0x5A][priority][sender][recipient][cmd][body x7][CRC-16 MSB][CRC-16 LSB]
+#define SERIAL_SYNC_0       0xA5
+#define SERIAL_SYNC_1       0x5A
+#define SERIAL_MSG_SIZE     11
+#define SERIAL_FRAME_SIZE   (2 + SERIAL_MSG_SIZE + 2)
 
 /* USER CODE END PD */
 
@@ -66,6 +72,7 @@ static void MX_TIM16_Init(void);
 /* USER CODE BEGIN PFP */
 void serializeCANMessage(CANMessage* message, uint8_t* serializedData);
 void deserializeCANMessage(CANMessage* message, const uint8_t* deserializedData);
+uint16_t crc16CCITT(const uint8_t* data, uint32_t length);
 void on_message_received(CANMessage msg);
 void on_error_occured(CANWrapper_ErrorInfo error);
 /* USER CODE END PFP */
@@ -406,7 +413,7 @@ static void MX_GPIO_Init(void)
 void on_message_received(CANMessage msg)
 {
 	CANMessage message = msg;
-	uint8_t serializedData[11];
+	uint8_t serializedData[SERIAL_FRAME_SIZE];
 
 	//serializing the CANMessage to transfer over UART.
 	serializeCANMessage(&message, serializedData);
@@ -435,15 +442,24 @@ void HAL_UART_RxCpltCallback(UART_HandleTypeDef *huart)
 
 void serializeCANMessage(CANMessage* message, uint8_t* serializedData)
 {
-  serializedData[0] = message->priority;
-  serializedData[1] = message->sender;
-  serializedData[2] = message->recipient;
-  serializedData[3] = message->cmd;
+  serializedData[0] = SERIAL_SYNC_0;
+  serializedData[1] = SERIAL_SYNC_1;
+
+  uint8_t* msgData = &serializedData[2];
+  msgData[0] = message->priority;
+  msgData[1] = message->sender;
+  msgData[2] = message->recipient;
+  msgData[3] = message->cmd;
 
   for (int i = 0; i < CAN_MAX_BODY_SIZE; i++)
   {
-    serializedData[4 + i] = message->body[i];
+    msgData[4 + i] = message->body[i];
   }
+
+  // The checksum covers the message bytes only and is sent MSB first.
+  uint16_t crc = crc16CCITT(msgData, SERIAL_MSG_SIZE);
+  serializedData[2 + SERIAL_MSG_SIZE] = crc >> 8;
+  serializedData[3 + SERIAL_MSG_SIZE] = crc & 0xFF;
 }
 
 void deserializeCANMessage(CANMessage* message, const uint8_t* deserializedData)
@@ -458,6 +474,25 @@ void deserializeCANMessage(CANMessage* message, const uint8_t* deserializedData)
   	message->body[i] = deserializedData[4 + i];
   }
 }
+
+/**
+  * @brief  Computes the CRC-16/CCITT-FALSE checksum (poly 0x1021, init 0xFFFF).
+  */
+uint16_t crc16CCITT(const uint8_t* data, uint32_t length)
+{
+  uint16_t crc = 0xFFFF;
+
+  for (uint32_t i = 0; i < length; i++)
+  {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++)
+    {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+    }
+  }
+
+  return crc;
+}
 /* USER CODE END 4 */
 
 /**
@@ -1,18 +1,31 @@
 """
 The main soti front-end script which initializes the terminal and listener threads.
+
+The worker processes are started with the spawn method, so each of them
+imports this module again. Only what every process needs is imported at
+the top; each command and the startup code import the rest when they run.
 """
 
+import time
+STARTED = time.monotonic() # to report how long startup took
+
 import multiprocessing
 import cmd
-import serial.tools.list_ports
-import serial.tools.list_ports_common
-
-from utils import help_strings
-from utils.constants import CmdID, NodeID
+import math
+import os
+import threading
+from pathlib import Path
+from queue import Empty
+
+from utils.constants import (
+    CmdID, NodeID, MESSAGE_SOURCES, UPDATE_WINDOW, LOG_FORMATS, SAVE_DATA_DIR, SEARCH_LIMIT, METRICS_PORT,
+    PROFILES_DIR, PROFILE_SAMPLE_INTERVAL, SESSION_FILE_FORMAT, BAUD_RATE, RUNTIME, REPLY_QUEUE_SIZE, SESSIONS_DIR,
+    SESSION_INDEX_PATH
+)
 
-from serial_reader import serial_reader
-from session_logger import log_messages, dict_to_yaml
 from message import Message
+from message_filter import FilterSettings, FilterError
+from pipeline_metrics import format_stats, pipeline_gauges
 import parser
 
 
@@ -23,13 +36,25 @@ import parser
 class CommandLine(cmd.Cmd):
     """Represents the command line interface."""
     # initialize the object
-    def __init__(self, out_queue, write_queue):
+    def __init__(self, out_queue, frame_ring, reply_queue, display, filters, metrics, save_dir=SAVE_DATA_DIR):
         super().__init__()
-        self.intro = "\nAvailable commands:\nsend\niamnow\nhelp\nlist\nexit\n"
+        self.intro = ("\nAvailable commands:\nsend\niamnow\nhelp\nlist\nreplay\nupdate\ndashboard\nverbose\nsummary\n"
+                      "filter\nsearch\nstats\nexit\n")
         self.prompt = ">> "
         self.out_msg_queue = out_queue
-        self.write_msg_queue = write_queue
+        self.frame_ring = frame_ring
+        self.reply_queue = reply_queue
+        self.display = display
+        self.filters = filters
+        self.metrics = metrics
+        # where sessions are logged, and so searched.
+        self.save_dir = save_dir
+        self.last_stats = None
         self.sender_id = NodeID.CDH
+        self.replay_thread = None
+        self.stop_replay_flag = threading.Event()
+        # set to cancel the update in progress, if there is one.
+        self.stop_update_flag = None
 
 
     def do_send(self, arg):
@@ -37,14 +62,13 @@ class CommandLine(cmd.Cmd):
         try:
             msg = parser.parse_send(arg, self.sender_id)
 
+            from session_logger import dict_to_yaml
             msg_yaml = dict_to_yaml(msg.as_dict(), 1, True)
             print(f"Preparing to send message:\n{msg_yaml}")
 
             match input("Send this message? (Y/N) ").lower():
                 case "y":
-                    # send the message to be written to the serial device and logged
-                    self.write_msg_queue.put(msg)
-                    self.out_msg_queue.put(msg)
+                    self.transmit(msg)
                 case _:
                     print("Cancelled message send.")
 
@@ -53,6 +77,14 @@ class CommandLine(cmd.Cmd):
             return
 
 
+    def transmit(self, msg: Message):
+        """Sends the message to be written to the serial device and logged."""
+        self.frame_ring.write(
+            [msg.serialize()], [msg.time_ns], [msg.mono_ns], MESSAGE_SOURCES.index(msg.source)
+        )
+        self.out_msg_queue.put(msg)
+
+
     def do_iamnow(self, arg):
         """Changes the default sender ID."""
         try:
@@ -66,23 +98,241 @@ class CommandLine(cmd.Cmd):
             print("Invalid args.")
 
 
+    def do_replay(self, arg):
+        """Sends the messages of a recorded session, with their original timing or faster."""
+        parts = arg.split()
+        if parts == ["stop"]:
+            self.stop_replay_flag.set()
+            return
+
+        if self.replay_thread and self.replay_thread.is_alive():
+            print("A replay is already running. Use 'replay stop' to stop it.")
+            return
+
+        try:
+            path = Path(parts[0])
+            speed = 1.0
+            sources = None
+            for part in parts[1:]:
+                if part.startswith("sources="):
+                    sources = part.removeprefix("sources=").split(",")
+                else:
+                    speed = math.inf if part == "max" else float(part)
+            if speed <= 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            print("Invalid args. Usage: replay <file> [speed|max] [sources=port,user,...]")
+            return
+
+        if not path.is_file():
+            print(f"'{path}' doesn't exist.")
+            return
+
+        from replay import replay_to_transmit
+
+        # replay in the background so the CLI stays usable (e.g. to stop it).
+        self.stop_replay_flag = threading.Event()
+        self.replay_thread = threading.Thread(
+            target=replay_to_transmit,
+            args=(path, self.out_msg_queue, self.frame_ring, speed, sources, self.stop_replay_flag),
+            daemon=True
+        )
+        self.replay_thread.start()
+
+
+    def do_update(self, arg):
+        """Uploads a binary image to a subsystem."""
+        from firmware_update import FirmwareUpload, UpdateError, UpdateCancelled, print_progress
+
+        parts = arg.split()
+        try:
+            path = Path(parts[0])
+            node = NodeID(parser.parse_int(parts[1]))
+            address = 0
+            window = UPDATE_WINDOW
+            check_echo = False
+            for part in parts[2:]:
+                if part.startswith("window="):
+                    window = int(part.removeprefix("window="))
+                elif part.startswith("echo="):
+                    check_echo = {"on": True, "off": False}[part.removeprefix("echo=")]
+                else:
+                    address = parser.parse_int(part)
+            if window < 1 or address < 0:
+                raise ValueError
+        except (IndexError, ValueError, KeyError):
+            print("Invalid args. Usage: update <file> <node> [address] [window=N] [echo=on|off]")
+            return
+
+        try:
+            image = path.read_bytes()
+        except OSError as e:
+            print(e)
+            return
+        if not image:
+            print(f"'{path}' is empty.")
+            return
+
+        # replies to earlier commands would be mistaken for the update's.
+        while True:
+            try:
+                self.reply_queue.get_nowait()
+            except Empty:
+                break
+
+        print(f"Uploading {len(image):,} bytes to {node.get_display_name()} at 0x{address:08x}. "
+              "Press Ctrl+C to cancel.")
+        self.stop_update_flag = threading.Event()
+        upload = FirmwareUpload(image, node, self.transmit, self.reply_queue, address, self.sender_id,
+                                window, check_echo=check_echo, progress=print_progress,
+                                stop_flag=self.stop_update_flag)
+        try:
+            upload.run()
+            print(f"Uploaded in {upload.elapsed:.1f} s with {upload.retransmits} chunk(s) retransmitted.")
+        except (UpdateCancelled, KeyboardInterrupt):
+            print("\nUpdate cancelled.")
+        except UpdateError as e:
+            print(f"\nUpdate failed: {e}")
+        finally:
+            self.stop_update_flag = None
+
+
+    def do_dashboard(self, _):
+        """Shows live message counts, rates and the most recent messages until 'q' is pressed."""
+        from live_display import run_dashboard
+
+        try:
+            run_dashboard(self.display)
+        except RuntimeError as e:
+            print(e)
+
+
+    def do_verbose(self, arg):
+        """Turns printing every message as it is received on or off."""
+        match arg.lower():
+            case "on":
+                self.display.verbose.set()
+            case "off":
+                self.display.verbose.clear()
+            case "":
+                pass
+            case _:
+                print("Invalid args. Usage: verbose [on|off]")
+                return
+        print(f"Verbose mode is {'on' if self.display.verbose.is_set() else 'off'}.")
+
+
+    def do_summary(self, arg):
+        """Turns printing a summary of the message rates every few seconds on or off."""
+        match arg.lower():
+            case "on":
+                self.display.summary.set()
+            case "off":
+                self.display.summary.clear()
+            case "":
+                pass
+            case _:
+                print("Invalid args. Usage: summary [on|off]")
+                return
+        print(f"The summary is {'on' if self.display.summary.is_set() else 'off'}.")
+
+
+    def do_filter(self, arg):
+        """Selects which messages are logged or shown, by their header and body fields."""
+        target, _, expression = arg.strip().partition(" ")
+        if target not in FilterSettings.TARGETS:
+            if target:
+                print("Invalid args. Usage: filter [log|display] [expression|off]")
+            for target in FilterSettings.TARGETS:
+                print(f"{target}: {self.filters.get(target) or 'everything'}")
+            return
+
+        expression = expression.strip()
+        if expression:
+            try:
+                self.filters.set(target, None if expression == "off" else expression)
+            except FilterError as e:
+                print(f"Invalid filter: {e}")
+                return
+        print(f"{target}: {self.filters.get(target) or 'everything'}")
+
+
+    def do_search(self, arg):
+        """Searches the messages of every recorded session."""
+        from session_index import search_sessions
+
+        options = {"since": None, "until": None, "limit": str(SEARCH_LIMIT)}
+        terms = []
+        for part in arg.split():
+            name, _, value = part.partition("=")
+            if name in options and value:
+                options[name] = value
+            else:
+                terms.append(part)
+
+        try:
+            search_sessions(" ".join(terms), options["since"], options["until"], int(options["limit"]),
+                            self.save_dir / SESSION_INDEX_PATH.name, self.save_dir / SESSIONS_DIR.name)
+        except (FilterError, ValueError) as e:
+            print(f"Invalid args: {e}")
+
+
+    def do_stats(self, _):
+        """Shows the message rates, queue depths, drops and latencies of the capture pipeline."""
+        snapshot = self.metrics.snapshot()
+        print(format_stats(snapshot, pipeline_gauges(self.frame_ring, self.out_msg_queue), self.last_stats))
+        if self.last_stats:
+            print(f"Rates are since the last 'stats', {snapshot['time'] - self.last_stats['time']:.1f} s ago.")
+        self.last_stats = snapshot
+
+
     def do_help(self, arg):
         """Displays help messages."""
         if arg == "send":
             cmd_method = getattr(self, "do_send")
             print(f"Description: {cmd_method.__doc__}")
-            print(f"Usage: send <command> [data1 ...] [option=value ...]")
+            print(f"Usage: send <command> [data1 ...] [option=value ...] [field=value ...]")
+        elif arg == "replay":
+            print(f"Description: {self.do_replay.__doc__}")
+            print(f"Usage: replay <file> [speed|max] [sources=port,user,...]")
+            print("       replay stop")
+        elif arg == "filter":
+            print(f"Description: {self.do_filter.__doc__}")
+            print("Usage: filter [log|display] [expression|off]")
+            print("Example: filter display from=PLD and cmd~PLD_* and priority<10")
+        elif arg == "search":
+            print(f"Description: {self.do_search.__doc__}")
+            print(f"Usage: search [expression] [since=DATE] [until=DATE] [limit=N]")
+            print("Example: search cmd=CDH_PROCESS_RUNTIME_ERROR and error-code=7 since=2026-09-01")
+        elif arg == "update":
+            print(f"Description: {self.do_update.__doc__}")
+            print(f"Usage: update <file> <node> [address] [window=N] [echo=on|off]")
         else:
+            from utils import help_strings
             print(help_strings.HELP_MESSAGE)
 
 
     def do_list(self, _):
         """Lists the available CAN commands."""
-        print(help_strings.COMMAND_LIST)
+        from utils import help_strings
+        print(help_strings.command_list())
+
+
+    def interrupt(self) -> bool:
+        """Cancels the update in progress, for a runtime where Ctrl+C doesn't reach the CLI's thread.
+
+        Returns False if there was nothing to cancel.
+        """
+        stop_update_flag = self.stop_update_flag
+        if stop_update_flag is None:
+            return False
+        stop_update_flag.set()
+        return True
 
 
     def do_exit(self, _):
         """Exits the CLI."""
+        self.stop_replay_flag.set()
         return True
 
 
@@ -99,74 +349,268 @@ ___*   / __/ __ \\/_  __/  _/   __*'.     \\ \\_____
 _'._ /___/\\____/ /_/ /___/   *_.__       /_/
 """
 
+# the name of the simulated board, which can be given to --port in any case.
+VIRTUAL_PORT = "Virtual"
+
+# the ways a session can run (see RUNTIME in utils/constants.py).
+RUNTIMES = ("processes", "asyncio")
+
+
+def choose_ports() -> list[tuple[str, bool]]:
+    """Lists the serial ports and the simulated board, and asks which to read from. Returns them as name_ports() does."""
+    import serial.tools.list_ports
+
+    print("Available Input Sources:")
+    sources = [(port.device, port.description) for port in sorted(serial.tools.list_ports.comports())]
+    sources.append((VIRTUAL_PORT, "Run in virtual mode against a simulated board for off-board testing."))
+
+    for i, (device, description) in enumerate(sources):
+        print(str(i) + ": " + device + " - " + description)
+    print()
+
+    # Prompt user for valid ports.
+    while True:
+        try:
+            source_numbers = input("Please choose an input source (or several, separated by commas):").split(",")
+            return name_ports([sources[int(number)][0] for number in source_numbers])
+        except (ValueError, IndexError):
+            pass
+        print("Invalid input. Please enter the numbers corresponding to your selection.")
+
+
+def name_ports(ports: list[str]) -> list[tuple[str, bool]]:
+    """The name each port is logged as and whether it is a simulated board, which are numbered if there are several.
+
+    Raises ValueError if a port is given twice.
+    """
+    simulated = sum(port.lower() == VIRTUAL_PORT.lower() for port in ports)
+    names = []
+    for port in ports:
+        if port.lower() != VIRTUAL_PORT.lower():
+            names.append((port, False))
+        elif simulated == 1:
+            names.append((VIRTUAL_PORT, True))
+        else:
+            names.append((f"{VIRTUAL_PORT} {sum(virtual for _, virtual in names) + 1}", True))
+
+    if len({name for name, _ in names}) < len(names):
+        raise ValueError("Each serial port can only be read once.")
+    return names
+
+
+def serve_metrics(metrics, frame_ring, send_queue):
+    """Serves the pipeline metrics for Prometheus until SOTI exits."""
+    from pipeline_metrics import MetricsServer
 
-if __name__ == "__main__":
     try:
-        print(SPLASH)
-        print("\nWelcome to the SOTI CLI!\n")
+        MetricsServer(lambda: (metrics.snapshot(), pipeline_gauges(frame_ring, send_queue)), METRICS_PORT)
+    except OSError as e:
+        print(f"Couldn't serve metrics on port {METRICS_PORT}: {e}")
 
-        print("Available Input Sources:")
 
-        virtual_port = serial.tools.list_ports_common.ListPortInfo("Virtual")
-        virtual_port.description = "Run in virtual mode for off-board testing."
+def start_serving_metrics(metrics, frame_ring, send_queue):
+    """Serves the metrics, if METRICS_PORT is set, without waiting for the server to start."""
+    # importing http.server and opening the port take a while, so don't wait for them.
+    if METRICS_PORT is not None:
+        threading.Thread(target=serve_metrics, args=(metrics, frame_ring, send_queue), daemon=True).start()
 
-        sources = sorted(serial.tools.list_ports.comports()) + [virtual_port]
 
-        for i, port in enumerate(sources):
-            print(str(i) + ": " + port.device + " - " + port.description)
-        print()
+if __name__ == "__main__":
+    import argparse
+    import datetime
+    import signal
+    from profiling import ProfileOptions, PROFILE_MODES, worker_process
+
+    arg_parser = argparse.ArgumentParser(description="The SOTI command line interface.")
+    arg_parser.add_argument("--port", nargs="+", action="extend", metavar="PORT",
+                            help=f"the serial ports to read, or '{VIRTUAL_PORT.lower()}' for a simulated board, "
+                                 "instead of choosing them at startup. Several ports are logged as one session")
+    arg_parser.add_argument("--baud", type=int, default=BAUD_RATE,
+                            help=f"the baud rate of the serial port (default {BAUD_RATE})")
+    arg_parser.add_argument("--log-dir", type=Path, default=SAVE_DATA_DIR, metavar="DIR",
+                            help="where sessions, telemetry and profiles are saved (default save-data)")
+    arg_parser.add_argument("--headless", action="store_true",
+                            help="capture without the splash screen or the command line until Ctrl+C, SIGTERM or "
+                                 "--duration (needs --port)")
+    arg_parser.add_argument("--duration", type=float, metavar="SECONDS",
+                            help="with --headless, stop capturing after this long")
+    arg_parser.add_argument("--runtime", choices=RUNTIMES, default=RUNTIME,
+                            help="run the serial readers and logger in processes of their own, or all on one "
+                                 f"asyncio event loop in a single process (default {RUNTIME})")
+    arg_parser.add_argument("--profile", nargs="?", const="cprofile", choices=PROFILE_MODES,
+                            help="profile the serial reader and logger processes with cProfile (the default) "
+                                 "or by sampling their stacks, saving the results in save-data/profiles")
+    arg_parser.add_argument("--profile-memory", action="store_true",
+                            help="trace the allocations of the serial reader and logger processes with tracemalloc")
+    arg_parser.add_argument("--sample-interval", type=float, default=PROFILE_SAMPLE_INTERVAL, metavar="SECONDS",
+                            help=f"how often --profile sample records stacks (default {PROFILE_SAMPLE_INTERVAL})")
+    args = arg_parser.parse_args()
+
+    if args.headless and args.port is None:
+        arg_parser.error("--headless needs --port")
+    if args.duration is not None and not args.headless:
+        arg_parser.error("--duration needs --headless")
+    if args.baud <= 0:
+        arg_parser.error("--baud must be positive")
+    if args.runtime == "asyncio" and os.name != "posix":
+        arg_parser.error("--runtime asyncio needs Linux or MacOS")
+
+    selected_ports = None
+    if args.port is not None:
+        try:
+            selected_ports = name_ports(args.port)
+        except ValueError as e:
+            arg_parser.error(str(e))
 
-        # Prompt user for valid port.
-        while True:
-            try:
-                source_number = int(input("Please choose an input source:"))
-                selected_port = sources[source_number]
-                break
-            except (ValueError, IndexError):
-                pass
-            print("Invalid input. Please enter the number corresponding to your selection.")
+    profile = None
+    if args.profile or args.profile_memory:
+        profiles_dir = args.log_dir / PROFILES_DIR.name
+        try:
+            profile = ProfileOptions(profiles_dir / datetime.datetime.now().strftime(SESSION_FILE_FORMAT),
+                                     args.profile, args.profile_memory, args.sample_interval)
+        except ValueError as e:
+            arg_parser.error(str(e))
+
+    try:
+        if not args.headless:
+            print(SPLASH)
+            print("\nWelcome to the SOTI CLI!\n")
 
-        virtual_mode = selected_port is virtual_port
+        if selected_ports is None:
+            selected_ports = choose_ports()
+        port_names = [name for name, _ in selected_ports]
+
+        from live_display import DisplayControl
+        from pipeline_metrics import PipelineMetrics
 
         multiprocessing.set_start_method('spawn')
-        write_msg_queue = multiprocessing.Queue() # messages to be written to file
-        out_msg_queue = multiprocessing.Queue() # messages to send to SOTI board
+        metrics = PipelineMetrics(len(selected_ports)) # counters and latencies of the pipeline
+        display = DisplayControl() # how incoming traffic is shown
+        if args.headless:
+            # nobody is typing at a prompt, so the summary can't get in the way.
+            display.summary.set()
+        filters = FilterSettings() # which messages are logged and shown
 
         # thread-safe flags to tell the processes to stop.
         stop_serial_reader_flag = multiprocessing.Event()
         stop_session_logger_flag = multiprocessing.Event()
+        stop_simulator_flag = multiprocessing.Event()
 
         processes = []
+        simulators = []
+        rings = []
+
+        # the device each port is read from, or None if it can't be read.
+        ports = []
+        for i, (name, virtual) in enumerate(selected_ports):
+            port = name
+            # in virtual mode, the serial reader talks to a simulated board over
+            # a pseudo-terminal. These don't exist on Windows, so nothing is read.
+            if virtual:
+                if os.name != "posix":
+                    ports.append(None)
+                    continue
+                from simulator import start_simulator
+                simulator, port = start_simulator(stop_simulator_flag, seed=i, baud_rate=args.baud)
+                simulators.append(simulator)
+                print(f"Simulating a SOTI board on {port}.")
+            ports.append(port)
+
+        def headless_started():
+            print(f"Capturing from {', '.join(port_names)} into {args.log_dir}, "
+                  f"started in {time.monotonic() - STARTED:.2f} s. "
+                  "Press Ctrl+C to stop.")
+
+        if args.runtime == "asyncio":
+            from async_runtime import AsyncSession
+
+            # everything runs on an event loop in this process, which also
+            # stops it on Ctrl+C and SIGTERM.
+            session = AsyncSession(ports, port_names, args.baud, args.log_dir, display, filters, metrics)
+
+            def make_cli(session):
+                return CommandLine(session.send_queues[0], session.records, session.reply_queue, display, filters,
+                                   metrics, args.log_dir)
+
+            def on_start(session):
+                start_serving_metrics(metrics, session.records, session.send_queues[0])
+                if args.headless:
+                    headless_started()
+
+            run_args = (None if args.headless else make_cli, args.duration, on_start)
+            if profile:
+                from profiling import run_profiled
+                run_profiled(profile, "session", session.run, *run_args)
+            else:
+                session.run(*run_args)
 
-        # create the serial handler process
-        if not virtual_mode:
-            processes.append(multiprocessing.Process(
-                target=serial_reader,
-                args=(
-                    write_msg_queue,
-                    out_msg_queue,
-                    stop_serial_reader_flag,
-                    selected_port.device
+        else:
+            from serial_reader import serial_reader
+            from session_logger import log_messages
+            from frame_ring import FrameRing
+            from frame_merge import FrameMerger, port_rings
+
+            # messages to be written to file. Each port has its own ring, which
+            # the logger reads in capture order if there are several.
+            rings = [FrameRing()] if len(selected_ports) == 1 else port_rings(len(selected_ports))
+            frame_ring = rings[0] if len(rings) == 1 else FrameMerger(rings, metrics=metrics)
+            # messages to send to each SOTI board. Commands are sent to the first.
+            out_msg_queues = [multiprocessing.Queue() for _ in selected_ports]
+            reply_queue = multiprocessing.Queue(REPLY_QUEUE_SIZE) # replies to commands, for the CLI
+
+            for i, port in enumerate(ports):
+                if port is None:
+                    continue
+                # create the serial handler process
+                processes.append(worker_process(
+                    serial_reader,
+                    (
+                        rings[i],
+                        out_msg_queues[i],
+                        stop_serial_reader_flag,
+                        port,
+                        reply_queue,
+                        display,
+                        filters,
+                        metrics.writer(i),
+                        args.baud,
+                        i
                     ),
-                daemon=True)
-            )
-
-        # create the session logger process
-        processes.append(multiprocessing.Process(
-            target=log_messages,
-            args=(
-                write_msg_queue,
-                stop_session_logger_flag,
-                selected_port.device
-            ),
-            daemon=True)
-        )
-
-        # start the processes
-        for p in processes:
-            p.start()
-
-        CommandLine(out_msg_queue, write_msg_queue).cmdloop()
+                    profile,
+                    "serial_reader" if len(selected_ports) == 1 else f"serial_reader_{i}"
+                ))
+
+            # create the session logger process
+            processes.append(worker_process(
+                log_messages,
+                (
+                    frame_ring,
+                    stop_session_logger_flag,
+                    port_names[0] if len(port_names) == 1 else port_names,
+                    LOG_FORMATS,
+                    args.log_dir,
+                    display,
+                    filters,
+                    metrics
+                ),
+                profile
+            ))
+
+            # start the processes
+            for p in processes:
+                p.start()
+
+            start_serving_metrics(metrics, frame_ring, out_msg_queues[0])
+
+            if args.headless:
+                # stop on SIGTERM as on Ctrl+C, so the session is logged completely.
+                stop_flag = threading.Event()
+                signal.signal(signal.SIGTERM, lambda *_: stop_flag.set())
+                headless_started()
+                stop_flag.wait(args.duration)
+            else:
+                CommandLine(out_msg_queues[0], frame_ring, reply_queue, display, filters, metrics,
+                            args.log_dir).cmdloop()
 
     except KeyboardInterrupt:
         pass
@@ -179,4 +623,13 @@ if __name__ == "__main__":
         for p in processes:
             p.join()
 
+        # the simulated boards outlive the serial readers, like real ones would.
+        stop_simulator_flag.set()
+        for simulator in simulators:
+            simulator.join()
+
+        for ring in rings:
+            ring.close()
+            ring.unlink()
+
         print("\nExiting...")
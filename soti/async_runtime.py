@@ -0,0 +1,310 @@
+"""
+Runs a whole session in one process, on an asyncio event loop.
+
+By default a session is spread over processes: a serial reader for each
+port and a logger, which pass messages through shared memory. That keeps
+up with the busiest links, but each process takes a while to start and
+holds its own copy of the interpreter. With `python3 soti --runtime
+asyncio`, everything runs in one process instead:
+
+- the event loop reads each serial port when its file descriptor is
+  readable (POSIX only), so nothing polls while the link is quiet.
+- captured messages reach the logger task on an asyncio.Queue, as records
+  in the frame ring's layout, and are logged by the same SessionRecorder
+  as the logger process uses, on the loop's executor so that writing to
+  disk doesn't hold up the loop.
+- each port's writer task sends the messages put on its asyncio.Queue,
+  without blocking: what the driver can't take yet is written once the
+  event loop sees the port is writable again.
+- the CLI runs on its own thread, so waiting for input never blocks the
+  loop. Its commands reach the loop through RecordQueue and SendQueue,
+  which can be used from any thread.
+
+benchmarks/pipeline.py --runtime asyncio compares the two runtimes.
+"""
+
+import asyncio
+import contextlib
+import os
+import queue
+import signal
+import threading
+import time
+from pathlib import Path
+import serial
+from utils.constants import FRAME_SIZE, BAUD_RATE, POLL_INTERVAL, LOG_FORMATS, SAVE_DATA_DIR, REPLY_QUEUE_SIZE
+from message import Message
+from frame_ring import RECORD, DEFAULT_CAPACITY
+from serial_reader import PortCapture
+from session_logger import SessionRecorder
+from live_display import DisplayControl
+from message_filter import FilterSettings
+from pipeline_metrics import PipelineMetrics
+
+
+class RecordQueue:
+    """Batches of records for the logger task, with the parts of a FrameRing the CLI and metrics use.
+
+    Create it on the event loop's thread. write() may be called from any
+    thread; from others, the batch is handed to the loop. Like a
+    FrameRing, it holds at most `capacity` records and drops what doesn't
+    fit rather than blocking.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.dropped = 0
+        self._count = 0
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+
+    def __len__(self) -> int:
+        """The number of records waiting to be read."""
+        return self._count
+
+    def write(self, frames: list[bytes], times_ns: list[int], monos_ns: list[int], source: int,
+              port: int = 0) -> int:
+        """Queues a batch of messages.
+
+        On the loop's thread, returns the number of messages queued. From
+        other threads the batch is only queued later, so the return value
+        is optimistic: it is the number of messages handed to the loop,
+        and any which don't fit are only counted in `dropped`.
+        """
+        data = b"".join(
+            RECORD.pack(times_ns[i], monos_ns[i], source, port, frames[i]) for i in range(len(frames))
+        )
+        if threading.get_ident() == self._thread_id:
+            return self._put(data)
+        self._loop.call_soon_threadsafe(self._put, data)
+        return len(frames)
+
+    def _put(self, data: bytes) -> int:
+        count = len(data) // RECORD.size
+        free = self.capacity - self._count
+        if count > free:
+            self.dropped += count - free
+            count = free
+            data = data[:count * RECORD.size]
+        if count:
+            self._count += count
+            self._queue.put_nowait(data)
+        return count
+
+    async def read(self, timeout: float | None = None) -> bytes:
+        """Takes every waiting record, waiting for up to `timeout` seconds if there are none."""
+        if not self._queue.empty():
+            return self.take()
+        try:
+            first = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return b""
+        return first + self.take()
+
+    def take(self) -> bytes:
+        """Takes every waiting record without waiting."""
+        batches = []
+        while not self._queue.empty():
+            batches.append(self._queue.get_nowait())
+        self._count = 0
+        return b"".join(batches)
+
+
+class SendQueue:
+    """The messages to write to a port. put() may be called from any thread."""
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+
+    def put(self, msg: Message):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, msg)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def get(self) -> Message:
+        return await self._queue.get()
+
+
+async def log_records(records: RecordQueue, recorder: SessionRecorder, stop: asyncio.Event):
+    """Logs the records as they arrive until `stop` is set, then finishes the session.
+
+    Each batch is logged on the loop's default executor, as writing the
+    logs out may wait for the disk (e.g. to fsync them). Only one batch is
+    logged at a time, so they are logged in order.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while not stop.is_set():
+            await loop.run_in_executor(None, recorder.log, await records.read(POLL_INTERVAL))
+        # pick up anything which arrived while stopping.
+        await loop.run_in_executor(None, recorder.log, records.take())
+    finally:
+        await loop.run_in_executor(None, recorder.close, records.dropped)
+
+
+def writable(fd: int) -> asyncio.Future:
+    """A future which is done once `fd` can be written."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        loop.remove_writer(fd)
+        if not future.done():
+            future.set_result(None)
+
+    loop.add_writer(fd, ready)
+    return future
+
+
+async def write_messages(ser: serial.Serial, send_queue: SendQueue, display: DisplayControl | None = None,
+                         metrics: PipelineMetrics | None = None):
+    """Sends each message put on the queue, until cancelled.
+
+    Like serial_reader.send_message(), but the event loop carries on while
+    the port can't take any more. A message which hasn't been written
+    after the port's write_timeout is reported as timed out.
+    """
+    loop = asyncio.get_running_loop()
+    fd = ser.fileno()
+    os.set_blocking(fd, False)
+    while True:
+        out_msg = await send_queue.get()
+        if display is not None and display.verbose.is_set():
+            print(f"Sending '{out_msg.cmd_id.name}' to {out_msg.recipient.get_display_name()}.")
+
+        data = memoryview(out_msg.serialize())
+        deadline = time.monotonic() + ser.write_timeout
+        try:
+            while data:
+                try:
+                    data = data[os.write(fd, data):]
+                except BlockingIOError:
+                    await asyncio.wait_for(writable(fd), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            print("Send Fail: Serial write timed out.")
+            if metrics is not None:
+                metrics.add("send_timeouts")
+        except OSError as e:
+            print(f"Stopped writing {ser.port}: {e}")
+            return
+        else:
+            if metrics is not None:
+                metrics.add("frames_sent")
+        finally:
+            # stop watching the port if the wait timed out or was cancelled.
+            loop.remove_writer(fd)
+
+
+def read_port(ser: serial.Serial, capture: PortCapture):
+    """Takes everything the driver has buffered. Called by the event loop when the port is readable."""
+    try:
+        chunk = ser.read(ser.in_waiting or FRAME_SIZE)
+    except serial.SerialException as e:
+        print(f"Stopped reading {ser.port}: {e}")
+        asyncio.get_running_loop().remove_reader(ser.fileno())
+        return
+    # stamp the bytes as soon as they're read.
+    capture.feed(chunk, time.monotonic_ns())
+
+
+class AsyncSession:
+    """A session whose ports, logger and CLI share one event loop.
+
+    `ports` are the serial ports to read, or None for one which can't be
+    read (a simulated board on Windows), and `port_names` what each is
+    logged as. The other arguments are as for the serial reader and
+    logger processes.
+    """
+
+    def __init__(self, ports: list[str | None], port_names: list[str], baud_rate: int = BAUD_RATE,
+                 save_dir: Path = SAVE_DATA_DIR, display: DisplayControl | None = None,
+                 filters: FilterSettings | None = None, metrics: PipelineMetrics | None = None,
+                 log_formats=LOG_FORMATS):
+        self.ports = ports
+        self.port_names = port_names
+        self.baud_rate = baud_rate
+        self.save_dir = save_dir
+        self.display = display
+        self.filters = filters
+        self.metrics = metrics
+        self.log_formats = log_formats
+        # created on the event loop, once it runs.
+        self.records: RecordQueue | None = None
+        self.send_queues: list[SendQueue] = []
+        # replies to commands, for the CLI.
+        self.reply_queue = queue.Queue(REPLY_QUEUE_SIZE)
+
+    def run(self, make_cli=None, duration: float | None = None, on_start=None):
+        """Captures until the CLI made by make_cli(session) exits, Ctrl+C or SIGTERM, or `duration` seconds.
+
+        Ctrl+C calls the CLI's interrupt() first, and only stops the
+        session if that returns False. on_start(session) is called once
+        the ports are open and the session's queues exist, e.g. to serve
+        their metrics.
+        """
+        asyncio.run(self._run(make_cli, duration, on_start))
+
+    async def _run(self, make_cli, duration: float | None, on_start):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        cli = None
+
+        def interrupted():
+            # Ctrl+C only reaches this thread, so the CLI is asked to cancel what it's doing first.
+            if cli is None or not cli.interrupt():
+                stop.set()
+
+        # stop on Ctrl+C and SIGTERM, so the session is logged completely.
+        loop.add_signal_handler(signal.SIGINT, interrupted)
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+        self.records = RecordQueue()
+        self.send_queues = [SendQueue() for _ in self.ports]
+        recorder = SessionRecorder(self.port_names[0] if len(self.port_names) == 1 else self.port_names,
+                                   self.log_formats, self.save_dir, self.display, self.filters, self.metrics)
+        stop_logger = asyncio.Event()
+        logger = asyncio.create_task(log_records(self.records, recorder, stop_logger))
+
+        writers = []
+        with contextlib.ExitStack() as open_ports:
+            for i, port in enumerate(self.ports):
+                if port is None:
+                    continue
+                ser = open_ports.enter_context(
+                    serial.Serial(port, baudrate=self.baud_rate, timeout=0, write_timeout=1)
+                )
+                metrics = self.metrics.writer(i) if self.metrics else None
+                capture = PortCapture(self.records, self.reply_queue, self.display, self.filters, metrics,
+                                      self.baud_rate, i)
+                loop.add_reader(ser.fileno(), read_port, ser, capture)
+                open_ports.callback(loop.remove_reader, ser.fileno())
+                writers.append(asyncio.create_task(write_messages(ser, self.send_queues[i], self.display, metrics)))
+
+            if on_start is not None:
+                on_start(self)
+            if make_cli is not None:
+                # a daemon thread, so a prompt waiting for input doesn't keep SOTI from exiting.
+                cli = make_cli(self)
+                threading.Thread(target=self._run_cli, args=(cli, loop, stop), daemon=True).start()
+
+            try:
+                await asyncio.wait_for(stop.wait(), duration)
+            except asyncio.TimeoutError:
+                pass
+
+            for writer in writers:
+                writer.cancel()
+            await asyncio.gather(*writers, return_exceptions=True)
+
+        stop_logger.set()
+        await logger
+
+    @staticmethod
+    def _run_cli(cli, loop: asyncio.AbstractEventLoop, stop: asyncio.Event):
+        try:
+            cli.cmdloop()
+        finally:
+            loop.call_soon_threadsafe(stop.set)
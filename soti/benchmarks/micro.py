@@ -0,0 +1,116 @@
+"""
+Times the functions each message passes through, one at a time.
+
+Run from the root folder:
+python3 soti/benchmarks/micro.py [--repeat N] [--output results.json]
+
+Each result is the best of `repeat` timings, in nanoseconds per call.
+"""
+
+import argparse
+import multiprocessing
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.constants import NodeID, CmdID, MESSAGE_SOURCES
+from message import Message
+from body_codec import decode_body
+from framing import StreamFramer, encode_frame
+from frame_ring import FrameRing, iter_records
+from frame_merge import FrameMerger, port_rings
+from session_logger import dict_to_yaml
+import parser
+from results import save_results
+
+PORT_SOURCE = MESSAGE_SOURCES.index("port")
+# messages per FrameRing write and multiprocessing.Queue round trip.
+BATCH = 64
+# ports merged by FrameMerger, each writing BATCH / PORTS messages.
+PORTS = 4
+
+
+def time_call(function, repeat: int) -> float:
+    """Returns the fastest time of one call to `function` in nanoseconds."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def benchmarks() -> tuple[dict, list[FrameRing]]:
+    """Returns {name: (function, calls it stands for)} and the rings the cases use.
+
+    The rings are shared memory, so the caller closes and unlinks them
+    once the cases have run.
+    """
+    msg = Message(3, NodeID.PLD, NodeID.CDH, CmdID.CDH_PROCESS_TELEMETRY_REPORT, bytes([1, 2, 0, 4, 5, 6, 7]))
+    msg_bytes = msg.serialize()
+    msg_dict = msg.as_dict()
+    frames = encode_frame(msg_bytes) * BATCH
+    framer = StreamFramer()
+
+    ring = FrameRing()
+    ring_frames = [msg_bytes] * BATCH
+    ring_times = [msg.time_ns] * BATCH
+
+    def ring_round_trip():
+        ring.write(ring_frames, ring_times, ring_times, PORT_SOURCE)
+        for record in iter_records(ring.read(timeout=0)):
+            pass
+
+    merge_rings = port_rings(PORTS)
+    merger = FrameMerger(merge_rings, window=0)
+    per_port = BATCH // PORTS
+    # the ports' messages interleave in time, so they really have to be merged.
+    port_times = [[msg.time_ns + PORTS * i + port for i in range(per_port)] for port in range(PORTS)]
+
+    def merge_round_trip():
+        for port, merge_ring in enumerate(merge_rings):
+            merge_ring.write(ring_frames[:per_port], port_times[port], port_times[port], PORT_SOURCE, port)
+        merger.take()
+
+    queue = multiprocessing.Queue()
+
+    def queue_round_trip():
+        for _ in range(BATCH):
+            queue.put(msg)
+        for _ in range(BATCH):
+            queue.get()
+
+    return {
+        "Message.deserialize": (lambda: Message.deserialize(msg_bytes, "port"), 1),
+        "Message.deserialize+as_dict": (lambda: Message.deserialize(msg_bytes, "port").as_dict(), 1),
+        "decode_body": (lambda: decode_body(CmdID.CDH_PROCESS_TELEMETRY_REPORT, msg.body), 1),
+        "dict_to_yaml": (lambda: dict_to_yaml(msg_dict, 1, True), 1),
+        "parser.parse_send": (lambda: parser.parse_send("PLD_SET_SETPOINT 2 37.5", NodeID.CDH), 1),
+        "StreamFramer.feed": (lambda: framer.feed(frames), BATCH),
+        "FrameRing write+read": (ring_round_trip, BATCH),
+        f"FrameMerger write+take ({PORTS} ports)": (merge_round_trip, BATCH),
+        "multiprocessing.Queue put+get": (queue_round_trip, BATCH),
+    }, [ring, *merge_rings]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--output", type=Path)
+    args = arg_parser.parse_args()
+
+    cases, rings = benchmarks()
+    results = {}
+    try:
+        for name, (function, calls) in cases.items():
+            results[name] = round(time_call(function, args.repeat) / calls, 1)
+            print(f"{name:32} {results[name]:10,.1f} ns per message")
+    finally:
+        for ring in rings:
+            ring.close()
+            ring.unlink()
+
+    print(f"Saved {save_results('micro', {'repeat': args.repeat}, results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
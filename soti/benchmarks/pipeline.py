@@ -0,0 +1,221 @@
+"""
+Pushes frames through a pseudo-terminal into serial_reader and log_messages.
+
+Run from the root folder (POSIX only):
+python3 soti/benchmarks/pipeline.py [--frames N] [--batch N] [--ports N] [--runtime processes|asyncio]
+                                    [--output results.json]
+
+The frames are written to the pty as fast as it accepts them. With
+--ports, they are shared between that many ptys, each with its own serial
+reader, and merged into one session by a FrameMerger. With --runtime
+asyncio, the ports are read and the session logged by one process running
+async_runtime.AsyncSession instead. Reports the frames/s captured, the
+latency from writing each frame to the serial reader capturing it, and the
+CPU time (in total and per frame) and peak memory of each process. The
+session is logged to a temporary folder which is deleted afterwards.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tty
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.constants import NodeID, CmdID, SESSIONS_DIR, LOG_FORMATS, BAUD_RATE
+from message import Message
+from framing import encode_frame
+from frame_ring import FrameRing
+from frame_merge import FrameMerger, port_rings
+from binary_log import BinaryLogReader
+from serial_reader import serial_reader
+from session_logger import log_messages
+from async_runtime import AsyncSession
+from results import save_results
+
+# how long the logger may go without logging anything before the run is
+# considered finished. Longer than the log flush interval.
+IDLE_TIMEOUT = 3.0 # seconds
+
+
+def make_frames(count: int) -> list[bytes]:
+    """Telemetry reports whose payload is their index, so each can be matched to its send time."""
+    return [
+        encode_frame(Message(3, NodeID.PLD, NodeID.CDH, CmdID.CDH_PROCESS_TELEMETRY_REPORT,
+                             bytes([1, i % 256, 0]) + struct.pack("<I", i)).serialize())
+        for i in range(count)
+    ]
+
+
+def measured(name: str, usage_queue, target, *args):
+    """Runs `target` quietly, then reports the CPU time and peak memory of the process."""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        target(*args)
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in kilobytes on Linux but bytes on MacOS.
+        peak_kb = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        usage_queue.put((name, usage.ru_utime + usage.ru_stime, peak_kb))
+
+
+def run_async_session(ports: list[str], save_dir: Path):
+    """Captures from the ports on one event loop until SIGTERM."""
+    AsyncSession(ports, ports, BAUD_RATE, save_dir).run()
+
+
+def percentiles(values: list, points=(50, 90, 99, 99.9)) -> dict:
+    values = sorted(values)
+    result = {f"p{point:g}": values[min(len(values) - 1, int(len(values) * point / 100))] for point in points}
+    result["max"] = values[-1]
+    return result
+
+
+def logged_count(sessions_dir: Path) -> int:
+    for path in sessions_dir.glob("*.bin"):
+        with BinaryLogReader(path) as log:
+            return len(log)
+    return 0
+
+
+def run(count: int, batch: int, save_dir: Path, ports: int = 1, runtime: str = "processes") -> dict:
+    ptys = [os.openpty() for _ in range(ports)]
+    for _, device_fd in ptys:
+        tty.setraw(device_fd)
+    port_names = [os.ttyname(device_fd) for _, device_fd in ptys]
+
+    stop_reader = multiprocessing.Event()
+    stop_logger = multiprocessing.Event()
+    usage_queue = multiprocessing.Queue()
+    if runtime == "asyncio":
+        rings = []
+        processes = [multiprocessing.Process(target=measured, args=(
+            "asyncio_session", usage_queue, run_async_session, port_names, save_dir
+        ))]
+    else:
+        rings = [FrameRing()] if ports == 1 else port_rings(ports)
+        frame_ring = rings[0] if ports == 1 else FrameMerger(rings)
+        out_msg_queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=measured, args=(
+                "serial_reader" if ports == 1 else f"serial_reader_{i}", usage_queue, serial_reader,
+                rings[i], out_msg_queue, stop_reader, port_names[i], None, None, None, None, BAUD_RATE, i
+            ))
+            for i in range(ports)
+        ]
+        processes.append(multiprocessing.Process(target=measured, args=(
+            "log_messages", usage_queue, log_messages, frame_ring, stop_logger,
+            port_names[0] if ports == 1 else port_names, LOG_FORMATS, save_dir
+        )))
+    for p in processes:
+        p.start()
+
+    frames = make_frames(count)
+    send_ns = [0] * count
+    # give the processes time to finish importing and open the ports.
+    time.sleep(1.5)
+
+    def send(port: int):
+        """Writes every `ports`th frame to a port, starting from frame `port`."""
+        controller_fd = ptys[port][0]
+        indices = range(port, count, ports)
+        for start in range(0, len(indices), batch):
+            chunk_indices = indices[start:start + batch]
+            chunk = memoryview(b"".join([frames[i] for i in chunk_indices]))
+            now = time.monotonic_ns()
+            for i in chunk_indices:
+                send_ns[i] = now
+            while chunk:
+                chunk = chunk[os.write(controller_fd, chunk):]
+
+    senders = [threading.Thread(target=send, args=(port,)) for port in range(ports)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    # wait for the logger to catch up and flush.
+    sessions_dir = save_dir / SESSIONS_DIR.name
+    logged, last_change = 0, time.monotonic()
+    while logged < count and time.monotonic() - last_change < IDLE_TIMEOUT:
+        time.sleep(0.1)
+        if (new_count := logged_count(sessions_dir)) != logged:
+            logged, last_change = new_count, time.monotonic()
+
+    stop_reader.set()
+    stop_logger.set()
+    if runtime == "asyncio":
+        # the session stops on SIGTERM as on Ctrl+C.
+        processes[0].terminate()
+    usage = {}
+    for _ in processes:
+        name, cpu_s, peak_kb = usage_queue.get()
+        usage[name] = {
+            "cpu_s": round(cpu_s, 3),
+            "cpu_us_per_frame": round(cpu_s / count * 1e6, 2),
+            "peak_memory_kb": peak_kb,
+        }
+    for p in processes:
+        p.join()
+
+    # the asyncio session doesn't report its drops, but whatever wasn't logged was dropped.
+    dropped = frame_ring.dropped if rings else None
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+    for controller_fd, device_fd in ptys:
+        os.close(controller_fd)
+        os.close(device_fd)
+
+    latencies_us = []
+    first_send_ns = min(send_ns)
+    last_capture_ns = first_send_ns
+    with BinaryLogReader(next(sessions_dir.glob("*.bin"))) as log:
+        for _, capture_mono, _, _, msg_bytes in log:
+            index = struct.unpack_from("<I", msg_bytes, 7)[0]
+            latencies_us.append((capture_mono - send_ns[index]) / 1000)
+            last_capture_ns = max(last_capture_ns, capture_mono)
+
+    return {
+        "logged": len(latencies_us),
+        "dropped": count - len(latencies_us) if dropped is None else dropped,
+        "frames_per_s": round(len(latencies_us) / ((last_capture_ns - first_send_ns) / 1e9)),
+        "capture_latency_us": {name: round(value, 1) for name, value in percentiles(latencies_us).items()},
+        "processes": usage,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--frames", type=int, default=100_000)
+    arg_parser.add_argument("--batch", type=int, default=64, help="frames per write to the pty")
+    arg_parser.add_argument("--ports", type=int, default=1, help="ptys to share the frames between")
+    arg_parser.add_argument("--runtime", choices=("processes", "asyncio"), default="processes",
+                            help="run the serial readers and logger as processes or on one event loop")
+    arg_parser.add_argument("--output", type=Path)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        results = run(args.frames, args.batch, Path(save_dir), args.ports, args.runtime)
+
+    print(f"Logged {results['logged']:,} of {args.frames:,} frames "
+          f"({results['dropped']:,} dropped) at {results['frames_per_s']:,} frames/s")
+    print("Capture latency (us): " + ", ".join(f"{k} {v:,}" for k, v in results["capture_latency_us"].items()))
+    for name, usage in results["processes"].items():
+        print(f"{name}: {usage['cpu_s']} s CPU ({usage['cpu_us_per_frame']} us per frame), "
+              f"{usage['peak_memory_kb']:,} KiB peak memory")
+
+    parameters = {"frames": args.frames, "batch": args.batch, "ports": args.ports, "runtime": args.runtime}
+    print(f"Saved {save_results('pipeline', parameters, results, args.output)}")
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
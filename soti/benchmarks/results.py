@@ -0,0 +1,89 @@
+"""
+Saves benchmark results as JSON and compares saved runs.
+
+Each run is written to its own file with enough context (commit, Python
+version, machine) to tell runs apart later. To compare two runs, run from
+the root folder:
+
+python3 soti/benchmarks/results.py <before.json> <after.json>
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.constants import SAVE_DATA_DIR, SESSION_FILE_FORMAT
+
+RESULTS_DIR = SAVE_DATA_DIR / "benchmarks"
+
+
+def git_commit() -> str | None:
+    """The commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name: str, parameters: dict, results: dict, output: Path | None = None) -> Path:
+    """Writes a run's results to `output`, or to a new file in RESULTS_DIR."""
+    now = datetime.datetime.now()
+    if output is None:
+        output = RESULTS_DIR / f"{name}_{now.strftime(SESSION_FILE_FORMAT)}.json"
+
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "benchmark": name,
+        "time": now.isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": results,
+    }, indent=2) + "\n")
+    return output
+
+
+def load_results(path: Path) -> dict:
+    return json.loads(Path(path).read_text())
+
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(before: dict, after: dict):
+    """Prints every result of two runs side by side, with the relative change."""
+    print(f"{'':40} {before['commit'] or 'before':>14} {after['commit'] or 'after':>14}")
+    old, new = _flatten(before["results"]), _flatten(after["results"])
+    for key in sorted(old.keys() | new.keys()):
+        a, b = old.get(key), new.get(key)
+        change = ""
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a:
+            change = f"{(b - a) / a:+.1%}"
+        print(f"{key:40} {a!s:>14} {b!s:>14} {change:>8}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Compares two saved benchmark runs.")
+    arg_parser.add_argument("before", type=Path)
+    arg_parser.add_argument("after", type=Path)
+    args = arg_parser.parse_args()
+
+    compare(load_results(args.before), load_results(args.after))
@@ -0,0 +1,111 @@
+"""
+Compares the multiprocessing.Queue transport with the shared-memory FrameRing.
+
+Run from the root folder:
+python3 soti/benchmarks/transport.py [--frames N] [--batch N]
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+# allow the soti modules to be imported the same way the CLI imports them.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.constants import NodeID, CmdID, MESSAGE_SOURCES
+from message import Message
+from frame_ring import FrameRing, iter_records
+
+PORT_SOURCE = MESSAGE_SOURCES.index("port")
+
+
+def make_frames(count: int) -> list[bytes]:
+    """Builds telemetry reports like the ones seen during a HIL session."""
+    return [
+        Message(3, NodeID.PLD, NodeID.CDH, CmdID.CDH_PROCESS_TELEMETRY_REPORT,
+                bytes([i % 256, i % 256, 0, 1, 2, 3, 4])).serialize()
+        for i in range(count)
+    ]
+
+
+def queue_producer(queue, frames, batch, go):
+    go.wait()
+    for msg_bytes in frames:
+        queue.put(Message.deserialize(msg_bytes, "port"))
+
+
+def queue_consumer(queue, count, result):
+    for _ in range(count):
+        queue.get()
+    result.put(time.perf_counter())
+
+
+def ring_producer(ring, frames, batch, go):
+    go.wait()
+    for i in range(0, len(frames), batch):
+        chunk = frames[i:i + batch]
+        times_ns = [time.time_ns()] * len(chunk)
+        monos_ns = [time.monotonic_ns()] * len(chunk)
+        while ring.write(chunk, times_ns, monos_ns, PORT_SOURCE) == 0:
+            # the consumer is behind; give it a moment rather than dropping.
+            time.sleep(0.0001)
+
+
+def ring_consumer(ring, count, result):
+    received = 0
+    while received < count:
+        for capture_time, capture_mono, source, _, msg_bytes in iter_records(ring.read(timeout=1)):
+            Message.deserialize(msg_bytes, MESSAGE_SOURCES[source], capture_time, capture_mono)
+            received += 1
+    result.put(time.perf_counter())
+
+
+def run(producer, consumer, transport, frames: list[bytes], batch: int) -> float:
+    """Returns the number of messages per second delivered end to end."""
+    go = multiprocessing.Event()
+    result = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=producer, args=(transport, frames, batch, go)),
+        multiprocessing.Process(target=consumer, args=(transport, len(frames), result)),
+    ]
+    for p in processes:
+        p.start()
+
+    # give both processes time to finish importing before the clock starts.
+    time.sleep(1)
+    start = time.perf_counter()
+    go.set()
+    end = result.get()
+
+    for p in processes:
+        p.join()
+
+    return len(frames) / (end - start)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--frames", type=int, default=200_000)
+    arg_parser.add_argument("--batch", type=int, default=64,
+                            help="messages per FrameRing write (one serial read's worth)")
+    args = arg_parser.parse_args()
+
+    frames = make_frames(args.frames)
+
+    queue_rate = run(queue_producer, queue_consumer, multiprocessing.Queue(), frames, args.batch)
+    print(f"multiprocessing.Queue: {queue_rate:12,.0f} msg/s")
+
+    ring = FrameRing()
+    try:
+        ring_rate = run(ring_producer, ring_consumer, ring, frames, args.batch)
+    finally:
+        ring.close()
+        ring.unlink()
+    print(f"FrameRing:             {ring_rate:12,.0f} msg/s ({ring_rate / queue_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
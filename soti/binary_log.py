@@ -0,0 +1,286 @@
+"""
+A compact binary session log with a memory-mapped reader.
+
+The file is a fixed header followed by fixed-size records, in the same
+layout frame_ring.RECORD uses in shared memory, so batches from the ring can
+be written straight to disk. Compressed segments of a log (see
+log_segments.py) can't be memory-mapped, so BinaryLogStream reads them
+from start to end instead. To convert a binary log into the YAML layout,
+run from the root folder:
+
+python3 soti/binary_log.py <file.bin> [output.log]
+"""
+
+import argparse
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from utils.constants import MESSAGE_SOURCES, LOG_FLUSH_INTERVAL, LOG_FLUSH_SIZE
+from frame_ring import RECORD
+from log_segments import open_log_file
+
+MAGIC = b"SOTILOG\0"
+# Increase this whenever the header or RECORD layout changes.
+FORMAT_VERSION = 3
+
+# The most bytes the names of a session's ports can take up.
+PORTS_SIZE = 256
+# magic, format version, header size, record size, start time (ns since epoch),
+# the ports a record's port index refers to, one per line
+HEADER = struct.Struct(f"<8sHHHxxq{PORTS_SIZE}s")
+
+
+class FormatError(Exception):
+    pass
+
+
+# Records are read from streams this many at a time.
+STREAM_CHUNK = 4096
+
+
+def _parse_header(path: Path, header: bytes) -> tuple[int, list[str], int]:
+    """Checks a log's header. Returns its start time, ports and header size."""
+    if len(header) < HEADER.size:
+        raise FormatError(f"'{path}' is too short to be a binary session log")
+    magic, version, header_size, record_size, start_ns, ports = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise FormatError(f"'{path}' is not a binary session log")
+    if version != FORMAT_VERSION or record_size != RECORD.size:
+        raise FormatError(f"'{path}' uses unsupported format version {version}")
+    return start_ns, ports.rstrip(b"\0").decode("utf_8").split("\n"), header_size
+
+
+class BinaryLogWriter:
+    """Appends raw records to a binary session log in buffered batches.
+
+    `ports` are the ports of the session, in the order of the port index
+    of each record.
+    """
+
+    def __init__(self, path: Path, start_time: datetime.datetime, ports: list[str],
+                 flush_interval: float = LOG_FLUSH_INTERVAL,
+                 flush_size: int = LOG_FLUSH_SIZE,
+                 fsync: bool = True):
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._last_flush = time.monotonic()
+
+        encoded_ports = "\n".join(str(port) for port in ports).encode("utf_8")
+        if len(encoded_ports) > PORTS_SIZE:
+            raise ValueError("The names of the ports are too long to fit in a binary log's header")
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # the file object's own buffer holds records until the next flush.
+        self._file = open(path, 'wb', buffering=flush_size)
+        self._file.write(HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            HEADER.size,
+            RECORD.size,
+            int(start_time.timestamp() * 1e9),
+            encoded_ports
+        ))
+        self.flush()
+
+    @property
+    def size(self) -> int:
+        """The length of the log in bytes, including records not yet written out."""
+        return self._file.tell()
+
+    def write_records(self, batch: bytes):
+        """Appends packed records, such as a batch read from a FrameRing."""
+        self._file.write(batch)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Writes out buffered records if the flush interval has passed."""
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes out buffered records."""
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class _RecordTimes:
+    """A read-only sequence of record times, so bisect can search the file in place."""
+
+    def __init__(self, log: "BinaryLogReader"):
+        self._log = log
+
+    def __len__(self):
+        return len(self._log)
+
+    def __getitem__(self, index: int) -> int:
+        return struct.unpack_from("<q", self._log._mm, self._log._offset(index))[0]
+
+
+class BinaryLogReader:
+    """Random access to the records of a binary session log.
+
+    The file is memory-mapped, so opening even a very large log is instant
+    and only the records which are accessed are read from disk. Records are
+    (time_ns, mono_ns, source, port, msg_bytes) tuples, where `port` is an
+    index into `ports`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            self._file.close()
+            raise FormatError(f"'{self.path}' is too short to be a binary session log")
+
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.start_time_ns, self.ports, header_size = _parse_header(self.path, self._mm)
+        except FormatError:
+            self.close()
+            raise
+
+        self.version = FORMAT_VERSION
+        self._header_size = header_size
+        # a record cut short by a crash is ignored.
+        self._count = (size - header_size) // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        try:
+            self._mm.close()
+        except BufferError:
+            # views from raw() (e.g. NumPy arrays) are still in use. The file
+            # is unmapped once they are garbage collected.
+            pass
+        self._file.close()
+
+    def _offset(self, index: int) -> int:
+        return self._header_size + index * RECORD.size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return list(RECORD.iter_unpack(self.raw(start, stop)))
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("record index out of range")
+        return RECORD.unpack_from(self._mm, self._offset(index))
+
+    def __iter__(self):
+        return RECORD.iter_unpack(self.raw())
+
+    def raw(self, start: int = 0, stop: int | None = None) -> memoryview:
+        """Returns the packed records in [start, stop) without copying them."""
+        if stop is None:
+            stop = self._count
+        return memoryview(self._mm)[self._offset(start):self._offset(stop)]
+
+    def index_of_time(self, time_ns: int) -> int:
+        """Returns the index of the first record captured at or after `time_ns`."""
+        return bisect.bisect_left(_RecordTimes(self), time_ns)
+
+    def between(self, start_ns: int, end_ns: int) -> list:
+        """Returns the records captured in [start_ns, end_ns)."""
+        return self[self.index_of_time(start_ns):self.index_of_time(end_ns)]
+
+    @property
+    def end_time_ns(self) -> int:
+        """The capture time of the last record, or the start time of an empty log."""
+        return self[-1][0] if self._count else self.start_time_ns
+
+
+class BinaryLogStream:
+    """Reads the records of a binary session log in order, whether or not it is compressed.
+
+    Records are (time_ns, mono_ns, source, port, msg_bytes) tuples, as from
+    BinaryLogReader.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open_log_file(self.path)
+        try:
+            header = self._file.read(HEADER.size)
+            self.start_time_ns, self.ports, header_size = _parse_header(self.path, header)
+            self._file.read(header_size - HEADER.size)
+        except (FormatError, OSError, EOFError):
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        remainder = b""
+        while chunk := self._file.read(RECORD.size * STREAM_CHUNK):
+            data = remainder + chunk
+            end = len(data) - len(data) % RECORD.size
+            yield from RECORD.iter_unpack(data[:end])
+            # a record cut short by a crash is ignored.
+            remainder = data[end:]
+
+
+def export_yaml(path: Path, output_path: Path | None = None) -> Path:
+    """Writes a binary session log out in the YAML layout used by session_logger."""
+    # imported here because session_logger depends on this module.
+    from session_logger import SessionLogWriter, FsyncPolicy, dict_to_yaml
+    from message import Message
+
+    path = Path(path)
+    output_path = path.with_suffix(".log") if output_path is None else Path(output_path)
+
+    with BinaryLogReader(path) as log:
+        start_time = datetime.datetime.fromtimestamp(log.start_time_ns / 1e9)
+        writer = SessionLogWriter(output_path, start_time, ", ".join(log.ports), fsync_policy=FsyncPolicy.NEVER)
+        # each message only says which port it came from if there were several.
+        tag_ports = len(log.ports) > 1
+
+        for capture_time, capture_mono, source, port, msg_bytes in log:
+            try:
+                msg = Message.deserialize(msg_bytes, MESSAGE_SOURCES[source], capture_time, capture_mono)
+            except ValueError:
+                continue
+            msg_dict = {**msg.as_dict(), "port": log.ports[port]} if tag_ports else msg.as_dict()
+            writer.write(dict_to_yaml(msg_dict, 1, True) + "\n")
+
+        writer.close(datetime.datetime.fromtimestamp(log.end_time_ns / 1e9))
+
+    return output_path
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Converts a binary session log to YAML.")
+    arg_parser.add_argument("path", type=Path)
+    arg_parser.add_argument("output", type=Path, nargs="?")
+    args = arg_parser.parse_args()
+
+    print(f"Wrote {export_yaml(args.path, args.output)}")
@@ -0,0 +1,188 @@
+"""
+Decodes and encodes message bodies using BODY_SCHEMA.
+
+The schema is compiled once, at import time, into a struct.Struct for each
+command and a table indexed by command value, so decoding a body is a list
+lookup and a single unpack_from().
+"""
+
+import re
+import struct
+from enum import Enum
+from utils.constants import BODY_SCHEMA, DATA_SIZE, CmdID, NodeID
+
+RAW_TYPE_RE = re.compile(r'(hex|bin)(\d+)$')
+
+# struct format of each numeric field type.
+NUMBER_FORMATS = {
+    "u8": "B",
+    "u16": "H",
+    "u32": "I",
+    "i8": "b",
+    "i16": "h",
+    "i32": "i",
+    "f32": "f",
+    "bool": "?",
+    "node": "B",
+    "cmd": "B",
+}
+
+ENUM_TYPES = {
+    "node": NodeID,
+    "cmd": CmdID,
+}
+
+
+def to_hex_str(data: bytes) -> str:
+    """Returns a hexadecimal representation of the provided data."""
+    return "0x" + data.hex()
+
+
+def to_bin_str(data: bytes) -> str:
+    """Returns a binary representation of the provided data."""
+    return "0b" + "".join(f"{byte:08b}" for byte in data)
+
+
+def from_hex_str(s: str, size: int) -> bytes:
+    """Inverse of to_hex_str(). Short values are padded with zeroes."""
+    return bytes.fromhex(s.removeprefix("0x")).ljust(size, b"\0")[:size]
+
+
+def from_bin_str(s: str, size: int) -> bytes:
+    """Inverse of to_bin_str(). Short values are padded with zeroes."""
+    bits = s.removeprefix("0b")
+    data = int(bits, 2).to_bytes((len(bits) + 7) // 8, byteorder="big") if bits else b""
+    return data.ljust(size, b"\0")[:size]
+
+
+def field_format(field_type: str) -> str:
+    """Returns the struct format of a schema field type."""
+    if field_type in NUMBER_FORMATS:
+        return NUMBER_FORMATS[field_type]
+    raw_match = RAW_TYPE_RE.match(field_type)
+    if raw_match:
+        return f"{raw_match.group(2)}s"
+    raise ValueError(f"Unknown field type '{field_type}'")
+
+
+def field_size(field_type: str) -> int:
+    """Returns the size of a schema field type in bytes."""
+    return struct.calcsize("<" + field_format(field_type))
+
+
+def _enum_or_int(enum_type):
+    def convert(value):
+        try:
+            return enum_type(value)
+        except ValueError:
+            # keep unknown IDs visible instead of failing the whole message.
+            return value
+    return convert
+
+
+def _decode_converter(field_type: str):
+    """Returns the function which turns an unpacked value into its displayed form."""
+    if field_type in ENUM_TYPES:
+        return _enum_or_int(ENUM_TYPES[field_type])
+    if field_type.startswith("hex"):
+        return to_hex_str
+    if field_type.startswith("bin"):
+        return to_bin_str
+    return None
+
+
+def _encode_converter(field_type: str):
+    """Returns the function which turns a displayed value back into a packable one."""
+    size = field_size(field_type)
+    if field_type in ENUM_TYPES:
+        enum_type = ENUM_TYPES[field_type]
+        def convert(value):
+            if isinstance(value, Enum):
+                return value.value
+            if isinstance(value, str):
+                return enum_type[value].value
+            return value
+        return convert
+    if field_type.startswith("hex"):
+        return lambda value: value if isinstance(value, bytes) else from_hex_str(value, size)
+    if field_type.startswith("bin"):
+        return lambda value: value if isinstance(value, bytes) else from_bin_str(value, size)
+    if field_type == "bool":
+        return lambda value: value if isinstance(value, bool) else value not in (0, "False", "false")
+    return None
+
+
+class BodyCodec:
+    """The compiled form of one command's body layout."""
+
+    def __init__(self, fields: tuple):
+        fields = sorted(fields, key=lambda field: field[2])
+
+        # build a single format, skipping any gaps between fields.
+        fmt = "<"
+        position = 0
+        for name, field_type, offset in fields:
+            if offset < position:
+                raise ValueError(f"Field '{name}' overlaps the previous field")
+            fmt += "x" * (offset - position) + field_format(field_type)
+            position = offset + field_size(field_type)
+        if position > DATA_SIZE:
+            raise ValueError(f"Fields take {position} bytes but the body is only {DATA_SIZE}")
+
+        self.struct = struct.Struct(fmt)
+        self.fields = fields
+        self.names = tuple(name for name, _, _ in fields)
+        self.types = {name: field_type for name, field_type, _ in fields}
+        self.offsets = {name: offset for name, _, offset in fields}
+
+        # only fields which need converting are visited after unpacking.
+        self._decoders = [
+            (i, converter) for i, (_, field_type, _) in enumerate(fields)
+            if (converter := _decode_converter(field_type))
+        ]
+        self._defaults = tuple(
+            b"" if RAW_TYPE_RE.match(field_type) else 0 for _, field_type, _ in fields
+        )
+        self._encoders = [
+            (i, converter) for i, (_, field_type, _) in enumerate(fields)
+            if (converter := _encode_converter(field_type))
+        ]
+
+    def decode(self, body: bytes) -> dict:
+        values = self.struct.unpack_from(body)
+        if self._decoders:
+            values = list(values)
+            for i, converter in self._decoders:
+                values[i] = converter(values[i])
+        return dict(zip(self.names, values))
+
+    def encode(self, values: dict) -> bytes:
+        """Packs field values (in the form decode() returns) into a body. Missing fields are zero."""
+        packed = [values.get(name, default) for name, default in zip(self.names, self._defaults)]
+        for i, converter in self._encoders:
+            if self.names[i] in values:
+                packed[i] = converter(packed[i])
+        body = bytearray(DATA_SIZE)
+        self.struct.pack_into(body, 0, *packed)
+        return bytes(body)
+
+
+# Indexed by command value. None for commands without a body.
+CODECS: list[BodyCodec | None] = [None] * (max(cmd_id.value for cmd_id in CmdID) + 1)
+
+for _cmd_id, _fields in BODY_SCHEMA.items():
+    CODECS[_cmd_id.value] = BodyCodec(_fields)
+
+
+def decode_body(cmd_id: CmdID, body: bytes) -> dict:
+    """Returns the named fields of a message body."""
+    codec = CODECS[cmd_id.value]
+    return codec.decode(body) if codec else {}
+
+
+def encode_body(cmd_id: CmdID, values: dict) -> bytes:
+    """Returns the body for the named field values of a command."""
+    codec = CODECS[cmd_id.value]
+    if codec is None:
+        return bytes(DATA_SIZE)
+    return codec.encode(values)
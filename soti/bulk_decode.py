@@ -0,0 +1,165 @@
+"""
+Decodes recorded messages in bulk with NumPy, for analysing long sessions.
+
+Requires NumPy (`pip install numpy`). Nothing here loops over messages in
+Python: buffers are viewed as structured arrays and bodies are reinterpreted
+in place, so decoding millions of messages takes milliseconds.
+
+Example:
+with BinaryLogReader(path) as log:
+    records = decode_records(log.raw())
+    reports = telemetry_reports(records)
+    print(reports["time_ns"], reports["telemetry_key"], reports["telemetry"])
+"""
+
+import numpy as np
+from utils.constants import MSG_SIZE, DATA_SIZE, BODY_SCHEMA, CmdID
+from frame_ring import RECORD
+from body_codec import field_size
+
+# The layout of a message produced by Message.serialize().
+FRAME_DTYPE = np.dtype([
+    ("priority", "u1"),
+    ("sender", "u1"),
+    ("recipient", "u1"),
+    ("cmd_id", "u1"),
+    ("body", "u1", (DATA_SIZE,)),
+])
+
+# The layout of frame_ring.RECORD, used by the ring buffer and binary logs.
+RECORD_DTYPE = np.dtype([
+    ("time_ns", "<i8"),
+    ("mono_ns", "<i8"),
+    ("source", "u1"),
+    ("port", "u1"),
+    ("msg", FRAME_DTYPE),
+])
+
+assert FRAME_DTYPE.itemsize == MSG_SIZE
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+# NumPy dtype of each BODY_SCHEMA field type.
+FIELD_DTYPES = {
+    "u8": "u1",
+    "u16": "<u2",
+    "u32": "<u4",
+    "i8": "i1",
+    "i16": "<i2",
+    "i32": "<i4",
+    "f32": "<f4",
+    "bool": "?",
+    "node": "u1",
+    "cmd": "u1",
+}
+
+
+def _field_dtype(field_type: str):
+    if field_type in FIELD_DTYPES:
+        return FIELD_DTYPES[field_type]
+    # hexN/binN fields are kept as raw bytes.
+    return ("u1", (field_size(field_type),))
+
+
+# Body layouts for per-command columns, as (name, dtype, offset in body),
+# generated from BODY_SCHEMA. Names use underscores so they are valid
+# Python identifiers.
+BODY_FIELDS = {
+    cmd_id: [(name.replace("-", "_"), _field_dtype(field_type), offset)
+             for name, field_type, offset in fields]
+    for cmd_id, fields in BODY_SCHEMA.items()
+}
+
+# where the message starts within each row of the two array layouts.
+_MSG_OFFSETS = {
+    FRAME_DTYPE: 0,
+    RECORD_DTYPE: RECORD_DTYPE.fields["msg"][1],
+}
+
+
+def decode_frames(buffer) -> np.ndarray:
+    """Views a buffer of back-to-back serialized messages as a FRAME_DTYPE array.
+
+    No data is copied. A trailing partial message is ignored.
+    """
+    count = len(buffer) // MSG_SIZE
+    return np.frombuffer(buffer, dtype=FRAME_DTYPE, count=count)
+
+
+def decode_records(buffer) -> np.ndarray:
+    """Views a buffer of packed records (e.g. BinaryLogReader.raw()) as a RECORD_DTYPE array."""
+    count = len(buffer) // RECORD.size
+    return np.frombuffer(buffer, dtype=RECORD_DTYPE, count=count)
+
+
+def headers(data: np.ndarray) -> np.ndarray:
+    """Returns the FRAME_DTYPE view of either array layout."""
+    return data["msg"] if data.dtype == RECORD_DTYPE else data
+
+
+def mask(data: np.ndarray, cmd_id: CmdID | None = None, sender=None, recipient=None) -> np.ndarray:
+    """Returns a boolean mask of the messages matching every given criterion."""
+    frames = headers(data)
+    selected = np.ones(len(frames), dtype=bool)
+    if cmd_id is not None:
+        selected &= frames["cmd_id"] == cmd_id.value
+    if sender is not None:
+        selected &= frames["sender"] == sender.value
+    if recipient is not None:
+        selected &= frames["recipient"] == recipient.value
+    return selected
+
+
+def columns(data: np.ndarray, cmd_id: CmdID, fields=None) -> np.ndarray:
+    """Returns the decoded body fields of every `cmd_id` message as a structured array.
+
+    The result also has the row's "index" in `data` and its "sender"; rows
+    from records carry their "time_ns" as well. `fields` defaults to the
+    command's layout in BODY_FIELDS.
+    """
+    if fields is None:
+        fields = BODY_FIELDS[cmd_id]
+
+    msg_offset = _MSG_OFFSETS[data.dtype]
+    index = np.flatnonzero(mask(data, cmd_id))
+    # copy the matching rows so they are contiguous, then reinterpret each
+    # row through a dtype which names the body fields at their offsets.
+    rows = np.ascontiguousarray(data[index])
+
+    names, formats, offsets = ["sender"], ["u1"], [msg_offset + 1]
+    if data.dtype == RECORD_DTYPE:
+        names.append("time_ns")
+        formats.append("<i8")
+        offsets.append(0)
+    for name, dtype, offset in fields:
+        names.append(name)
+        formats.append(dtype)
+        offsets.append(msg_offset + 4 + offset)
+
+    body_view = rows.view(np.dtype({
+        "names": names,
+        "formats": formats,
+        "offsets": offsets,
+        "itemsize": data.dtype.itemsize,
+    }))
+
+    result_dtype = [("index", "<i8")] + [(name, body_view.dtype.fields[name][0]) for name in names]
+    result = np.empty(len(rows), dtype=result_dtype)
+    result["index"] = index
+    for name in names:
+        result[name] = body_view[name]
+    return result
+
+
+def telemetry_reports(data: np.ndarray) -> np.ndarray:
+    """Telemetry key, sequence number, packet number and payload of each telemetry report."""
+    return columns(data, CmdID.CDH_PROCESS_TELEMETRY_REPORT)
+
+
+def setpoints(data: np.ndarray) -> np.ndarray:
+    """Well ID and setpoint of each PLD_SET_SETPOINT message."""
+    return columns(data, CmdID.PLD_SET_SETPOINT)
+
+
+def runtime_errors(data: np.ndarray) -> np.ndarray:
+    """Error code, context code and debug data of each runtime error."""
+    return columns(data, CmdID.CDH_PROCESS_RUNTIME_ERROR)
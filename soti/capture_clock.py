@@ -0,0 +1,40 @@
+"""Timestamps for captured messages."""
+
+import time
+from utils.constants import FRAME_SIZE, BAUD_RATE
+
+# How long one frame takes on the wire: 10 bits per byte with 8N1 framing.
+FRAME_TIME_NS = FRAME_SIZE * 10 * 1_000_000_000 // BAUD_RATE
+
+
+class CaptureClock:
+    """Stamps messages with a monotonic time and the matching time since the epoch.
+
+    The epoch time is derived from the monotonic one using a single reference
+    pair taken when the clock is created, so timestamps never go backwards
+    and intervals aren't distorted if the wall clock is adjusted mid-session.
+    """
+
+    def __init__(self, baud_rate: int = BAUD_RATE):
+        self.frame_time_ns = FRAME_TIME_NS * BAUD_RATE // baud_rate
+        self.epoch_ref_ns = time.time_ns()
+        self.mono_ref_ns = time.monotonic_ns()
+
+    def to_epoch(self, mono_ns: int) -> int:
+        """Converts a time.monotonic_ns() reading to nanoseconds since the epoch."""
+        return self.epoch_ref_ns + (mono_ns - self.mono_ref_ns)
+
+    def stamp_chunk(self, count: int, read_ns: int, previous_read_ns: int) -> tuple[list[int], list[int]]:
+        """Spreads timestamps over `count` messages which arrived in one read.
+
+        The last message finished arriving by `read_ns`, and earlier ones
+        are placed one frame time apart before it, but never before the
+        previous read. Returns the (epoch, monotonic) time of each message.
+        """
+        step = self.frame_time_ns
+        if count > 1:
+            step = min(step, max(read_ns - previous_read_ns, 0) // count)
+
+        mono_ns = [read_ns - (count - 1 - i) * step for i in range(count)]
+        offset = self.epoch_ref_ns - self.mono_ref_ns
+        return [t + offset for t in mono_ns], mono_ns
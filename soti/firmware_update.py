@@ -0,0 +1,219 @@
+"""
+Uploads a binary image to a subsystem with COMM_UPDATE_START, COMM_UPDATE_LOAD and COMM_UPDATE_END.
+
+The image is split into 7-byte COMM_UPDATE_LOAD messages which are sent
+without waiting for each reply in turn: up to a window of them are in
+flight at once. The window grows while the chunks are acknowledged with
+CDH_PROCESS_RETURN and halves when one fails with
+CDH_PROCESS_COMMAND_ERROR or isn't answered in time.
+
+COMM_UPDATE_LOAD carries no offset, so the subsystem writes each chunk
+after the last one it accepted. After a failure the upload is restarted
+from the failed chunk with another COMM_UPDATE_START at its address, and
+the chunks which were in flight are sent again (go-back-N). If the node's
+return for each chunk echoes the start of it, like the simulated board's
+returns, `check_echo` compares the two, so a lost chunk is noticed as
+soon as the next chunk's return arrives in its place.
+"""
+
+import time
+from collections import deque
+from queue import Empty
+from utils.constants import CmdID, NodeID, COMM_INFO, DATA_SIZE, REPLY_TIMEOUT, UPDATE_WINDOW, POLL_INTERVAL
+from message import Message
+from body_codec import encode_body
+
+# Give up after this many failures in a row at the same chunk.
+MAX_RETRIES = 5
+# How often the progress line is redrawn.
+PROGRESS_INTERVAL = 0.25 # seconds
+
+_UPDATE_COMMANDS = {
+    cmd_id.value: cmd_id for cmd_id in (CmdID.COMM_UPDATE_START, CmdID.COMM_UPDATE_LOAD, CmdID.COMM_UPDATE_END)
+}
+
+
+class UpdateError(Exception):
+    pass
+
+
+class UpdateCancelled(UpdateError):
+    """The upload's stop_flag was set."""
+
+
+class FirmwareUpload:
+    """Streams an image to `node` through `send`, reading the node's replies from `replies`.
+
+    `send` takes a Message. `replies` is a queue of received
+    CDH_PROCESS_RETURN and CDH_PROCESS_COMMAND_ERROR messages; others in
+    it are ignored. Replies are expected in the order the commands were
+    sent, as the link is a single serial line. Setting `stop_flag`
+    cancels the upload.
+    """
+
+    def __init__(self, image: bytes, node: NodeID, send, replies, address: int = 0,
+                 sender: NodeID = NodeID.CDH, window: int = UPDATE_WINDOW,
+                 timeout: float = REPLY_TIMEOUT, check_echo: bool = False, progress=None, stop_flag=None):
+        if not image:
+            raise ValueError("The image is empty")
+        self.chunks = [image[i:i + DATA_SIZE] for i in range(0, len(image), DATA_SIZE)]
+        self.size = len(image)
+        self.node = node
+        self.address = address
+        self.sender = sender
+        self.max_window = window
+        self.window = float(min(window, 4))
+        self.timeout_ns = int(timeout * 1e9)
+        self.check_echo = check_echo
+        self.progress = progress
+        self.stop_flag = stop_flag
+
+        self._send = send
+        self._replies = replies
+
+        self.acked = 0          # chunks the node has accepted, in order
+        self.retransmits = 0    # chunks sent more than once
+        self.failures = 0       # errors and timeouts
+        self.start_ns = None
+
+        # (chunk index, send time) of each COMM_UPDATE_LOAD awaiting a reply.
+        self._in_flight = deque()
+        self._next = 0
+        # replies to loads sent before a restart are ignored until the restart is acknowledged.
+        self._restarting = False
+        self._restart_ns = 0
+        self._retries = 0
+        self._last_progress = 0.0
+
+    def _message(self, cmd_id: CmdID, values: dict | None = None) -> Message:
+        body = encode_body(cmd_id, values) if values else bytes()
+        return Message(COMM_INFO[cmd_id]["priority"], self.sender, self.node, cmd_id, body, source="user")
+
+    def _command(self, cmd_id: CmdID, values: dict | None = None):
+        """Sends a command and waits for its reply, failing the upload if it's refused."""
+        self._send(self._message(cmd_id, values))
+        deadline = time.monotonic_ns() + self.timeout_ns
+        while (remaining := deadline - time.monotonic_ns()) > 0:
+            reply = self._next_reply(remaining)
+            if reply is None:
+                break
+            command, ok, _ = reply
+            if command is cmd_id:
+                if not ok:
+                    raise UpdateError(f"{self.node.get_display_name()} refused {cmd_id.name}")
+                return
+        raise UpdateError(f"No reply to {cmd_id.name} from {self.node.get_display_name()}")
+
+    def _next_reply(self, timeout_ns: int) -> tuple[CmdID, bool, bytes] | None:
+        """Waits for the node's next reply.
+
+        Returns the command, whether it succeeded and the data returned, or
+        None on timeout. Raises UpdateCancelled if the stop flag is set.
+        """
+        deadline = time.monotonic_ns() + timeout_ns
+        while (remaining := deadline - time.monotonic_ns()) > 0:
+            if self.stop_flag is not None and self.stop_flag.is_set():
+                raise UpdateCancelled("Cancelled")
+            try:
+                # wake up now and then to check the stop flag.
+                msg = self._replies.get(timeout=min(remaining / 1e9, POLL_INTERVAL))
+            except Empty:
+                continue
+            if msg.sender is not self.node or msg.recipient is not self.sender:
+                continue
+            if msg.cmd_id is CmdID.CDH_PROCESS_RETURN:
+                command, ok, data = msg.body[0], True, msg.body[1:]
+            elif msg.cmd_id is CmdID.CDH_PROCESS_COMMAND_ERROR:
+                command, ok, data = msg.body[1], False, msg.body[2:]
+            else:
+                continue
+            if command in _UPDATE_COMMANDS:
+                return _UPDATE_COMMANDS[command], ok, data
+        return None
+
+    def _send_chunk(self, index: int):
+        self._send(self._message(CmdID.COMM_UPDATE_LOAD, {"data": self.chunks[index]}))
+        self._in_flight.append((index, time.monotonic_ns()))
+
+    def _fail(self):
+        """Shrinks the window and restarts the upload from the oldest unacknowledged chunk."""
+        self.failures += 1
+        self._retries += 1
+        if self._retries > MAX_RETRIES:
+            raise UpdateError(f"Chunk {self.acked} failed {MAX_RETRIES} times in a row")
+
+        self.window = max(self.window / 2, 1.0)
+        self.retransmits += self._next - self.acked
+        self._in_flight.clear()
+        self._next = self.acked
+        self._restarting = True
+        self._send(self._message(CmdID.COMM_UPDATE_START, {"address": self.address + self.acked * DATA_SIZE}))
+        self._restart_ns = time.monotonic_ns()
+
+    def run(self):
+        """Uploads the whole image. Raises UpdateError if the node stops accepting it."""
+        self.start_ns = time.monotonic_ns()
+        self._command(CmdID.COMM_UPDATE_START, {"address": self.address})
+
+        while self.acked < len(self.chunks):
+            if not self._restarting:
+                while self._next < len(self.chunks) and self._next - self.acked < int(self.window):
+                    self._send_chunk(self._next)
+                    self._next += 1
+
+            oldest_ns = self._restart_ns if self._restarting else self._in_flight[0][1]
+            reply = self._next_reply(oldest_ns + self.timeout_ns - time.monotonic_ns())
+            if reply is None:
+                self._fail()
+            else:
+                self._handle(*reply)
+            self._show_progress()
+
+        self._command(CmdID.COMM_UPDATE_END)
+        self._show_progress(final=True)
+
+    def _handle(self, command: CmdID, ok: bool, data: bytes):
+        if self._restarting:
+            if command is CmdID.COMM_UPDATE_START:
+                if not ok:
+                    raise UpdateError(f"{self.node.get_display_name()} refused to restart the upload")
+                self._restarting = False
+            return
+
+        if command is not CmdID.COMM_UPDATE_LOAD:
+            return
+        if not self._in_flight:
+            return
+        index, _ = self._in_flight[0]
+        chunk = self.chunks[index]
+        if not ok or (self.check_echo and data[:len(chunk)] != chunk[:len(data)]):
+            self._fail()
+            return
+
+        self._in_flight.popleft()
+        self.acked += 1
+        self._retries = 0
+        # additive increase: about one more chunk in flight per window acknowledged.
+        self.window = min(self.window + 1 / self.window, self.max_window)
+
+    @property
+    def elapsed(self) -> float:
+        return (time.monotonic_ns() - self.start_ns) / 1e9
+
+    def _show_progress(self, final: bool = False):
+        if self.progress is None:
+            return
+        now = time.monotonic()
+        if not final and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+
+        done = min(self.acked * DATA_SIZE, self.size)
+        rate = done / self.elapsed if self.elapsed else 0
+        self.progress(f"{done / self.size:6.1%}  {done:,}/{self.size:,} bytes  {rate / 1024:6.1f} KiB/s  "
+                      f"window {int(self.window):3}  {self.retransmits} retransmitted", final)
+
+
+def print_progress(line: str, final: bool):
+    """Redraws the progress on a single terminal line."""
+    print(f"\r{line}", end="\n" if final else "", flush=True)
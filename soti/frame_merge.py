@@ -0,0 +1,128 @@
+"""
+Merges the frame rings of several serial ports into one stream in capture order.
+
+Each port has its own reader process writing to its own FrameRing, so the
+readers never wait for each other, and the rings share the event which
+wakes the logger. FrameMerger reads them all like a single FrameRing, so
+the logger doesn't need to know how many ports there are.
+
+Each port's records arrive in order, but they reach its ring a little
+after they are captured, so a record from one port can arrive after later
+records from another. Records are held for REORDER_WINDOW after they are
+captured and then released in batches sorted by their monotonic capture
+time, which is the same clock in every process. Sorting appends each
+ring's run of records to the sorted records still being held, so Timsort
+merges the k runs in C rather than a heap doing it one record at a time in
+Python. A record which arrives after the window has passed is released as
+soon as it is taken, and counted as late.
+"""
+
+import bisect
+import multiprocessing
+import struct
+import time
+from operator import itemgetter
+from frame_ring import FrameRing, RECORD, DEFAULT_CAPACITY
+from pipeline_metrics import PipelineMetrics
+from utils.constants import REORDER_WINDOW
+
+# the monotonic capture time of each record (see frame_ring.RECORD).
+_RECORD_MONO = struct.Struct(f"<8xq{RECORD.size - 16}x")
+
+_mono = itemgetter(0)
+
+
+def port_rings(count: int, capacity: int = DEFAULT_CAPACITY) -> list[FrameRing]:
+    """Creates a ring for each of `count` ports, sharing the event which wakes their consumer."""
+    data_ready = multiprocessing.Event()
+    return [FrameRing(capacity, data_ready) for _ in range(count)]
+
+
+class FrameMerger:
+    """Reads the rings from port_rings(), returning their records in capture order.
+
+    Like a FrameRing, only a single process may read it. Messages written
+    to it, e.g. by the CLI, go to the first port's ring.
+    """
+
+    def __init__(self, rings: list[FrameRing], window: float = REORDER_WINDOW,
+                 metrics: PipelineMetrics | None = None):
+        self.rings = rings
+        self.window_ns = int(window * 1e9)
+        self.metrics = metrics
+        # (monotonic time, record) of the records being held, in order.
+        self._pending: list[tuple[int, bytes]] = []
+        # every record captured up to this time has been released.
+        self._released_ns = 0
+
+    @property
+    def capacity(self) -> int:
+        return sum(ring.capacity for ring in self.rings)
+
+    @property
+    def dropped(self) -> int:
+        return sum(ring.dropped for ring in self.rings)
+
+    def __len__(self) -> int:
+        return sum(len(ring) for ring in self.rings) + len(self._pending)
+
+    def write(self, frames: list[bytes], times_ns: list[int], monos_ns: list[int], source: int) -> int:
+        return self.rings[0].write(frames, times_ns, monos_ns, source, 0)
+
+    def _gather(self):
+        """Moves the records waiting in every ring to the sorted pending records."""
+        pending = self._pending
+        size = RECORD.size
+        added = False
+        for ring in self.rings:
+            batch = ring.take()
+            if batch:
+                monos = [mono_ns for (mono_ns,) in _RECORD_MONO.iter_unpack(batch)]
+                pending.extend(zip(monos, [batch[i:i + size] for i in range(0, len(batch), size)]))
+                added = True
+        if not added:
+            return
+        pending.sort(key=_mono)
+
+        # nothing at or before _released_ns was pending, so whatever is now arrived late.
+        late = bisect.bisect_right(pending, self._released_ns, key=_mono)
+        if late and self.metrics is not None:
+            self.metrics.add("frames_late", late)
+
+    def _release(self, until_ns: int) -> bytes:
+        """Takes the pending records captured up to `until_ns`."""
+        split = bisect.bisect_right(self._pending, until_ns, key=_mono)
+        self._released_ns = max(self._released_ns, until_ns)
+        if not split:
+            return b""
+        released = self._pending[:split]
+        del self._pending[:split]
+        return b"".join([record for _, record in released])
+
+    def read(self, timeout: float | None = None) -> bytes:
+        """Takes the records captured more than the reorder window ago, blocking for up to `timeout` seconds if there are none.
+
+        Returns the packed records in capture order; decode them with
+        frame_ring.iter_records().
+        """
+        deadline = None if timeout is None else time.monotonic_ns() + int(timeout * 1e9)
+        while True:
+            self._gather()
+            now = time.monotonic_ns()
+            batch = self._release(now - self.window_ns)
+            if batch:
+                return batch
+
+            # wait for new records, or for the oldest pending one to leave the window.
+            wait_ns = self._pending[0][0] + self.window_ns - now if self._pending else None
+            if deadline is not None:
+                if now >= deadline:
+                    return b""
+                wait_ns = deadline - now if wait_ns is None else min(wait_ns, deadline - now)
+            # the rings share one event, so waiting on the first waits on them all.
+            self.rings[0].wait(None if wait_ns is None else max(wait_ns, 0) / 1e9)
+
+    def take(self) -> bytes:
+        """Takes every waiting and pending record without blocking, e.g. once capture has stopped."""
+        self._gather()
+        return self._release(self._pending[-1][0] if self._pending else 0)
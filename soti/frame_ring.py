@@ -0,0 +1,158 @@
+"""A shared-memory ring buffer which carries raw messages between processes."""
+
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+from utils.constants import MSG_SIZE
+
+# Each record is the capture time in nanoseconds since the epoch, the same
+# time as a time.monotonic_ns() reading, the index of the message source in
+# MESSAGE_SOURCES, the index of the port it was read from among the
+# session's ports and the serialized message. Binary session logs use the
+# same layout (see binary_log.py).
+RECORD = struct.Struct(f"<qqBB{MSG_SIZE}s")
+
+# The cursors count records, not bytes, and only ever increase. They are kept
+# on separate cache lines because different processes write them.
+_CURSOR = struct.Struct("<Q")
+_HEAD_OFFSET = 0    # next record to be written, owned by the producers
+_TAIL_OFFSET = 64   # next record to be read, owned by the consumer
+_DROPPED_OFFSET = 128  # records discarded because the ring was full
+_DATA_OFFSET = 192
+
+# Enough for over a minute of a saturated 115200 baud link.
+DEFAULT_CAPACITY = 2**16
+
+
+def iter_records(batch: bytes):
+    """Iterates over (time_ns, mono_ns, source, port, msg_bytes) tuples in a batch from FrameRing.read()."""
+    return RECORD.iter_unpack(batch)
+
+
+class FrameRing:
+    """Fixed-size records in shared memory with batched producer and consumer cursors.
+
+    Any number of producers may write (they take a lock for each batch) but
+    only a single process may read. Records are copied straight into shared
+    memory, so nothing is pickled or sent through a pipe; the only system
+    call per batch is the event which wakes the consumer.
+
+    Rings which are read by the same consumer can share their `data_ready`
+    event, so it can wait for all of them at once (see frame_merge.py).
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, data_ready=None):
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(create=True, size=_DATA_OFFSET + capacity * RECORD.size)
+        self._write_lock = multiprocessing.Lock()
+        self._data_ready = multiprocessing.Event() if data_ready is None else data_ready
+
+    def __getstate__(self):
+        # only the name of the memory block is sent to child processes.
+        return (self.capacity, self._shm.name, self._write_lock, self._data_ready)
+
+    def __setstate__(self, state):
+        self.capacity, name, self._write_lock, self._data_ready = state
+        self._shm = shared_memory.SharedMemory(name=name)
+
+    def _get(self, offset: int) -> int:
+        return _CURSOR.unpack_from(self._shm.buf, offset)[0]
+
+    def _set(self, offset: int, value: int):
+        _CURSOR.pack_into(self._shm.buf, offset, value)
+
+    @property
+    def dropped(self) -> int:
+        """The number of records discarded because the consumer fell behind."""
+        return self._get(_DROPPED_OFFSET)
+
+    def __len__(self) -> int:
+        """The number of records waiting to be read."""
+        return self._get(_HEAD_OFFSET) - self._get(_TAIL_OFFSET)
+
+    def write(self, frames: list[bytes], times_ns: list[int], monos_ns: list[int], source: int,
+              port: int = 0) -> int:
+        """Appends a batch of messages and wakes the consumer.
+
+        Messages which do not fit are dropped rather than blocking the
+        producer. Returns the number of messages written.
+        """
+        with self._write_lock:
+            head = self._get(_HEAD_OFFSET)
+            free = self.capacity - (head - self._get(_TAIL_OFFSET))
+            count = min(len(frames), free)
+
+            if count < len(frames):
+                self._set(_DROPPED_OFFSET, self.dropped + len(frames) - count)
+            if count == 0:
+                return 0
+
+            data = b"".join(
+                RECORD.pack(times_ns[i], monos_ns[i], source, port, frames[i]) for i in range(count)
+            )
+            self._copy_in(head, data)
+
+            # publish the whole batch at once, after its records are in place.
+            self._set(_HEAD_OFFSET, head + count)
+
+        self._data_ready.set()
+        return count
+
+    def read(self, timeout: float | None = None) -> bytes:
+        """Takes every waiting record, blocking for up to `timeout` seconds if there are none.
+
+        Returns the packed records; decode them with iter_records().
+        """
+        if not self.wait(timeout):
+            return b""
+        return self.take()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Blocks until a batch has been written since the last wait, for up to `timeout` seconds.
+
+        Returns False if none was.
+        """
+        if not self._data_ready.wait(timeout):
+            return False
+        # clear before reading the cursor so a batch published from now on
+        # sets the event again and isn't missed.
+        self._data_ready.clear()
+        return True
+
+    def take(self) -> bytes:
+        """Takes every waiting record without blocking."""
+        tail = self._get(_TAIL_OFFSET)
+        count = self._get(_HEAD_OFFSET) - tail
+        if count == 0:
+            return b""
+
+        data = self._copy_out(tail, count)
+        self._set(_TAIL_OFFSET, tail + count)
+        return data
+
+    def _copy_in(self, index: int, data: bytes):
+        start = index % self.capacity
+        first = min(len(data), (self.capacity - start) * RECORD.size)
+        offset = _DATA_OFFSET + start * RECORD.size
+        view = memoryview(data)
+        self._shm.buf[offset:offset + first] = view[:first]
+        if first < len(data):
+            # wrap around to the start of the ring.
+            self._shm.buf[_DATA_OFFSET:_DATA_OFFSET + len(data) - first] = view[first:]
+
+    def _copy_out(self, index: int, count: int) -> bytes:
+        start = index % self.capacity
+        first = min(count, self.capacity - start)
+        offset = _DATA_OFFSET + start * RECORD.size
+        data = bytes(self._shm.buf[offset:offset + first * RECORD.size])
+        if first < count:
+            data += bytes(self._shm.buf[_DATA_OFFSET:_DATA_OFFSET + (count - first) * RECORD.size])
+        return data
+
+    def close(self):
+        """Detaches this process from the shared memory."""
+        self._shm.close()
+
+    def unlink(self):
+        """Frees the shared memory. Call once, from the process which created the ring."""
+        self._shm.unlink()
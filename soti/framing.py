@@ -0,0 +1,66 @@
+"""Splits the serial byte stream from the SOTI board into checked messages."""
+
+from binascii import crc_hqx
+from utils.constants import SYNC_MARKER, CRC_INIT, MSG_SIZE, FRAME_SIZE
+
+_MSG_START = len(SYNC_MARKER)
+_MSG_END = _MSG_START + MSG_SIZE
+
+
+def encode_frame(msg_bytes: bytes) -> bytes:
+    """Wraps serialized message bytes in a sync marker and checksum."""
+    return SYNC_MARKER + msg_bytes + crc_hqx(msg_bytes, CRC_INIT).to_bytes(2, byteorder="big")
+
+
+class StreamFramer:
+    """Finds frames in a rolling buffer and resynchronizes after corruption.
+
+    Each frame is a sync marker, the 11 message bytes, and a big-endian
+    CRC-16/CCITT-FALSE of the message bytes. Because the checksum is sent
+    MSB first, running the CRC over the message and checksum together
+    leaves a remainder of zero for an intact frame.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # number of frames which passed the checksum.
+        self.accepted = 0
+        # number of candidate frames which failed the checksum.
+        self.rejected = 0
+        # number of bytes thrown away while searching for a sync marker.
+        self.skipped_bytes = 0
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Adds newly read bytes and returns the messages completed by them."""
+        buf = self._buffer
+        buf += data
+
+        messages = []
+        pos = 0
+        last_start = len(buf) - FRAME_SIZE
+
+        while pos <= last_start:
+            if not buf.startswith(SYNC_MARKER, pos):
+                sync = buf.find(SYNC_MARKER, pos)
+                if sync < 0:
+                    # keep the final byte, it may be the start of a marker.
+                    self.skipped_bytes += len(buf) - 1 - pos
+                    pos = len(buf) - 1
+                    break
+                self.skipped_bytes += sync - pos
+                pos = sync
+                if pos > last_start:
+                    break
+
+            if crc_hqx(buf[pos + _MSG_START:pos + FRAME_SIZE], CRC_INIT) == 0:
+                messages.append(bytes(buf[pos + _MSG_START:pos + _MSG_END]))
+                pos += FRAME_SIZE
+            else:
+                # not a real frame boundary; search again from the next byte.
+                self.rejected += 1
+                self.skipped_bytes += 1
+                pos += 1
+
+        del buf[:pos]
+        self.accepted += len(messages)
+        return messages
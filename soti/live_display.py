@@ -0,0 +1,180 @@
+"""
+Shows live traffic without printing every message.
+
+The logger counts messages in a TrafficStats and publishes a snapshot of
+it a few times a second. `dashboard` in the CLI redraws the counters,
+rates and most recent messages in a curses screen, and `verbose on` goes
+back to printing every message as it arrives. With `summary on`, or
+--headless, a one-line summary is printed every SUMMARY_INTERVAL while
+there is traffic; it is off by default, as the logger prints it without
+regard for what is being typed at the prompt.
+"""
+
+import multiprocessing
+import time
+from collections import deque
+from queue import Empty, Full
+from utils.constants import DISPLAY_FPS, DISPLAY_RECENT, DISPLAY_RATE_WINDOW
+from message import Message
+
+try:
+    import curses
+except ImportError: # not available on Windows
+    curses = None
+
+
+class DisplayControl:
+    """How the CLI wants traffic shown, shared with the serial reader and logger processes."""
+
+    def __init__(self):
+        # print every message as it is read and logged.
+        self.verbose = multiprocessing.Event()
+        # the dashboard owns the terminal, so nothing else may print.
+        self.dashboard = multiprocessing.Event()
+        # print a one-line summary of the traffic every SUMMARY_INTERVAL.
+        self.summary = multiprocessing.Event()
+        # the latest snapshots from the logger. Full means nobody is reading them.
+        self.snapshots = multiprocessing.Queue(maxsize=2)
+
+    @property
+    def can_print(self) -> bool:
+        return not self.dashboard.is_set()
+
+    def publish(self, snapshot: dict):
+        """Offers a snapshot to the dashboard, dropping it if the last ones haven't been taken."""
+        try:
+            self.snapshots.put_nowait(snapshot)
+        except Full:
+            pass
+
+    def latest(self) -> dict | None:
+        """The newest snapshot published, if any arrived since the last call."""
+        snapshot = None
+        while True:
+            try:
+                snapshot = self.snapshots.get_nowait()
+            except Empty:
+                return snapshot
+
+
+class TrafficStats:
+    """Counts messages per command and keeps the most recent ones.
+
+    add() is called for every message, so it only counts and keeps a
+    reference; rates and text are worked out when a snapshot is taken.
+    """
+
+    def __init__(self, recent: int = DISPLAY_RECENT, rate_window: float = DISPLAY_RATE_WINDOW):
+        self.total = 0
+        self.counts: dict[str, int] = {}
+        self.recent: deque[Message] = deque(maxlen=recent)
+        self.rate_window_ns = int(rate_window * 1e9)
+        self.start_ns = time.monotonic_ns()
+        # (time, total, counts) at earlier snapshots, to measure rates against.
+        self._history = deque()
+
+    def add(self, msg: Message):
+        name = msg.cmd_id.name
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.total += 1
+        self.recent.append(msg)
+
+    def snapshot(self, now_ns: int | None = None) -> dict:
+        """The counters, the rate of each over the last rate window, and the recent messages as text."""
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        self._history.append((now_ns, self.total, dict(self.counts)))
+        while len(self._history) > 1 and self._history[1][0] <= now_ns - self.rate_window_ns:
+            self._history.popleft()
+
+        then_ns, then_total, then_counts = self._history[0]
+        seconds = (now_ns - then_ns) / 1e9
+        if seconds <= 0:
+            then_total, then_counts, seconds = 0, {}, max((now_ns - self.start_ns) / 1e9, 1e-9)
+
+        return {
+            "uptime": (now_ns - self.start_ns) / 1e9,
+            "total": self.total,
+            "rate": (self.total - then_total) / seconds,
+            "commands": {
+                name: (count, (count - then_counts.get(name, 0)) / seconds)
+                for name, count in sorted(self.counts.items(), key=lambda item: -item[1])
+            },
+            "recent": [format_message(msg) for msg in self.recent],
+        }
+
+
+def format_message(msg: Message) -> str:
+    return (f"{msg.time} {msg.source:7} {msg.sender.name:>4} -> {msg.recipient.name:4} "
+            f"{msg.cmd_id.name:32} 0x{msg.body.hex()}")
+
+
+def summary_line(snapshot: dict, top: int = 3) -> str:
+    """One line with the total, the overall rate and the busiest commands."""
+    busiest = ", ".join(f"{name} {rate:.1f}/s" for name, (_, rate) in list(snapshot["commands"].items())[:top])
+    return f"[{snapshot['total']:,} messages, {snapshot['rate']:.1f}/s: {busiest}]"
+
+
+class SummaryPrinter:
+    """Prints a summary line every `interval` seconds, but only when messages arrived in between."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._last_print = time.monotonic()
+        self._last_total = 0
+
+    def update(self, snapshot: dict):
+        now = time.monotonic()
+        if now - self._last_print < self.interval or snapshot["total"] == self._last_total:
+            return
+        self._last_print = now
+        self._last_total = snapshot["total"]
+        print(summary_line(snapshot))
+
+
+def run_dashboard(control: DisplayControl, fps: float = DISPLAY_FPS):
+    """Takes over the terminal with a live view of the traffic until 'q' is pressed."""
+    if curses is None:
+        raise RuntimeError("The dashboard needs the curses module, which isn't available on this system")
+
+    control.dashboard.set()
+    try:
+        curses.wrapper(_dashboard, control, fps)
+    finally:
+        control.dashboard.clear()
+
+
+def _dashboard(screen, control: DisplayControl, fps: float):
+    curses.curs_set(0)
+    screen.nodelay(True)
+    snapshot = None
+
+    while screen.getch() not in (ord("q"), ord("Q")):
+        snapshot = control.latest() or snapshot
+        screen.erase()
+        height, width = screen.getmaxyx()
+
+        def line(y, text, attr=curses.A_NORMAL):
+            if y < height:
+                screen.addnstr(y, 0, text, width - 1, attr)
+
+        line(0, "SOTI live traffic - press q to return to the CLI", curses.A_REVERSE)
+        if snapshot is None:
+            line(2, "Waiting for messages...")
+        else:
+            line(1, f"{snapshot['total']:,} messages in {snapshot['uptime']:.0f} s, "
+                    f"{snapshot['rate']:.1f} messages/s")
+            line(3, f"{'Command':32} {'count':>10} {'per s':>8}", curses.A_BOLD)
+            y = 4
+            for name, (count, rate) in snapshot["commands"].items():
+                line(y, f"{name:32} {count:10,} {rate:8.1f}")
+                y += 1
+
+            y += 1
+            line(y, "Recent messages", curses.A_BOLD)
+            rows = max(height - y - 1, 0)
+            recent = snapshot["recent"][-rows:] if rows else []
+            for y, text in enumerate(recent, y + 1):
+                line(y, text)
+
+        screen.refresh()
+        time.sleep(1 / fps)
@@ -0,0 +1,196 @@
+"""
+Segments of long session logs: their manifest, compression and reading.
+
+A session is logged in numbered segments, e.g.
+2026-10-18_122931.0001.bin, 2026-10-18_122931.0002.bin, ..., and a
+manifest, 2026-10-18_122931.manifest.json, lists them in order with their
+format, times and size. The segment being written is a plain log; finished
+segments are compressed in the background to .gz or .xz files.
+
+To read a whole session, open its manifest: read_recording() in replay.py
+streams the messages of every segment in order.
+"""
+
+import datetime
+import gzip
+import json
+import lzma
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+# compression -> (file suffix, function opening a file with it, options when compressing)
+COMPRESSIONS = {
+    "gzip": (".gz", gzip.open, {"compresslevel": 6}), # 9 is much slower for a few % smaller files
+    "lzma": (".xz", lzma.open, {}),
+}
+_OPENERS = {suffix: opener for suffix, opener, _ in COMPRESSIONS.values()}
+
+# file suffix of each log format.
+FORMAT_SUFFIXES = {"yaml": ".log", "binary": ".bin"}
+
+
+def open_log_file(path: Path, mode: str = "rb"):
+    """Opens a log file, decompressing it if it is a .gz or .xz file."""
+    path = Path(path)
+    opener = _OPENERS.get(path.suffix, open)
+    return opener(path, mode, encoding="utf_8" if "t" in mode else None)
+
+
+def is_compressed(path: Path) -> bool:
+    return Path(path).suffix in _OPENERS
+
+
+def uncompressed_name(path: Path) -> str:
+    """The name of a log file without its compression suffix, e.g. x.0001.bin for x.0001.bin.gz."""
+    path = Path(path)
+    return path.stem if is_compressed(path) else path.name
+
+
+def is_manifest(path: Path) -> bool:
+    return Path(path).name.endswith(MANIFEST_SUFFIX)
+
+
+def compress_file(path: Path, compression: str) -> Path:
+    """Compresses a file next to itself and deletes the original. Returns the compressed file's path."""
+    suffix, opener, options = COMPRESSIONS[compression]
+    compressed_path = path.with_name(path.name + suffix)
+    partial_path = compressed_path.with_name(compressed_path.name + ".part")
+
+    with open(path, 'rb') as source, opener(partial_path, 'wb', **options) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    # the compressed file only appears once it is complete.
+    os.replace(partial_path, compressed_path)
+    path.unlink()
+    return compressed_path
+
+
+class SessionManifest:
+    """The list of a session's segments, saved as JSON whenever it changes.
+
+    It is updated by the logger and its compression thread, so each change
+    holds a lock, and the file is replaced atomically so readers never see
+    half of it.
+    """
+
+    def __init__(self, path: Path, start_time: datetime.datetime, port):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.data = {
+            "session": self.path.name.removesuffix(MANIFEST_SUFFIX),
+            "port": str(port),
+            "start": start_time.isoformat(),
+            "end": None,
+            "deleted-segments": 0,
+            "segments": [],
+        }
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = self.path.with_name(self.path.name + ".part")
+        partial_path.write_text(json.dumps(self.data, indent=2) + "\n")
+        os.replace(partial_path, self.path)
+
+    def _segment(self, name: str) -> dict:
+        return next(segment for segment in self.data["segments"] if segment["file"] == name)
+
+    def add(self, path: Path, log_format: str, start_time: datetime.datetime):
+        with self._lock:
+            self.data["segments"].append({
+                "file": path.name,
+                "format": log_format,
+                "start": start_time.isoformat(),
+                "end": None,
+                "size": 0,
+                "compressed": False,
+            })
+            self._save()
+
+    def finish(self, path: Path, end_time: datetime.datetime):
+        with self._lock:
+            segment = self._segment(path.name)
+            segment["end"] = end_time.isoformat()
+            segment["size"] = path.stat().st_size
+            self._save()
+
+    def compressed(self, path: Path, compressed_path: Path):
+        with self._lock:
+            segment = self._segment(path.name)
+            segment["file"] = compressed_path.name
+            segment["size"] = compressed_path.stat().st_size
+            segment["compressed"] = True
+            self._save()
+
+    def trim(self, retained_size: int):
+        """Deletes the oldest finished segments until the session takes up at most `retained_size` bytes."""
+        with self._lock:
+            segments = self.data["segments"]
+            total = sum(segment["size"] for segment in segments)
+            while total > retained_size and segments and segments[0]["end"] is not None:
+                segment = segments.pop(0)
+                total -= segment["size"]
+                (self.path.parent / segment["file"]).unlink(missing_ok=True)
+                self.data["deleted-segments"] += 1
+            self._save()
+
+    def close(self, end_time: datetime.datetime):
+        with self._lock:
+            self.data["end"] = end_time.isoformat()
+            self._save()
+
+
+class SegmentCompressor:
+    """Compresses finished segments in a background thread, so logging never waits for it.
+
+    With a `retained_size`, the session's oldest segments are deleted after
+    each one is compressed to keep it within that size.
+    """
+
+    def __init__(self, manifest: SessionManifest, compression: str | None, retained_size: int | None = None):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}'. Use one of {', '.join(COMPRESSIONS)} or None")
+        self.manifest = manifest
+        self.compression = compression
+        self.retained_size = retained_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, path: Path):
+        self._queue.put(path)
+
+    def _run(self):
+        while (path := self._queue.get()) is not None:
+            if not path.exists():
+                continue # already deleted to keep the session within its retained size
+            try:
+                if self.compression:
+                    self.manifest.compressed(path, compress_file(path, self.compression))
+                if self.retained_size is not None:
+                    self.manifest.trim(self.retained_size)
+            except OSError as e:
+                print(f"Couldn't compress '{path}': {e}")
+
+    def close(self):
+        """Waits for the segments already submitted."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def read_manifest(path: Path) -> dict:
+    return json.loads(Path(path).read_text())
+
+
+def manifest_segments(path: Path) -> list[Path]:
+    """The segments of a session which still exist, in order, in its binary format if it was logged in both."""
+    manifest = read_manifest(path)
+    formats = {segment["format"] for segment in manifest["segments"]}
+    log_format = "binary" if "binary" in formats else "yaml"
+    return [
+        path.parent / segment["file"] for segment in manifest["segments"]
+        if segment["format"] == log_format and (path.parent / segment["file"]).exists()
+    ]
@@ -1,60 +1,155 @@
+import time
 from datetime import datetime
-from dataclasses import dataclass, field
-from utils.constants import DATA_SIZE, CmdID, NodeID
-from session_logger import parse_msg_body
+from utils.constants import MSG_SIZE, DATA_SIZE, CmdID, NodeID
+from body_codec import decode_body
+
+# Lookup tables from ID values to enum members, cheaper than calling the enums.
+_NODE_IDS = {node_id.value: node_id for node_id in NodeID}
+_CMD_IDS = {cmd_id.value: cmd_id for cmd_id in CmdID}
+
 
-@dataclass
 class Message:
-    # serial parameters
-    priority: int
-    sender: NodeID
-    recipient: NodeID
-    cmd_id: CmdID
-    body: bytes = field(default_factory=([0] * 7))
-    # additional parameters
-    source: str = field(default="unspecified")
-    time: datetime = field(default_factory=
-        lambda: datetime.now().strftime("%T")
-    )
-
-    def __post_init__(self):
-        # Ensure the data field is the correct length.
-        data = bytearray(self.body)
-        if len(data) > DATA_SIZE:
-            self.body = bytes(data[:DATA_SIZE])  # Truncate to the specified length
-        elif len(data) < DATA_SIZE:
-            self.body = bytes(data + bytearray(DATA_SIZE - len(data)))  # Extend with zeroes
+    """A CAN message, stored as its 11 serialized bytes.
+
+    The IDs, body fields and time are only decoded when they are read, so
+    receiving a message doesn't pay for enum lookups or time formatting that
+    nothing may need. The formatted time and as_dict() are cached.
+    """
+
+    __slots__ = ("_raw", "_source", "_time_ns", "mono_ns", "_time", "_dict")
+
+    def __init__(self, priority: int, sender: NodeID, recipient: NodeID, cmd_id: CmdID,
+                 body: bytes = bytes(DATA_SIZE), source: str = "unspecified",
+                 time_ns: int | None = None, mono_ns: int | None = None):
+        # Ensure the data field is the correct length (truncate or extend with zeroes).
+        body = bytes(body[:DATA_SIZE]).ljust(DATA_SIZE, b"\0")
+        self._raw = bytes((priority, sender.value, recipient.value, cmd_id.value)) + body
+        self._source = source
+        self._time_ns = time.time_ns() if time_ns is None else time_ns
+        # time.monotonic_ns() at the same moment, for measuring intervals.
+        self.mono_ns = time.monotonic_ns() if mono_ns is None else mono_ns
+        self._time = None
+        self._dict = None
 
     @classmethod
-    def deserialize(cls, msg_bytes: bytes) -> "Message":
-        """Create a message from serialized bytes."""
-        priority = msg_bytes[0]
-        sender = NodeID(msg_bytes[1])
-        recipient = NodeID(msg_bytes[2])
-        cmd_id = CmdID(msg_bytes[3])
-        body = msg_bytes[4:]
+    def deserialize(cls, msg_bytes: bytes, source: str = "unspecified",
+                    time_ns: int | None = None, mono_ns: int | None = None) -> "Message":
+        """Create a message from serialized bytes.
+
+        Raises ValueError if the bytes don't hold a known sender, recipient
+        and command, but doesn't decode them yet.
+        """
+        if len(msg_bytes) != MSG_SIZE:
+            raise ValueError(f"A message is {MSG_SIZE} bytes, not {len(msg_bytes)}")
+        if msg_bytes[1] not in _NODE_IDS:
+            raise ValueError(f"{msg_bytes[1]} is not a valid NodeID")
+        if msg_bytes[2] not in _NODE_IDS:
+            raise ValueError(f"{msg_bytes[2]} is not a valid NodeID")
+        if msg_bytes[3] not in _CMD_IDS:
+            raise ValueError(f"{msg_bytes[3]} is not a valid CmdID")
 
-        return cls(priority, sender, recipient, cmd_id, body)
+        msg = cls.__new__(cls)
+        msg._raw = bytes(msg_bytes)
+        msg._source = source
+        msg._time_ns = time.time_ns() if time_ns is None else time_ns
+        msg.mono_ns = time.monotonic_ns() if mono_ns is None else mono_ns
+        msg._time = None
+        msg._dict = None
+        return msg
 
     def serialize(self) -> bytes:
         """Return the serialized bytes of the message."""
-        return bytes(bytearray([
-            self.priority,
-            self.sender.value,
-            self.recipient.value,
-            self.cmd_id.value])
-            + self.body
-        )
+        return self._raw
+
+    def __reduce__(self):
+        return (_unpickle, (self._raw, self._source, self._time_ns, self.mono_ns, self._time))
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self._raw == other._raw and self._source == other._source
+
+    def __hash__(self):
+        return hash((self._raw, self._source))
+
+    def __repr__(self):
+        return (f"Message(priority={self.priority}, sender={self.sender}, recipient={self.recipient}, "
+                f"cmd_id={self.cmd_id}, body={self.body!r}, source={self._source!r}, time={self.time!r})")
+
+    @property
+    def priority(self) -> int:
+        return self._raw[0]
+
+    @property
+    def sender(self) -> NodeID:
+        return _NODE_IDS[self._raw[1]]
 
+    @property
+    def recipient(self) -> NodeID:
+        return _NODE_IDS[self._raw[2]]
+
+    @property
+    def cmd_id(self) -> CmdID:
+        return _CMD_IDS[self._raw[3]]
+
+    @property
+    def body(self) -> bytes:
+        return self._raw[4:]
+
+    @property
+    def source(self) -> str:
+        return self._source
+
+    @source.setter
+    def source(self, value: str):
+        self._source = value
+        self._dict = None
+
+    @property
+    def time_ns(self) -> int:
+        """The time the message was captured (or created) in nanoseconds since the epoch."""
+        return self._time_ns
+
+    @time_ns.setter
+    def time_ns(self, value: int):
+        self._time_ns = value
+        self._time = None
+        self._dict = None
+
+    @property
+    def time(self) -> str:
+        """The time the message was captured (or created), formatted for display."""
+        if self._time is None:
+            self._time = format_time_ns(self._time_ns)
+        return self._time
+
+    @time.setter
+    def time(self, value: str):
+        self._time = value
+        self._dict = None
 
     def as_dict(self) -> dict:
-        """Return the message parameters as a dictionary."""
-        return {
-            "time": self.time,
-            "source": self.source,
-            "priority": self.priority,
-            "sender-id": self.sender,
-            "recipient-id": self.recipient,
-            "cmd": self.cmd_id,
-            "body": parse_msg_body(self.cmd_id, self.body)
-        }
\ No newline at end of file
+        """Return the message parameters as a dictionary. The result is cached; don't modify it."""
+        if self._dict is None:
+            self._dict = {
+                "time": self.time,
+                "source": self._source,
+                "priority": self.priority,
+                "sender-id": self.sender,
+                "recipient-id": self.recipient,
+                "cmd": self.cmd_id,
+                "body": decode_body(self.cmd_id, self.body)
+            }
+        return self._dict
+
+
+def format_time_ns(time_ns: int) -> str:
+    """Formats nanoseconds since the epoch as a local time of day, to the microsecond."""
+    seconds, ns = divmod(time_ns, 1_000_000_000)
+    return f"{datetime.fromtimestamp(seconds).strftime('%T')}.{ns // 1000:06d}"
+
+
+def _unpickle(raw: bytes, source: str, time_ns: int, mono_ns: int, formatted_time: str | None) -> Message:
+    msg = Message.deserialize(raw, source, time_ns, mono_ns)
+    msg._time = formatted_time
+    return msg
@@ -0,0 +1,356 @@
+"""
+Filter expressions which select messages by their header and body fields.
+
+An expression compares fields with values and combines the comparisons
+with `and`, `or`, `not` and parentheses, e.g.
+
+    from=PLD and cmd~PLD_* and priority<10
+    cmd=CDH_PROCESS_RUNTIME_ERROR and error-code=7
+    not (cmd=CDH_PROCESS_HEARTBEAT or cmd=PWR_PROCESS_HEARTBEAT)
+
+The header fields are `from`, `to`, `cmd` and `priority`; any other name
+is a body field from BODY_SCHEMA, which only matches commands which have
+it. The operators are =, !=, <, <=, >, >= and ~, which matches node and
+command names against a glob pattern.
+
+Filters run on the 11 serialized bytes, before a message is decoded.
+Each part of an expression which only looks at one header byte is
+compiled into a 256-entry lookup table indexed by that byte, and the
+expression into a single Python function.
+"""
+
+import fnmatch
+import multiprocessing
+import operator
+import re
+import struct
+from utils.constants import CmdID, NodeID, DATA_SIZE, LOG_FILTER, DISPLAY_FILTER, MAX_FILTER_LENGTH
+from body_codec import CODECS, RAW_TYPE_RE, field_format, from_hex_str, from_bin_str
+from parser import parse_int
+
+_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|([\w-]+)\s*(<=|>=|!=|=|<|>|~)\s*([^\s()]+)|(\S+))')
+
+_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# header field name -> (byte in the message, enum of its values or None).
+_HEADER_FIELDS = {
+    "priority": (0, None),
+    "from": (1, NodeID),
+    "to": (2, NodeID),
+    "cmd": (3, CmdID),
+}
+_HEADER_ALIASES = {"sender": "from", "sender-id": "from", "recipient": "to", "recipient-id": "to", "cmd-id": "cmd"}
+
+_BODY_START = 4
+_ENUM_FIELD_TYPES = {"node": NodeID, "cmd": CmdID}
+
+
+class FilterError(Exception):
+    pass
+
+
+class _Node:
+    """A parsed expression. `header_bytes` holds the header bytes it depends on, or None if it reads the body.
+
+    A comparison's `term` is (field, operator, value), where the value of
+    a `~` is the set of matching node or command values.
+    """
+
+    def __init__(self, kind: str, children=(), evaluate=None, header_bytes=frozenset(), term=None):
+        self.kind = kind
+        self.children = children
+        self.evaluate = evaluate
+        self.header_bytes = header_bytes
+        self.term = term
+
+
+def _int_target(field: str, op: str, value: str, enum_type) -> int | frozenset:
+    """The value a field is compared with: a number, or the values of the names a `~` pattern matches."""
+    if op == "~":
+        if enum_type is None:
+            raise FilterError(f"'~' only matches node and command names, not '{field}'")
+        return frozenset(member.value for member in enum_type if fnmatch.fnmatchcase(member.name, value))
+
+    try:
+        return parse_int(value)
+    except ValueError as exc:
+        raise FilterError(f"Invalid value '{value}' for '{field}'") from exc
+
+
+def _value_matcher(op: str, target):
+    """Returns a function of a field's value for one comparison."""
+    if op == "~":
+        return target.__contains__
+    compare = _OPERATORS[op]
+    return lambda field_value: compare(field_value, target)
+
+
+def _header_term(field: str, op: str, value: str) -> _Node:
+    index, enum_type = _HEADER_FIELDS[field]
+    target = _int_target(field, op, value, enum_type)
+    matches = _value_matcher(op, target)
+    return _Node("term", evaluate=lambda m: matches(m[index]), header_bytes=frozenset((index,)),
+                 term=(field, op, target))
+
+
+def _body_term(field: str, op: str, value: str) -> _Node:
+    # command value -> (struct of the field, where it starts in the message)
+    layouts = {}
+    field_type = None
+    for cmd_value, codec in enumerate(CODECS):
+        if codec and field in codec.types:
+            field_type = codec.types[field]
+            layouts[cmd_value] = (struct.Struct("<" + field_format(field_type)), _BODY_START + codec.offsets[field])
+    if field_type is None:
+        raise FilterError(f"Unknown field '{field}'")
+
+    raw_match = RAW_TYPE_RE.match(field_type)
+    if raw_match:
+        if op not in ("=", "!="):
+            raise FilterError(f"'{field}' can only be compared with = or !=")
+        size = int(raw_match.group(2))
+        try:
+            target = from_hex_str(value, size) if field_type.startswith("hex") else from_bin_str(value, size)
+        except ValueError as exc:
+            raise FilterError(f"Invalid value '{value}' for '{field}'") from exc
+    elif field_type == "f32":
+        try:
+            target = float(value)
+        except ValueError as exc:
+            raise FilterError(f"Invalid value '{value}' for '{field}'") from exc
+        if op == "~":
+            raise FilterError(f"'~' only matches node and command names, not '{field}'")
+    elif field_type == "bool" and value.lower() in ("true", "false"):
+        target = _int_target(field, op, "1" if value.lower() == "true" else "0", None)
+    else:
+        target = _int_target(field, op, value, _ENUM_FIELD_TYPES.get(field_type))
+    matches = _value_matcher(op, target)
+
+    def evaluate(m):
+        layout = layouts.get(m[3])
+        if layout is None:
+            return False
+        field_struct, offset = layout
+        return matches(field_struct.unpack_from(m, offset)[0])
+
+    return _Node("term", evaluate=evaluate, header_bytes=None, term=(field, op, target))
+
+
+class _Parser:
+    """Recursive descent over: or_expr := and_expr ('or' and_expr)*, and_expr := unary ('and' unary)*."""
+
+    def __init__(self, expression: str):
+        self.tokens = []
+        for match in _TOKEN_RE.finditer(expression):
+            open_paren, close_paren, field, op, value, word = match.groups()
+            if open_paren or close_paren:
+                self.tokens.append(open_paren or close_paren)
+            elif field:
+                self.tokens.append((field.lower(), op, value))
+            elif word:
+                if word.lower() not in ("and", "or", "not"):
+                    raise FilterError(f"Expected a comparison such as cmd=CDH_PROCESS_HEARTBEAT, not '{word}'")
+                self.tokens.append(word.lower())
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self) -> _Node:
+        if not self.tokens:
+            raise FilterError("The filter is empty")
+        node = self.or_expr()
+        if self.peek() is not None:
+            raise FilterError(f"Unexpected '{self.peek()}'")
+        return node
+
+    def or_expr(self) -> _Node:
+        node = self.and_expr()
+        while self.peek() == "or":
+            self.take()
+            node = _combine("or", node, self.and_expr())
+        return node
+
+    def and_expr(self) -> _Node:
+        node = self.unary()
+        while self.peek() == "and":
+            self.take()
+            node = _combine("and", node, self.unary())
+        return node
+
+    def unary(self) -> _Node:
+        token = self.take()
+        if token == "not":
+            child = self.unary()
+            return _Node("not", (child,), lambda m: not child.evaluate(m), child.header_bytes)
+        if token == "(":
+            node = self.or_expr()
+            if self.take() != ")":
+                raise FilterError("Missing ')'")
+            return node
+        if isinstance(token, tuple):
+            field, op, value = token
+            field = _HEADER_ALIASES.get(field, field)
+            if field in _HEADER_FIELDS:
+                return _header_term(field, op, value)
+            return _body_term(field, op, value)
+        raise FilterError("Expected a comparison" + (f", not '{token}'" if token else " at the end"))
+
+
+def _combine(kind: str, left: _Node, right: _Node) -> _Node:
+    if kind == "and":
+        evaluate = lambda m: left.evaluate(m) and right.evaluate(m)
+    else:
+        evaluate = lambda m: left.evaluate(m) or right.evaluate(m)
+    if left.header_bytes is None or right.header_bytes is None:
+        header_bytes = None
+    else:
+        header_bytes = left.header_bytes | right.header_bytes
+    return _Node(kind, (left, right), evaluate, header_bytes)
+
+
+class _Compiler:
+    """Turns a parsed expression into the source of one function, with lookup tables for single-byte parts."""
+
+    def __init__(self):
+        self.namespace = {}
+
+    def _name(self, prefix: str, value) -> str:
+        name = f"{prefix}{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def compile(self, node: _Node) -> str:
+        if node.header_bytes is not None and len(node.header_bytes) == 1:
+            # evaluate the whole subtree once for every value of its byte.
+            index = next(iter(node.header_bytes))
+            message = bytearray(4 + DATA_SIZE)
+            table = bytearray(256)
+            for value in range(256):
+                message[index] = value
+                table[value] = bool(node.evaluate(message))
+            return f"{self._name('T', bytes(table))}[m[{index}]]"
+        if node.header_bytes is not None and not node.header_bytes:
+            return "True"
+
+        if node.kind == "and":
+            return f"({self.compile(node.children[0])} and {self.compile(node.children[1])})"
+        if node.kind == "or":
+            return f"({self.compile(node.children[0])} or {self.compile(node.children[1])})"
+        if node.kind == "not":
+            return f"(not {self.compile(node.children[0])})"
+        return f"{self._name('B', node.evaluate)}(m)"
+
+
+class MessageFilter:
+    """A compiled filter expression. Call it with serialized message bytes."""
+
+    def __init__(self, expression: str):
+        self.expression = expression.strip()
+        # the parsed expression, for anything which evaluates it another way (see session_index.py).
+        self.tree = _Parser(self.expression).parse()
+        compiler = _Compiler()
+        source = compiler.compile(self.tree)
+        self.source = f"lambda m: bool({source})"
+        self._predicate = eval(self.source, compiler.namespace)
+
+    def __call__(self, msg_bytes: bytes) -> bool:
+        return self._predicate(msg_bytes)
+
+    def filter(self, frames: list[bytes]) -> list[bytes]:
+        """The messages the filter matches, in order."""
+        predicate = self._predicate
+        return [msg_bytes for msg_bytes in frames if predicate(msg_bytes)]
+
+    def __reduce__(self):
+        # compiled functions can't be pickled, so child processes compile their own.
+        return (MessageFilter, (self.expression,))
+
+    def __repr__(self):
+        return f"MessageFilter({self.expression!r})"
+
+
+def compile_filter(expression: str | None) -> MessageFilter | None:
+    """Compiles an expression, or returns None (everything matches) for an empty one."""
+    if expression is None or not expression.strip():
+        return None
+    return MessageFilter(expression)
+
+
+class FilterSettings:
+    """The filter expression of each consumer of captured messages, shared between processes.
+
+    "log" selects what is logged and "display" what is shown live. The
+    serial reader keeps anything either wants. A version number is
+    published with every change, so each process only recompiles its
+    filters after one.
+    """
+
+    TARGETS = ("log", "display")
+
+    def __init__(self, log: str | None = LOG_FILTER, display: str | None = DISPLAY_FILTER):
+        self._lock = multiprocessing.Lock()
+        self._version = multiprocessing.Value("Q", 0, lock=False)
+        self._expressions = {
+            target: multiprocessing.Array("c", MAX_FILTER_LENGTH, lock=False) for target in self.TARGETS
+        }
+        self._compiled_version = None
+        self._compiled = {}
+        self._capture = None
+
+        self.set("log", log)
+        self.set("display", display)
+
+    def __getstate__(self):
+        return (self._lock, self._version, self._expressions)
+
+    def __setstate__(self, state):
+        self._lock, self._version, self._expressions = state
+        self._compiled_version = None
+        self._compiled = {}
+        self._capture = None
+
+    def get(self, target: str) -> str:
+        """The expression for `target`, or "" if it takes everything."""
+        return self._expressions[target].value.decode()
+
+    def set(self, target: str, expression: str | None):
+        """Changes the filter of `target`. Raises FilterError if the expression is invalid."""
+        compiled = compile_filter(expression)
+        encoded = compiled.expression.encode() if compiled else b""
+        if len(encoded) >= MAX_FILTER_LENGTH:
+            raise FilterError(f"Filters are limited to {MAX_FILTER_LENGTH - 1} characters")
+        with self._lock:
+            self._expressions[target].value = encoded
+            self._version.value += 1
+
+    def current(self) -> dict[str, MessageFilter | None]:
+        """The compiled filter of each target. None means everything matches."""
+        if self._version.value != self._compiled_version:
+            with self._lock:
+                self._compiled_version = self._version.value
+                expressions = {target: self.get(target) for target in self.TARGETS}
+
+            self._compiled = {target: compile_filter(expression) for target, expression in expressions.items()}
+            if all(self._compiled.values()):
+                self._capture = MessageFilter(" or ".join(f"({f.expression})" for f in self._compiled.values()))
+            else:
+                self._capture = None
+        return self._compiled
+
+    def capture(self) -> MessageFilter | None:
+        """The filter of messages any target wants, or None if one of them takes everything."""
+        self.current()
+        return self._capture
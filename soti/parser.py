@@ -3,7 +3,9 @@ The SOTI parser.
 """
 
 import re
+import struct
 from message import Message
+from body_codec import CODECS, NUMBER_FORMATS, RAW_TYPE_RE, field_format, field_size, from_hex_str, from_bin_str
 from utils.constants import (
     NodeID, CmdID, COMM_INFO, DATA_SIZE
 )
@@ -67,6 +69,32 @@ def get_implied_type(value: int) -> str:
             raise ValueError(f"{value} is out of range for unsigned 32-bit integer.")
 
 
+def encode_data_arg(value_str: str, data_type: str | None) -> bytes:
+    """Converts a data argument to bytes, using the implied type if none is given."""
+    if data_type is None:
+        data_type = get_implied_type(parse_int(value_str))
+
+    try:
+        size = field_size(data_type)
+    except ValueError as exc:
+        raise ArgumentException(f"Invalid type '{data_type}'") from exc
+
+    if RAW_TYPE_RE.match(data_type):
+        return from_hex_str(value_str, size) if data_type.startswith("hex") else from_bin_str(value_str, size)
+
+    if data_type == "f32":
+        value = float(value_str)
+    elif data_type == "bool" and value_str.lower() in ("true", "false"):
+        value = value_str.lower() == "true"
+    else:
+        value = parse_int(value_str)
+
+    try:
+        return struct.pack("<" + field_format(data_type), value)
+    except struct.error as exc:
+        raise ArgumentException(f"Integer overflow. '{value_str}' cannot be represented as {data_type}") from exc
+
+
 def parse_send(args: str, default_sender: NodeID) -> Message:
     """Parses arguments for the 'send' command.
 
@@ -76,6 +104,21 @@ def parse_send(args: str, default_sender: NodeID) -> Message:
     Function Arguments:
     args -- string containing the command arguments.
     default_sender -- the sender ID if none is specified in the command.
+
+    Data arguments take the type of the body field they land on if it is a
+    number, and otherwise their implied type. Hex and bin fields are only
+    read as hex or binary when set by name:
+
+    >>> parse_send("COMM_UPDATE_LOAD 5 to=PLD", NodeID.CDH).body.hex()
+    '05000000000000'
+    >>> parse_send("COMM_UPDATE_LOAD 01 02 03 to=PLD", NodeID.CDH).body.hex()
+    '01020300000000'
+    >>> parse_send("COMM_UPDATE_LOAD 0x01020304 to=PLD", NodeID.CDH).body.hex()
+    '04030201000000'
+    >>> parse_send("COMM_UPDATE_LOAD data=01020304 to=PLD", NodeID.CDH).body.hex()
+    '01020304000000'
+    >>> parse_send("PLD_SET_SETPOINT 2 37.5", NodeID.CDH).body.hex()
+    '02000016420000'
     """
     parts = args.split()
 
@@ -89,9 +132,17 @@ def parse_send(args: str, default_sender: NodeID) -> Message:
     sender_id: NodeID = default_sender
     recipient_id: NodeID | None = COMM_INFO[cmd_id]["dest"]
 
+    # the command's body layout, if it has one, supplies the type of data
+    # arguments given without one and allows fields to be set by name.
+    codec = CODECS[cmd_id.value]
+    field_types = {}
+    field_at_offset = {}
+    if codec:
+        field_types = codec.types
+        field_at_offset = {offset: name for name, offset in codec.offsets.items()}
+
     # represents the bytes that will be sent in the data section of the message
     data = bytearray()
-    data_index = 0
 
     for arg in parts[1:]:
         try:
@@ -112,47 +163,33 @@ def parse_send(args: str, default_sender: NodeID) -> Message:
                         recipient_id = NodeID(parse_int(value))
                     except ValueError as exc:
                         raise ArgumentException(f"Invalid node ID '{value}'") from exc
+                elif key in field_types:
+                    # write the field at its offset in the body.
+                    raw_bytes = encode_data_arg(value, field_types[key])
+                    offset = codec.offsets[key]
+                    if len(data) < offset + len(raw_bytes):
+                        data.extend(bytes(offset + len(raw_bytes) - len(data)))
+                    data[offset:offset + len(raw_bytes)] = raw_bytes
                 else:
                     raise ArgumentException(f"Unknown option '{key}'")
 
             # treat as data argument
-            elif data_index < DATA_SIZE:
-                data_type = None
-                data_size = 0
-                is_signed = False
-
+            else:
                 re_match = DATA_ARG_RE.match(arg)
                 if not re_match:
                     raise ArgumentException(f"Invalid syntax for data argument '{arg}'")
 
                 data_type = re_match.group(1)
-                value = parse_int(re_match.group(2))
-
-                if not data_type:
-                    data_type = get_implied_type(value)
-
-                if data_type in ["u8", "u16", "u32"]:
-                    is_signed = False
-                elif data_type in ["i8", "i16", "i32"]:
-                    is_signed = True
-
-                if data_type in ["u8", "i8"]:
-                    data_size = 1
-                elif data_type in ["u16", "i16"]:
-                    data_size = 2
-                elif data_type in ["u32", "i32"]:
-                    data_size = 4
-                else:
-                    raise ArgumentException(f"Invalid type '{data_type}'")
-
-                # Convert value to a bytes object.
-                try:
-                    raw_bytes = value.to_bytes(data_size, byteorder="little", signed=is_signed)
-                except OverflowError as exc:
-                    raise ArgumentException(f"Integer overflow. '{re_match.group(2)}' cannot be represented as {data_type}") from exc
+                # hex and bin fields are only read as such when set by name;
+                # given positionally, they're numbers of their implied type.
+                if not data_type and field_types.get(field_at_offset.get(len(data))) in NUMBER_FORMATS:
+                    data_type = field_types[field_at_offset[len(data)]]
 
                 # Add the bytes of data.
-                data.extend(raw_bytes)
+                data.extend(encode_data_arg(re_match.group(2), data_type))
+
+            if len(data) > DATA_SIZE:
+                raise ArgumentException(f"Too much data. A message body holds at most {DATA_SIZE} bytes")
 
         except ValueError as exc:
             raise ArgumentException(f"Invalid argument '{arg}': {exc}") from exc
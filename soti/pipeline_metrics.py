@@ -0,0 +1,257 @@
+"""
+Counters and latency histograms of the capture pipeline, shared between its processes.
+
+The serial readers and the logger each count what passes through them in
+shared memory which the CLI reads, so nothing is sent between processes
+to collect them. Each serial reader counts in its own block (see
+PipelineMetrics.writer()), which the logger shares with the first one, so
+every counter has one writer and updates need no lock. `stats` in the CLI
+prints them with their rates, and they are served in the Prometheus text
+format at
+http://127.0.0.1:METRICS_PORT/metrics for dashboards.
+
+Latencies are measured from when a chunk of frames is read from the
+port, to when its frames are in the frame ring ("ring"), taken from it
+by the logger ("dequeue") and handed to the log writers ("logged").
+"""
+
+import bisect
+import multiprocessing
+import struct
+import threading
+import time
+from utils.constants import METRICS_PORT
+from frame_ring import RECORD
+
+# name -> description
+COUNTERS = {
+    "bytes_read": "Bytes read from the serial port.",
+    "frames_read": "Complete frames read from the serial port.",
+    "frames_rejected": "Frames rejected for a bad CRC or length.",
+    "frames_filtered": "Frames dropped by the capture filter.",
+    "frames_sent": "Messages written to the serial port.",
+    "send_timeouts": "Messages which timed out being written to the serial port.",
+    "batches_logged": "Batches of records taken from the frame ring by the logger.",
+    "records_logged": "Records taken from the frame ring and written to the session logs by the logger.",
+    "decode_failures": "Records which couldn't be decoded into a message.",
+    "frames_late": "Frames from one port which reached the logger after later frames from another were logged.",
+}
+# stage -> description
+HISTOGRAMS = {
+    "ring": "From reading a frame to writing it to the frame ring.",
+    "dequeue": "From reading a frame to the logger taking it from the frame ring.",
+    "logged": "From reading a frame to it being handed to the log writers.",
+}
+# Bucket i counts latencies below 2**i microseconds; the last one counts the rest.
+BUCKETS = 32
+
+# the monotonic capture time of each record in a FrameRing batch (see frame_ring.RECORD).
+_RECORD_MONO = struct.Struct(f"<8xq{RECORD.size - 16}x")
+
+_HISTOGRAM_SIZE = BUCKETS + 2 # buckets, sum in microseconds, count
+
+# where each counter and histogram is in a writer's block.
+_COUNTER_OFFSETS = {name: i for i, name in enumerate(COUNTERS)}
+_HISTOGRAM_OFFSETS = {stage: len(COUNTERS) + i * _HISTOGRAM_SIZE for i, stage in enumerate(HISTOGRAMS)}
+_BLOCK_SIZE = len(COUNTERS) + len(HISTOGRAMS) * _HISTOGRAM_SIZE
+
+
+class PipelineMetrics:
+    """The counters and histograms, in shared memory which child processes are given access to.
+
+    There is a block of them for each of `writers` processes which count
+    the same things, such as the serial readers of several ports, and
+    snapshot() adds them up.
+    """
+
+    def __init__(self, writers: int = 1):
+        self._shared = multiprocessing.RawArray("Q", writers * _BLOCK_SIZE)
+        self.start_time = time.monotonic()
+        self._setup(0)
+
+    def _setup(self, block: int):
+        base = block * _BLOCK_SIZE
+        self._block = block
+        self._offsets = {name: base + offset for name, offset in _COUNTER_OFFSETS.items()}
+        self._histograms = {stage: base + offset for stage, offset in _HISTOGRAM_OFFSETS.items()}
+        self._values = self._view()
+
+    def _view(self) -> memoryview:
+        # indexing a memoryview is several times faster than indexing the ctypes array.
+        return memoryview(self._shared).cast("B").cast("Q")
+
+    def __getstate__(self):
+        return (self._shared, self.start_time, self._block)
+
+    def __setstate__(self, state):
+        self._shared, self.start_time, block = state
+        self._setup(block)
+
+    def writer(self, index: int) -> "PipelineMetrics":
+        """The same metrics, counting in the block of writer `index`."""
+        metrics = PipelineMetrics.__new__(PipelineMetrics)
+        metrics.__setstate__((self._shared, self.start_time, index))
+        return metrics
+
+    def add(self, counter: str, count: int = 1):
+        self._values[self._offsets[counter]] += count
+
+    def observe(self, stage: str, latency_ns: int, count: int = 1):
+        """Records `count` frames which took `latency_ns` to reach `stage`."""
+        latency_us = max(latency_ns, 0) // 1000
+        offset = self._histograms[stage]
+        values = self._values
+        values[offset + min(latency_us.bit_length(), BUCKETS - 1)] += count
+        values[offset + BUCKETS] += latency_us * count
+        values[offset + BUCKETS + 1] += count
+
+    def observe_batch(self, stage: str, batch: bytes, now_ns: int):
+        """Records the latency of every record in a FrameRing batch, measured from its capture time.
+
+        Rather than bucketing each record, the capture times are sorted
+        (they almost always are already) and each bucket's boundary is
+        found by bisection, so the cost is mostly per batch.
+        """
+        monos = sorted([mono_ns for (mono_ns,) in _RECORD_MONO.iter_unpack(batch)])
+        count = len(monos)
+        if not count:
+            return
+
+        offset = self._histograms[stage]
+        values = self._values
+        values[offset + BUCKETS] += max(now_ns * count - sum(monos), 0) // 1000
+        values[offset + BUCKETS + 1] += count
+
+        # the records with a latency below 2**i us were captured after now_ns - 2**i us.
+        counted = 0
+        for i in range(BUCKETS - 1):
+            below = count - bisect.bisect_right(monos, now_ns - 1000 * 2**i)
+            if below > counted:
+                values[offset + i] += below - counted
+                counted = below
+                if counted == count:
+                    return
+        values[offset + BUCKETS - 1] += count - counted
+
+    def snapshot(self) -> dict:
+        """A copy of every counter and histogram, with the time it was taken."""
+        # the sum of every writer's block.
+        blocks = self._values.tolist()
+        values = [sum(blocks[i::_BLOCK_SIZE]) for i in range(_BLOCK_SIZE)]
+        return {
+            "time": time.monotonic(),
+            "start_time": self.start_time,
+            "counters": {name: values[i] for name, i in _COUNTER_OFFSETS.items()},
+            "histograms": {
+                stage: {
+                    "buckets": values[offset:offset + BUCKETS],
+                    "sum_us": values[offset + BUCKETS],
+                    "count": values[offset + BUCKETS + 1],
+                }
+                for stage, offset in _HISTOGRAM_OFFSETS.items()
+            },
+        }
+
+
+def pipeline_gauges(frame_ring, send_queue) -> dict:
+    """The current depth of the frame ring and the queue of messages to send."""
+    gauges = {
+        "ring_depth": len(frame_ring),
+        "ring_capacity": frame_ring.capacity,
+        "ring_dropped_frames": frame_ring.dropped,
+    }
+    try:
+        gauges["send_queue_depth"] = send_queue.qsize()
+    except NotImplementedError:
+        pass # not available on MacOS
+    return gauges
+
+
+def percentile_us(histogram: dict, point: float) -> int | None:
+    """The upper bound of the bucket holding the `point` percentile, in microseconds."""
+    if not histogram["count"]:
+        return None
+    target = histogram["count"] * point / 100
+    seen = 0
+    for i, count in enumerate(histogram["buckets"]):
+        seen += count
+        if seen >= target:
+            return 2**i
+    return 2**BUCKETS
+
+
+def format_stats(snapshot: dict, gauges: dict, previous: dict | None = None) -> str:
+    """A table of the counters with their rates since `previous` (or the start), then the latencies."""
+    elapsed = snapshot["time"] - (previous["time"] if previous else snapshot["start_time"])
+    lines = [f"{'Counter':20} {'total':>14} {'per s':>10}"]
+    for name, value in snapshot["counters"].items():
+        before = previous["counters"][name] if previous else 0
+        rate = (value - before) / elapsed if elapsed > 0 else 0.0
+        lines.append(f"{name:20} {value:14,} {rate:10.1f}")
+
+    lines.append("")
+    lines.extend(f"{name:20} {value:14,}" for name, value in gauges.items())
+
+    lines.append("")
+    lines.append(f"{'Latency (ms)':20} {'count':>14} {'mean':>8} {'p50':>8} {'p99':>8}  (p50/p99 are upper bounds)")
+    for stage, histogram in snapshot["histograms"].items():
+        if histogram["count"]:
+            mean = histogram["sum_us"] / histogram["count"] / 1000
+            lines.append(f"{stage:20} {histogram['count']:14,} {mean:8.2f} "
+                         f"{percentile_us(histogram, 50) / 1000:8.2f} {percentile_us(histogram, 99) / 1000:8.2f}")
+        else:
+            lines.append(f"{stage:20} {0:14,} {'-':>8} {'-':>8} {'-':>8}")
+    return "\n".join(lines)
+
+
+def prometheus_text(snapshot: dict, gauges: dict) -> str:
+    """The counters, gauges and histograms in the Prometheus text exposition format."""
+    lines = []
+    for name, value in snapshot["counters"].items():
+        lines += [f"# HELP soti_{name}_total {COUNTERS[name]}", f"# TYPE soti_{name}_total counter",
+                  f"soti_{name}_total {value}"]
+    for name, value in gauges.items():
+        lines += [f"# TYPE soti_{name} gauge", f"soti_{name} {value}"]
+
+    lines += ["# HELP soti_latency_seconds Time frames take to reach each stage of the pipeline.",
+              "# TYPE soti_latency_seconds histogram"]
+    for stage, histogram in snapshot["histograms"].items():
+        cumulative = 0
+        for i, count in enumerate(histogram["buckets"][:-1]):
+            cumulative += count
+            lines.append(f'soti_latency_seconds_bucket{{stage="{stage}",le="{2**i / 1e6:g}"}} {cumulative}')
+        lines.append(f'soti_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'soti_latency_seconds_sum{{stage="{stage}"}} {histogram["sum_us"] / 1e6:g}')
+        lines.append(f'soti_latency_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves `collect()`'s (snapshot, gauges) at /metrics on the loopback interface, from a daemon thread."""
+
+    def __init__(self, collect, port: int = METRICS_PORT):
+        # imported here since it is slow to import and only the CLI serves metrics.
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = prometheus_text(*collect()).encode("utf_8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass # don't print every request over the CLI
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
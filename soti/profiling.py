@@ -0,0 +1,138 @@
+"""
+Profiles the worker processes of a session as they run.
+
+The serial reader and the logger run in their own processes, so profiling
+the CLI with `python -m cProfile` doesn't see them. With
+`python3 soti --profile`, each worker is run by run_profiled(), and when
+the session ends it writes what it found to
+save-data/profiles/<session>/<process>.*:
+
+.prof         cProfile statistics (--profile or --profile cprofile). Open
+              them with `python3 -m pstats` or a viewer such as snakeviz.
+.samples.txt  the stacks seen by the sampling profiler (--profile sample),
+              one "outer;...;inner count" line per stack, as flamegraph.pl
+              and speedscope read them.
+.tracemalloc  a tracemalloc snapshot (--profile-memory). Load it with
+              tracemalloc.Snapshot.load() to compare or dig into it.
+.memory.txt   the lines which had allocated the most memory at the end.
+
+With --runtime asyncio there are no workers, and the whole session is
+profiled as "session".
+
+cProfile only follows the thread which runs the worker, and slows every
+call down. The sampling profiler sees every thread and costs about the
+same however busy the process is, so it is the one to use for long runs.
+"""
+
+import cProfile
+import multiprocessing
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from utils.constants import PROFILE_SAMPLE_INTERVAL, PROFILE_TRACEBACK_DEPTH
+
+PROFILE_MODES = ("cprofile", "sample")
+# The number of lines listed in each .memory.txt.
+MEMORY_TOP = 25
+
+
+class ProfileOptions:
+    """What to profile and where to save it, given to each worker process."""
+
+    def __init__(self, output_dir: Path, mode: str | None = "cprofile", memory: bool = False,
+                 interval: float = PROFILE_SAMPLE_INTERVAL):
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}'. Use one of {', '.join(PROFILE_MODES)}")
+        if interval <= 0:
+            raise ValueError("The sampling interval must be positive")
+        self.output_dir = Path(output_dir)
+        self.mode = mode
+        self.memory = memory
+        self.interval = interval
+
+
+class StackSampler:
+    """Records the stack of every other thread of the process every `interval` seconds.
+
+    Each function is named with the file and line it starts on, so the
+    samples of one function add up whichever of its lines was running.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def save(self, path: Path):
+        """Writes the stacks in the collapsed format, most often seen first."""
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+
+
+def _save_memory(snapshot: tracemalloc.Snapshot, output_dir: Path, name: str):
+    snapshot.dump(str(output_dir / f"{name}.tracemalloc"))
+    lines = [f"Top {MEMORY_TOP} lines by memory allocated and not yet freed:"]
+    lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:MEMORY_TOP]]
+    (output_dir / f"{name}.memory.txt").write_text("\n".join(lines) + "\n")
+
+
+def run_profiled(options: ProfileOptions, name: str, target, *args):
+    """Runs target(*args) under the profilers in `options`, then saves what they found as `name`."""
+    output_dir = options.output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if options.memory:
+        tracemalloc.start(PROFILE_TRACEBACK_DEPTH)
+    profiler = cProfile.Profile() if options.mode == "cprofile" else None
+    sampler = StackSampler(options.interval) if options.mode == "sample" else None
+
+    if sampler:
+        sampler.start()
+    if profiler:
+        profiler.enable()
+    try:
+        target(*args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(output_dir / f"{name}.prof")
+        if sampler:
+            sampler.stop()
+            sampler.save(output_dir / f"{name}.samples.txt")
+        if options.memory:
+            _save_memory(tracemalloc.take_snapshot(), output_dir, name)
+            tracemalloc.stop()
+        print(f"Saved the profile of {name} in {output_dir}.")
+
+
+def worker_process(target, args: tuple, options: ProfileOptions | None = None,
+                   name: str | None = None) -> multiprocessing.Process:
+    """A daemon process running target(*args), profiled as `name` (by default, the target's) if there are `options`."""
+    if options is None:
+        return multiprocessing.Process(target=target, args=args, daemon=True)
+    return multiprocessing.Process(target=run_profiled, args=(options, name or target.__name__, target, *args),
+                                   daemon=True)
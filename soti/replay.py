@@ -0,0 +1,260 @@
+"""
+Replays recorded sessions with their original timing, N times faster, or as
+fast as possible.
+
+Recordings are streamed rather than loaded, so sessions of any length can be
+replayed, and a session split into segments is replayed from its manifest
+(see log_segments.py). Binary logs replay with the nanosecond timing they
+were captured with; YAML logs only have their time of day to the
+microsecond.
+
+In the CLI, `replay <file> [speed]` sends a recording through the serial
+transmit path. To play a recording as if it came from a board, on a
+pseudo-terminal another instance can open (POSIX only), run from the root
+folder:
+
+python3 soti/replay.py <file> [--speed N | --max] [--sources port ...]
+"""
+
+import argparse
+import datetime
+import math
+import os
+import struct
+import time
+import threading
+from pathlib import Path
+from utils.constants import CmdID, NodeID, MESSAGE_SOURCES, POLL_INTERVAL
+from message import Message
+from body_codec import CODECS, encode_body
+from binary_log import BinaryLogReader, BinaryLogStream, MAGIC
+from log_segments import open_log_file, is_compressed, is_manifest, manifest_segments
+from framing import encode_frame
+
+REPLAY_SOURCE = MESSAGE_SOURCES.index("replay")
+# How long before a deadline to stop sleeping and spin instead, as sleeps
+# can overshoot by about a scheduler tick.
+SPIN_TIME_NS = 1_000_000
+# The most messages sent at once when they are all due, e.g. at maximum speed.
+MAX_BATCH = 256
+
+
+def read_binary_log(path: Path):
+    """Yields (monotonic time, source, message bytes) for each record of a binary log."""
+    with (BinaryLogStream if is_compressed(path) else BinaryLogReader)(path) as log:
+        for _, capture_mono, source, _, msg_bytes in log:
+            yield capture_mono, MESSAGE_SOURCES[source], msg_bytes
+
+
+def _time_of_day_ns(s: str) -> int:
+    time_format = "%H:%M:%S.%f" if "." in s else "%H:%M:%S"
+    t = datetime.datetime.strptime(s, time_format)
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000_000 + t.microsecond * 1000
+
+
+def _yaml_entry_to_bytes(entry: dict) -> bytes:
+    cmd_id = CmdID[entry["cmd"]]
+    body = entry.get("body", {})
+    codec = CODECS[cmd_id.value]
+    if codec:
+        # numbers come back as text; everything else is converted by the codec.
+        for name, value in body.items():
+            if codec.types.get(name) == "f32":
+                body[name] = float(value)
+            elif codec.types.get(name, "").startswith(("u", "i")):
+                body[name] = int(value, 0)
+    return Message(
+        int(entry["priority"]), NodeID[entry["sender-id"]], NodeID[entry["recipient-id"]], cmd_id,
+        encode_body(cmd_id, body)
+    ).serialize()
+
+
+def read_yaml_log(path: Path):
+    """Yields (time, source, message bytes) for each message of a YAML session log.
+
+    Times are nanoseconds since midnight. Entries which can't be turned back
+    into a message are skipped.
+    """
+    def finish(entry):
+        try:
+            return _time_of_day_ns(entry["time"]), entry.get("source", "unspecified"), _yaml_entry_to_bytes(entry)
+        except (KeyError, ValueError, TypeError, struct.error):
+            return None
+
+    entry = None
+    with open_log_file(path, "rt") as file:
+        for line in file:
+            if line.startswith("- "):
+                if entry and (record := finish(entry)):
+                    yield record
+                entry = {}
+                line = line[2:]
+            elif entry is None or not line.strip():
+                continue
+
+            key, _, value = line.strip().partition(": ")
+            key, value = key.rstrip(":"), value.strip()
+            if line.startswith("    "):
+                entry["body"][key] = value
+            elif key == "body":
+                entry["body"] = {}
+            else:
+                entry[key] = value
+
+        if entry and (record := finish(entry)):
+            yield record
+
+
+def is_binary_log(path: Path) -> bool:
+    with open_log_file(path) as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def read_recording(path: Path):
+    """Streams a binary or YAML session log, whichever `path` is, or every segment of a session's manifest."""
+    paths = manifest_segments(path) if is_manifest(path) else [path]
+    if paths and is_binary_log(paths[0]):
+        return (record for segment in paths for record in read_binary_log(segment))
+    return _monotonic(record for segment in paths for record in read_yaml_log(segment))
+
+
+def _monotonic(records):
+    """Turns YAML times of day into times which keep increasing past midnight."""
+    day_offset_ns = 0
+    previous_ns = None
+    for time_ns, source, msg_bytes in records:
+        time_ns += day_offset_ns
+        if previous_ns is not None and time_ns < previous_ns - 43_200_000_000_000:
+            day_offset_ns += 86_400_000_000_000
+            time_ns += 86_400_000_000_000
+        previous_ns = time_ns
+        yield time_ns, source, msg_bytes
+
+
+class ReplayClock:
+    """Waits for each recorded time, scaled by `speed`, relative to when replay started.
+
+    Deadlines are computed from the start of the replay rather than from the
+    previous message, so time spent sending never accumulates into drift.
+    A speed of math.inf doesn't wait at all.
+    """
+
+    def __init__(self, speed: float = 1.0, stop_flag=None):
+        if speed <= 0:
+            raise ValueError("The replay speed must be positive")
+        self.speed = speed
+        self.stop_flag = stop_flag if stop_flag is not None else threading.Event()
+        self.start_ns = None
+        self.first_ns = None
+
+    def deadline(self, recorded_ns: int) -> int:
+        """The time.monotonic_ns() at which a message recorded at `recorded_ns` is due."""
+        if self.start_ns is None:
+            self.start_ns = time.monotonic_ns()
+            self.first_ns = recorded_ns
+        if math.isinf(self.speed):
+            return self.start_ns
+        return self.start_ns + int((recorded_ns - self.first_ns) / self.speed)
+
+    def wait_until(self, deadline_ns: int) -> bool:
+        """Blocks until the deadline. Returns False if the stop flag was set first."""
+        while True:
+            remaining_ns = deadline_ns - time.monotonic_ns()
+            if remaining_ns <= 0:
+                return not self.stop_flag.is_set()
+            if remaining_ns > SPIN_TIME_NS:
+                if self.stop_flag.wait(min((remaining_ns - SPIN_TIME_NS) / 1e9, POLL_INTERVAL)):
+                    return False
+
+
+def replay(records, send, speed: float = 1.0, sources=None, stop_flag=None) -> int:
+    """Calls send() with lists of (source, message bytes) as each becomes due.
+
+    Messages which are due at once, such as a burst or anything at
+    maximum speed, are sent together. Only messages from `sources` are
+    replayed, if given. Returns the number of messages sent.
+    """
+    clock = ReplayClock(speed, stop_flag)
+    batch = []
+    sent = 0
+
+    for recorded_ns, source, msg_bytes in records:
+        if sources is not None and source not in sources:
+            continue
+
+        deadline_ns = clock.deadline(recorded_ns)
+        if deadline_ns > time.monotonic_ns() or len(batch) >= MAX_BATCH:
+            if batch:
+                send(batch)
+                sent += len(batch)
+                batch = []
+            if not clock.wait_until(deadline_ns):
+                return sent
+        elif clock.stop_flag.is_set():
+            return sent
+
+        batch.append((source, msg_bytes))
+
+    if batch:
+        send(batch)
+        sent += len(batch)
+    return sent
+
+
+def replay_to_transmit(path: Path, out_msg_queue, frame_ring, speed: float = 1.0, sources=None, stop_flag=None):
+    """Sends a recording to the board through the serial reader's outgoing queue.
+
+    The messages are also logged, with the "replay" source.
+    """
+    def send(batch):
+        frames = [msg_bytes for _, msg_bytes in batch]
+        now_ns, now_mono = time.time_ns(), time.monotonic_ns()
+        frame_ring.write(frames, [now_ns] * len(frames), [now_mono] * len(frames), REPLAY_SOURCE)
+        for msg_bytes in frames:
+            try:
+                out_msg_queue.put(Message.deserialize(msg_bytes, "replay", now_ns, now_mono))
+            except ValueError:
+                pass
+
+    sent = replay(read_recording(path), send, speed, sources, stop_flag)
+    print(f"Replayed {sent} message(s) from {path}.")
+
+
+def replay_to_pty(path: Path, speed: float = 1.0, sources=None, stop_flag=None):
+    """Plays a recording on a new pseudo-terminal, framed as the board sends messages."""
+    # imported here, as tty is POSIX only and the rest of this module isn't.
+    import tty
+
+    controller_fd, device_fd = os.openpty()
+    tty.setraw(device_fd)
+
+    def send(batch):
+        data = memoryview(b"".join(encode_frame(msg_bytes) for _, msg_bytes in batch))
+        while data:
+            data = data[os.write(controller_fd, data):]
+
+    try:
+        input(f"Open {os.ttyname(device_fd)} (e.g. by choosing it in another SOTI CLI), then press Enter.")
+        sent = replay(read_recording(path), send, speed, sources, stop_flag)
+        print(f"Replayed {sent} message(s). Press Enter to close the port.")
+        input()
+    finally:
+        os.close(controller_fd)
+        os.close(device_fd)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Replays a session log on a pseudo-terminal.")
+    arg_parser.add_argument("path", type=Path)
+    speed_group = arg_parser.add_mutually_exclusive_group()
+    speed_group.add_argument("--speed", type=float, default=1.0, help="replay N times faster (default 1)")
+    speed_group.add_argument("--max", action="store_const", dest="speed", const=math.inf,
+                             help="replay as fast as possible")
+    arg_parser.add_argument("--sources", nargs="+", choices=MESSAGE_SOURCES,
+                            help="only replay messages from these sources (default: all)")
+    args = arg_parser.parse_args()
+
+    try:
+        replay_to_pty(args.path, args.speed, args.sources)
+    except KeyboardInterrupt:
+        pass
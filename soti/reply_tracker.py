@@ -0,0 +1,182 @@
+"""
+Matches replies to the commands which caused them and measures the round trip.
+
+A command sent to a subsystem is answered with CDH_PROCESS_RETURN or
+CDH_PROCESS_COMMAND_ERROR, whose body names the command. Each reply is
+matched to the oldest outstanding command with the same command ID sent
+to the node which replied, and the time between the two is recorded per
+command and per subsystem. Commands which get no reply within the timeout
+are counted instead.
+"""
+
+import json
+import math
+import time
+from collections import deque
+from pathlib import Path
+from utils.constants import CmdID, NodeID, REPLY_TIMEOUT
+from message import Message
+
+_REPLIES = (CmdID.CDH_PROCESS_RETURN, CmdID.CDH_PROCESS_COMMAND_ERROR)
+# Sources of the commands SOTI sends itself. Replayed messages are a
+# recording's, not commands waiting for a reply.
+_COMMAND_SOURCES = ("user", "script")
+
+
+class LatencyHistogram:
+    """Counts values in logarithmic buckets, like an HDR histogram.
+
+    Each power of two is split into equal sub-buckets, so any value is
+    recorded to `significant_digits` decimal digits whatever its size,
+    in a few hundred counters at most. Only buckets in use are stored.
+    """
+
+    def __init__(self, significant_digits: int = 2):
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10**significant_digits))
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value: int) -> int:
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (shift << (self.sub_bucket_bits - 1)) + (value >> shift)
+
+    def _highest_value(self, index: int) -> int:
+        """The largest value recorded in the same bucket as `index`."""
+        half = 1 << (self.sub_bucket_bits - 1)
+        shift = max((index >> (self.sub_bucket_bits - 1)) - 1, 0)
+        return ((index - shift * half + 1) << shift) - 1
+
+    def record(self, value: int):
+        """Adds a non-negative integer value."""
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, point: float) -> int | None:
+        """The value `point` percent of recorded values are at or below, to the histogram's precision."""
+        if not self.count:
+            return None
+        target = max(math.ceil(self.count * point / 100), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def summary(self, points=(50, 90, 99, 99.9)) -> dict:
+        """The count, mean, extremes and percentiles of the recorded values."""
+        result = {"count": self.count}
+        if self.count:
+            result["mean"] = round(self.total / self.count)
+            result["min"] = self.min
+            result.update({f"p{point:g}": self.percentile(point) for point in points})
+            result["max"] = self.max
+        return result
+
+
+class ReplyTracker:
+    """Follows commands until they are answered and records their round-trip latency in microseconds.
+
+    Feed it every message, sent and received, in the order they were
+    captured. Messages from the "port" are the board's. Of the others,
+    only commands sent by the user or a script are followed, and not the
+    CDH_PROCESS_* messages, which subsystems send to CDH without
+    expecting a reply.
+    """
+
+    def __init__(self, timeout: float = REPLY_TIMEOUT):
+        self.timeout_ns = int(timeout * 1e9)
+        self.by_command: dict[CmdID, LatencyHistogram] = {}
+        self.by_subsystem: dict[NodeID, LatencyHistogram] = {}
+        self.timeouts: dict[CmdID, int] = {}
+        self.timeouts_by_subsystem: dict[NodeID, int] = {}
+        self.errors: dict[CmdID, int] = {}
+        # replies which matched no outstanding command, e.g. ones arriving after the timeout.
+        self.unmatched = 0
+
+        # (replying node, node replied to, command value) -> capture times of the commands awaiting it.
+        self._outstanding: dict[tuple, deque] = {}
+
+    def feed(self, msg: Message):
+        """Records a sent command, or matches a reply to one. Other messages are ignored."""
+        cmd_id = msg.cmd_id
+        if msg.source != "port":
+            if msg.source in _COMMAND_SOURCES and not cmd_id.name.startswith("CDH_PROCESS_"):
+                key = (msg.recipient, msg.sender, cmd_id.value)
+                self._outstanding.setdefault(key, deque()).append(msg.mono_ns)
+            return
+
+        if cmd_id not in _REPLIES:
+            return
+        # the command ID is the first byte of a return and the second of an error.
+        command = msg.body[0] if cmd_id is CmdID.CDH_PROCESS_RETURN else msg.body[1]
+        pending = self._outstanding.get((msg.sender, msg.recipient, command))
+        if not pending:
+            self.unmatched += 1
+            return
+
+        latency_us = max(msg.mono_ns - pending.popleft(), 0) // 1000
+        command = CmdID(command)
+        self.by_command.setdefault(command, LatencyHistogram()).record(latency_us)
+        self.by_subsystem.setdefault(msg.sender, LatencyHistogram()).record(latency_us)
+        if cmd_id is CmdID.CDH_PROCESS_COMMAND_ERROR:
+            self.errors[command] = self.errors.get(command, 0) + 1
+
+    def expire(self, now_ns: int | None = None) -> list[tuple[NodeID, CmdID]]:
+        """Gives up on commands older than the timeout. Returns the (recipient, command) of each."""
+        cutoff = (time.monotonic_ns() if now_ns is None else now_ns) - self.timeout_ns
+        expired = []
+        for (node, _, command), pending in self._outstanding.items():
+            while pending and pending[0] < cutoff:
+                pending.popleft()
+                cmd_id = CmdID(command)
+                self.timeouts[cmd_id] = self.timeouts.get(cmd_id, 0) + 1
+                self.timeouts_by_subsystem[node] = self.timeouts_by_subsystem.get(node, 0) + 1
+                expired.append((node, cmd_id))
+        return expired
+
+    @property
+    def outstanding(self) -> int:
+        """The number of commands still awaiting a reply."""
+        return sum(len(pending) for pending in self._outstanding.values())
+
+    def as_dict(self) -> dict:
+        return {
+            "latency-us-by-command": {cmd_id.name: h.summary() for cmd_id, h in self.by_command.items()},
+            "latency-us-by-subsystem": {node.name: h.summary() for node, h in self.by_subsystem.items()},
+            "timeouts-by-command": {cmd_id.name: count for cmd_id, count in self.timeouts.items()},
+            "timeouts-by-subsystem": {node.name: count for node, count in self.timeouts_by_subsystem.items()},
+            "errors": {cmd_id.name: count for cmd_id, count in self.errors.items()},
+            "unmatched-replies": self.unmatched,
+        }
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.as_dict(), indent=2) + "\n")
+
+    def report(self) -> str:
+        """A table of round-trip latencies in milliseconds, slowest subsystem first."""
+        lines = [f"{'Round trip (ms)':32} {'count':>6} {'p50':>8} {'p99':>8} {'max':>8} {'timeouts':>9}"]
+
+        def row(name, histogram, timeouts):
+            if histogram.count:
+                p50, p99 = histogram.percentile(50), histogram.percentile(99)
+                return (f"{name:32} {histogram.count:6} {p50 / 1000:8.2f} {p99 / 1000:8.2f} "
+                        f"{histogram.max / 1000:8.2f} {timeouts:9}")
+            return f"{name:32} {0:6} {'-':>8} {'-':>8} {'-':>8} {timeouts:9}"
+
+        empty = LatencyHistogram()
+        nodes = self.by_subsystem.keys() | self.timeouts_by_subsystem.keys()
+        for node in sorted(nodes, key=lambda n: -(self.by_subsystem.get(n, empty).max or 0)):
+            lines.append(row(node.get_display_name(), self.by_subsystem.get(node, empty),
+                             self.timeouts_by_subsystem.get(node, 0)))
+        for cmd_id in sorted(self.by_command.keys() | self.timeouts.keys(), key=lambda c: c.value):
+            lines.append(row(f"  {cmd_id.name}", self.by_command.get(cmd_id, empty), self.timeouts.get(cmd_id, 0)))
+        return "\n".join(lines)
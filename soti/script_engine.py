@@ -0,0 +1,470 @@
+"""
+Runs test scripts against the SOTI board, or a simulated board.
+
+A test script is a Python file with an `async def run(sat)` function. `sat`
+is a ScriptBus, which sends commands and waits for messages without
+blocking, so many commands can be in flight at once:
+
+    async def run(sat):
+        # send a command and wait for its CDH_PROCESS_RETURN.
+        reply = await sat.request("PWR_GET_SUBSYSTEM_POWER subsystem-id=ADCS")
+
+        # send several commands at once and wait for every reply.
+        replies = await sat.gather(*(sat.request(f"PLD_GET_SETPOINT {well}") for well in range(4)))
+
+        # wait for a message without sending anything.
+        await sat.expect(cmd=CmdID.PWR_PROCESS_HEARTBEAT, from_=NodeID.PWR, timeout=2)
+
+Commands use the same syntax as the CLI's `send` command. A script passes
+if run() returns and fails if it raises. To run a suite of scripts one
+after the other and report the results, run from the root folder:
+
+python3 soti/script_engine.py <script.py ...> [--port PORT] [--timeout S] [--filter EXPRESSION]
+                               [--runtime processes|asyncio]
+
+Without --port, the scripts run against a simulated board (POSIX only).
+Every message sent and received is logged to the session logs as usual,
+by a logger process, or with --runtime asyncio by a task on the scripts'
+event loop, which then also reads the port itself (POSIX only).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+import serial
+from utils.constants import (
+    CmdID, NodeID, FRAME_SIZE, BAUD_RATE, POLL_INTERVAL, MESSAGE_SOURCES, SCRIPT_TIMEOUT, RUNTIME
+)
+from message import Message
+from framing import StreamFramer
+from frame_ring import FrameRing
+from capture_clock import CaptureClock
+from session_logger import log_messages, SessionRecorder
+from async_runtime import RecordQueue, SendQueue, log_records, write_messages
+from simulator import start_simulator
+from reply_tracker import ReplyTracker
+from message_filter import MessageFilter, FilterError, compile_filter
+import parser
+
+PORT_SOURCE = MESSAGE_SOURCES.index("port")
+SCRIPT_SOURCE = MESSAGE_SOURCES.index("script")
+
+
+class ScriptTimeout(Exception):
+    """An expected message didn't arrive in time."""
+
+
+class CommandError(Exception):
+    """The recipient of a command answered with CDH_PROCESS_COMMAND_ERROR."""
+
+    def __init__(self, msg: Message):
+        super().__init__(f"{msg.sender.get_display_name()} rejected the command: {msg.as_dict()['body']}")
+        self.msg = msg
+
+
+class _Waiter:
+    """A message a script is waiting for."""
+
+    __slots__ = ("matches", "future", "timer")
+
+    def __init__(self, matches, future: asyncio.Future):
+        self.matches = matches
+        self.future = future
+        self.timer = None
+
+
+class ScriptBus:
+    """Sends a script's commands and hands received messages to whatever is waiting for them.
+
+    Received messages are read on a background thread and passed to the
+    event loop in batches, or read by the event loop itself (see start()).
+    Commands are written to the port as they are sent, or put on
+    `send_queue` for a writer task on the loop. Each received message goes
+    to the oldest waiter it matches, so identical commands sent back to
+    back each get their own reply.
+    Messages nothing is waiting for are dropped. Scripts only see messages
+    which pass `message_filter`, though every message is still logged.
+    """
+
+    def __init__(self, ser: serial.Serial, frame_ring: FrameRing | RecordQueue | None = None,
+                 sender: NodeID = NodeID.CDH, timeout: float = SCRIPT_TIMEOUT,
+                 message_filter: MessageFilter | None = None, send_queue: SendQueue | None = None):
+        self.ser = ser
+        # commands are put here for a writer task if given, instead of written to the port directly.
+        self.send_queue = send_queue
+        self.frame_ring = frame_ring
+        self.message_filter = message_filter
+        self.sender = sender
+        self.timeout = timeout
+        self.sent = 0
+        self.received = 0
+        # round-trip latency of every command sent, whether or not a script waited for the reply.
+        self.tracker = ReplyTracker()
+
+        self._waiters: list[_Waiter] = []
+        self._loop = None
+        self._reader = None
+        self._in_loop = False
+        self._stop_flag = threading.Event()
+        self._framer = None
+        self._clock = None
+        self._previous_read_ns = 0
+
+    def start(self, in_loop: bool = False):
+        """Starts reading messages. Call from the event loop the script runs on.
+
+        With `in_loop`, the event loop reads the port whenever it is
+        readable (POSIX only) instead of a thread blocking on it.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._framer = StreamFramer()
+        self._clock = CaptureClock()
+        self._previous_read_ns = self._clock.mono_ref_ns
+        self._in_loop = in_loop
+        if in_loop:
+            self.ser.timeout = 0
+            self._loop.add_reader(self.ser.fileno(), self._read_ready)
+            return
+        self._stop_flag.clear()
+        self._reader = threading.Thread(target=self._read_messages, daemon=True)
+        self._reader.start()
+
+    def stop(self):
+        """Stops reading messages and cancels anything still waiting for one."""
+        if self._in_loop:
+            self._loop.remove_reader(self.ser.fileno())
+        self._stop_flag.set()
+        if self._reader:
+            self._reader.join()
+        self.cancel_pending()
+
+    def cancel_pending(self):
+        """Stops waiting for every expected message, e.g. when a script ends."""
+        for waiter in self._waiters:
+            waiter.future.cancel()
+        self._waiters.clear()
+
+    def _read_messages(self):
+        while not self._stop_flag.is_set():
+            chunk = self.ser.read(max(FRAME_SIZE, self.ser.in_waiting))
+            if batch := self._decode(chunk, time.monotonic_ns()):
+                self._loop.call_soon_threadsafe(self._dispatch, batch)
+
+    def _read_ready(self):
+        chunk = self.ser.read(self.ser.in_waiting or FRAME_SIZE)
+        if batch := self._decode(chunk, time.monotonic_ns()):
+            self._dispatch(batch)
+
+    def _decode(self, chunk: bytes, read_ns: int) -> list[Message]:
+        """Logs the messages in a chunk read at `read_ns`, and returns those which pass the filter."""
+        new_msgs = self._framer.feed(chunk) if chunk else []
+        previous_read_ns, self._previous_read_ns = self._previous_read_ns, read_ns
+        if not new_msgs:
+            return []
+
+        times_ns, monos_ns = self._clock.stamp_chunk(len(new_msgs), read_ns, previous_read_ns)
+        if self.frame_ring:
+            self.frame_ring.write(new_msgs, times_ns, monos_ns, PORT_SOURCE)
+
+        batch = []
+        for msg_bytes, time_ns, mono_ns in zip(new_msgs, times_ns, monos_ns):
+            if self.message_filter is not None and not self.message_filter(msg_bytes):
+                continue
+            try:
+                batch.append(Message.deserialize(msg_bytes, "port", time_ns, mono_ns))
+            except ValueError:
+                pass
+        return batch
+
+    def _dispatch(self, messages: list[Message]):
+        for msg in messages:
+            self.received += 1
+            self.tracker.feed(msg)
+            for waiter in self._waiters:
+                if not waiter.future.done() and waiter.matches(msg):
+                    waiter.future.set_result(msg)
+                    self._waiters.remove(waiter)
+                    break
+
+    def send(self, command: str | Message, sender: NodeID | None = None) -> Message:
+        """Sends a command, given as a Message or in the syntax of the CLI's send command.
+
+        Returns the message sent. Raises parser.ArgumentException for an
+        invalid command.
+        """
+        if isinstance(command, str):
+            msg = parser.parse_send(command, sender or self.sender)
+        else:
+            msg = command
+        msg.source = "script"
+        # stamp the message as it is sent, so round trips don't include time spent queued.
+        msg.time_ns, msg.mono_ns = time.time_ns(), time.monotonic_ns()
+
+        if self.send_queue is not None:
+            self.send_queue.put(msg)
+        else:
+            self.ser.write(msg.serialize())
+        if self.frame_ring:
+            self.frame_ring.write([msg.serialize()], [msg.time_ns], [msg.mono_ns], SCRIPT_SOURCE)
+        self.sent += 1
+        self.tracker.feed(msg)
+        return msg
+
+    def expect(self, cmd: CmdID | None = None, from_: NodeID | None = None, to: NodeID | None = None,
+               where=None, timeout: float | None = None) -> asyncio.Future:
+        """Waits for a message with the given command, sender and recipient.
+
+        `where` may be a function which takes the message and returns
+        whether it is the one expected. Returns a future of the message,
+        which raises ScriptTimeout if none arrives within `timeout` seconds.
+        The wait starts when expect() is called, not when the result is
+        awaited, so a message can't be missed in between.
+        """
+        def matches(msg: Message) -> bool:
+            return ((cmd is None or msg.cmd_id is cmd)
+                    and (from_ is None or msg.sender is from_)
+                    and (to is None or msg.recipient is to)
+                    and (where is None or where(msg)))
+
+        description = " ".join(filter(None, (
+            cmd.name if cmd else "message",
+            f"from {from_.get_display_name()}" if from_ else None,
+            f"to {to.get_display_name()}" if to else None,
+        )))
+        return self._wait(matches, description, timeout)
+
+    def _wait(self, matches, description: str, timeout: float | None) -> asyncio.Future:
+        timeout = self.timeout if timeout is None else timeout
+        waiter = _Waiter(matches, self._loop.create_future())
+        self._waiters.append(waiter)
+
+        def expire():
+            if not waiter.future.done():
+                waiter.future.set_exception(ScriptTimeout(f"No {description} within {timeout:g} s"))
+
+        def finished(_):
+            waiter.timer.cancel()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        waiter.timer = self._loop.call_later(timeout, expire)
+        waiter.future.add_done_callback(finished)
+        return waiter.future
+
+    async def request(self, command: str | Message, sender: NodeID | None = None,
+                      timeout: float | None = None) -> Message:
+        """Sends a command and waits for the recipient's CDH_PROCESS_RETURN for it.
+
+        Raises CommandError if the recipient answers with
+        CDH_PROCESS_COMMAND_ERROR instead, or ScriptTimeout if it doesn't
+        answer within `timeout` seconds.
+        """
+        if isinstance(command, str):
+            command = parser.parse_send(command, sender or self.sender)
+
+        def matches(msg: Message) -> bool:
+            if msg.sender is not command.recipient or msg.recipient is not command.sender:
+                return False
+            # the command ID is the first byte of a return and the second of an error.
+            if msg.cmd_id is CmdID.CDH_PROCESS_RETURN:
+                return msg.body[0] == command.cmd_id.value
+            if msg.cmd_id is CmdID.CDH_PROCESS_COMMAND_ERROR:
+                return msg.body[1] == command.cmd_id.value
+            return False
+
+        # wait before sending, so even an instant reply is caught.
+        reply = self._wait(matches, f"reply to {command.cmd_id.name} from "
+                           f"{command.recipient.get_display_name()}", timeout)
+        try:
+            self.send(command)
+        except BaseException:
+            reply.cancel()
+            raise
+
+        msg = await reply
+        if msg.cmd_id is CmdID.CDH_PROCESS_COMMAND_ERROR:
+            raise CommandError(msg)
+        return msg
+
+    @staticmethod
+    async def gather(*aws) -> list:
+        """Waits for every request or expected message and returns the results in order."""
+        return await asyncio.gather(*aws)
+
+    @staticmethod
+    async def sleep(seconds: float):
+        await asyncio.sleep(seconds)
+
+
+class ScriptResult:
+    """The outcome of running one test script."""
+
+    __slots__ = ("path", "passed", "duration_s", "sent", "received", "error")
+
+    def __init__(self, path: Path, passed: bool, duration_s: float, sent: int, received: int,
+                 error: BaseException | None = None):
+        self.path = path
+        self.passed = passed
+        self.duration_s = duration_s
+        self.sent = sent
+        self.received = received
+        self.error = error
+
+    def __str__(self):
+        line = (f"{'PASS' if self.passed else 'FAIL'}  {self.path.name:30} {self.duration_s:8.3f} s  "
+                f"{self.sent} sent, {self.received} received")
+        if self.error is not None:
+            line += f"\n      {type(self.error).__name__}: {self.error}"
+        return line
+
+
+def load_script(path: Path):
+    """Imports a test script and returns its run() function."""
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not asyncio.iscoroutinefunction(getattr(module, "run", None)):
+        raise TypeError(f"{path} has no 'async def run(sat)' function")
+    return module.run
+
+
+async def run_script(bus: ScriptBus, path: Path) -> ScriptResult:
+    """Runs one test script on the bus and records whether it passed."""
+    sent, received = bus.sent, bus.received
+    start_ns = time.monotonic_ns()
+    error = None
+    try:
+        await load_script(path)(bus)
+    except Exception as e:
+        error = e
+    finally:
+        # a script's leftover waits mustn't take the next script's messages.
+        bus.cancel_pending()
+
+    return ScriptResult(path, error is None, (time.monotonic_ns() - start_ns) / 1e9,
+                        bus.sent - sent, bus.received - received, error)
+
+
+async def run_suite(ser: serial.Serial, paths: list[Path], frame_ring: FrameRing | RecordQueue | None = None,
+                    timeout: float = SCRIPT_TIMEOUT, message_filter: MessageFilter | None = None,
+                    read_in_loop: bool = False, send_queue: SendQueue | None = None) -> list[ScriptResult]:
+    """Runs each test script in turn, printing each result as it finishes.
+
+    Ends with the round-trip latency of the commands the scripts sent.
+    """
+    bus = ScriptBus(ser, frame_ring, timeout=timeout, message_filter=message_filter, send_queue=send_queue)
+    bus.start(read_in_loop)
+    results = []
+    try:
+        for path in paths:
+            result = await run_script(bus, path)
+            print(result)
+            results.append(result)
+    finally:
+        bus.stop()
+
+    bus.tracker.expire()
+    if bus.tracker.by_command or bus.tracker.timeouts:
+        print(f"\n{bus.tracker.report()}")
+    return results
+
+
+def _log_quietly(*args):
+    """Runs log_messages() without printing every message over the results."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        log_messages(*args)
+
+
+async def run_suite_logged(ser: serial.Serial, paths: list[Path], port: str, timeout: float = SCRIPT_TIMEOUT,
+                           message_filter: MessageFilter | None = None) -> list[ScriptResult]:
+    """Runs the suite as run_suite() does, with the port read and written and every message logged on this event loop."""
+    records = RecordQueue()
+    stop_logger = asyncio.Event()
+    logger = asyncio.create_task(log_records(records, SessionRecorder(port, quiet=True), stop_logger))
+    send_queue = SendQueue()
+    writer = asyncio.create_task(write_messages(ser, send_queue))
+    try:
+        return await run_suite(ser, paths, records, timeout, message_filter, read_in_loop=True,
+                               send_queue=send_queue)
+    finally:
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        stop_logger.set()
+        await logger
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Runs test scripts against the SOTI board.")
+    arg_parser.add_argument("scripts", type=Path, nargs="+")
+    arg_parser.add_argument("--port", help="the board's serial port (default: a simulated board)")
+    arg_parser.add_argument("--timeout", type=float, default=SCRIPT_TIMEOUT,
+                            help=f"default seconds to wait for an expected message (default {SCRIPT_TIMEOUT:g})")
+    arg_parser.add_argument("--filter", metavar="EXPRESSION",
+                            help="only show scripts the messages which match, e.g. 'from=PLD and cmd~PLD_*'")
+    arg_parser.add_argument("--runtime", choices=("processes", "asyncio"), default=RUNTIME,
+                            help="log in a process of its own, or read the port and log on the scripts' event loop "
+                                 f"(default {RUNTIME})")
+    args = arg_parser.parse_args()
+    if args.runtime == "asyncio" and os.name != "posix":
+        arg_parser.error("--runtime asyncio needs Linux or MacOS")
+
+    try:
+        message_filter = compile_filter(args.filter)
+    except FilterError as e:
+        arg_parser.error(f"invalid filter: {e}")
+
+    stop_simulator_flag = multiprocessing.Event()
+    simulator = None
+    port = args.port
+    if port is None:
+        simulator, port = start_simulator(stop_simulator_flag)
+
+    # with the asyncio runtime, the suite logs its own messages.
+    frame_ring = logger = None
+    stop_logger_flag = multiprocessing.Event()
+    if args.runtime == "processes":
+        frame_ring = FrameRing()
+        logger = multiprocessing.Process(
+            target=_log_quietly,
+            args=(frame_ring, stop_logger_flag, port),
+            daemon=True
+        )
+        logger.start()
+
+    results = []
+    start_ns = time.monotonic_ns()
+    try:
+        with serial.Serial(port, baudrate=BAUD_RATE, timeout=POLL_INTERVAL, write_timeout=1) as ser:
+            if logger is None:
+                suite = run_suite_logged(ser, args.scripts, port, args.timeout, message_filter)
+            else:
+                suite = run_suite(ser, args.scripts, frame_ring, args.timeout, message_filter)
+            results = asyncio.run(suite)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if logger is not None:
+            stop_logger_flag.set()
+            logger.join()
+        if simulator:
+            stop_simulator_flag.set()
+            simulator.join()
+        if frame_ring is not None:
+            frame_ring.close()
+            frame_ring.unlink()
+
+    passed = sum(result.passed for result in results)
+    print(f"\n{passed} of {len(args.scripts)} script(s) passed in {(time.monotonic_ns() - start_ns) / 1e9:.3f} s.")
+    return passed == len(args.scripts)
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    sys.exit(0 if main() else 1)
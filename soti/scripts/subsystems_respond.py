@@ -0,0 +1,23 @@
+"""
+Checks that every subsystem is alive and answers commands.
+
+Run from the root folder with:
+python3 soti/script_engine.py soti/scripts/subsystems_respond.py [--port PORT]
+"""
+
+from utils.constants import CmdID, NodeID
+
+SUBSYSTEMS = (NodeID.PWR, NodeID.ADCS, NodeID.PLD)
+
+
+async def run(sat):
+    # ask every subsystem at once rather than waiting for each in turn.
+    replies = await sat.gather(*(
+        sat.request(f"COMM_GET_TELEMETRY_INTERVAL 0 to={node.name}") for node in SUBSYSTEMS
+    ))
+    assert [reply.sender for reply in replies] == list(SUBSYSTEMS)
+
+    # identical commands in flight together each get their own reply.
+    await sat.gather(*(sat.request(f"PLD_GET_SETPOINT {well}") for well in range(4)))
+
+    await sat.expect(cmd=CmdID.CDH_PROCESS_HEARTBEAT, to=NodeID.CDH, timeout=3)
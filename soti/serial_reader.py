@@ -1,40 +1,165 @@
-"""Reads messages from the serial wire into a queue. Does not process them."""
+"""Reads messages from the serial wire into a ring buffer. Does not process them."""
 
-from queue import Empty
+from queue import Empty, Full
+import signal
+import threading
+import time
 import serial
-from utils.constants import MSG_SIZE
+from utils.constants import CmdID, FRAME_SIZE, BAUD_RATE, POLL_INTERVAL, MESSAGE_SOURCES
 from message import Message
+from framing import StreamFramer
+from frame_ring import FrameRing
+from capture_clock import CaptureClock
+from live_display import DisplayControl
+from message_filter import FilterSettings
+from pipeline_metrics import PipelineMetrics
 
+PORT_SOURCE = MESSAGE_SOURCES.index("port")
+# The command byte of the messages which answer a command.
+REPLY_CMD_VALUES = (CmdID.CDH_PROCESS_RETURN.value, CmdID.CDH_PROCESS_COMMAND_ERROR.value)
+
+
+def serial_reader(frame_ring: FrameRing, out_msg_queue, stop_flag, port, reply_queue=None,
+                  display: DisplayControl | None = None, filters: FilterSettings | None = None,
+                  metrics: PipelineMetrics | None = None, baud_rate: int = BAUD_RATE, port_index: int = 0):
+    """Handles incoming and outgoing serial messages.
+
+    Only messages which pass the `filters` of the log or the display are
+    passed on. Replies to commands are put on `reply_queue`, if given,
+    for whatever is waiting for them (e.g. a firmware update), whether or
+    not they pass; a bounded queue drops those which don't fit. Each message is only printed if the display is verbose.
+    What passes through is counted in `metrics`, if given. Messages are
+    tagged with `port_index`, the port's place among the session's ports.
+    """
+    # Ctrl+C reaches every process on the terminal, but only the CLI acts
+    # on it (e.g. to cancel an update). It stops this process with stop_flag.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # use a write timeout of 1 second to avoid infinite blocking
+    with serial.Serial(port, baudrate=baud_rate, timeout=POLL_INTERVAL, write_timeout=1) as ser:
+        # outgoing messages are sent from their own thread so that
+        # neither direction has to poll the other.
+        writer = threading.Thread(
+            target=write_messages,
+            args=(ser, out_msg_queue, stop_flag, display, metrics),
+            daemon=True
+        )
+        writer.start()
+
+        read_messages(ser, frame_ring, stop_flag, reply_queue, display, filters, metrics, baud_rate, port_index)
+
+        writer.join()
+
+
+def read_messages(ser: serial.Serial, frame_ring: FrameRing, stop_flag, reply_queue=None,
+                  display: DisplayControl | None = None, filters: FilterSettings | None = None,
+                  metrics: PipelineMetrics | None = None, baud_rate: int = BAUD_RATE, port_index: int = 0):
+    """Blocks on the serial port and forwards every complete message."""
+    capture = PortCapture(frame_ring, reply_queue, display, filters, metrics, baud_rate, port_index)
+
+    while not stop_flag.is_set():
+        # block until at least one frame arrives (or the timeout expires),
+        # then take everything else the driver has buffered in the same call.
+        chunk = ser.read(max(FRAME_SIZE, ser.in_waiting))
+        # stamp the bytes as soon as they're read.
+        capture.feed(chunk, time.monotonic_ns())
+
+
+class PortCapture:
+    """Frames, stamps and filters the chunks read from a port, and passes its messages on.
+
+    The arguments are serial_reader()'s. `frame_ring` only needs a
+    FrameRing's write(), so the asyncio runtime can pass its own queue.
+    """
+
+    def __init__(self, frame_ring: FrameRing, reply_queue=None, display: DisplayControl | None = None,
+                 filters: FilterSettings | None = None, metrics: PipelineMetrics | None = None,
+                 baud_rate: int = BAUD_RATE, port_index: int = 0):
+        self.frame_ring = frame_ring
+        self.reply_queue = reply_queue
+        self.display = display
+        self.filters = filters
+        self.metrics = metrics
+        self.port_index = port_index
+        self.framer = StreamFramer()
+        self.clock = CaptureClock(baud_rate)
+        self.previous_read_ns = self.clock.mono_ref_ns
+
+    def feed(self, chunk: bytes, read_ns: int):
+        """Handles a chunk read at `read_ns`. An empty chunk means nothing arrived since the last read."""
+        framer, clock, metrics, display = self.framer, self.clock, self.metrics, self.display
+        previous_read_ns, self.previous_read_ns = self.previous_read_ns, read_ns
+        if not chunk:
+            return
+
+        rejected = framer.rejected
+        new_msgs = framer.feed(chunk)
+
+        # messages are decoded by the logger; only the raw bytes are passed on.
+        if new_msgs:
+            times_ns, monos_ns = clock.stamp_chunk(len(new_msgs), read_ns, previous_read_ns)
+
+            capture = self.filters.capture() if self.filters else None
+            if capture is None:
+                kept, kept_times, kept_monos = new_msgs, times_ns, monos_ns
+            else:
+                kept, kept_times, kept_monos = [], [], []
+                for msg_bytes, time_ns, mono_ns in zip(new_msgs, times_ns, monos_ns):
+                    if capture(msg_bytes):
+                        kept.append(msg_bytes)
+                        kept_times.append(time_ns)
+                        kept_monos.append(mono_ns)
+
+            if kept:
+                self.frame_ring.write(kept, kept_times, kept_monos, PORT_SOURCE, self.port_index)
+            if metrics is not None:
+                metrics.add("frames_read", len(new_msgs))
+                metrics.add("frames_filtered", len(new_msgs) - len(kept))
+                metrics.observe("ring", time.monotonic_ns() - read_ns, len(kept))
+
+            if display is not None and display.verbose.is_set():
+                for new_msg_bytes in kept:
+                    print(f"New Message: 0x{new_msg_bytes.hex()}")
+
+            if self.reply_queue is not None:
+                for msg_bytes, time_ns, mono_ns in zip(new_msgs, times_ns, monos_ns):
+                    if msg_bytes[3] in REPLY_CMD_VALUES:
+                        try:
+                            self.reply_queue.put_nowait(Message.deserialize(msg_bytes, "port", time_ns, mono_ns))
+                        except (ValueError, Full):
+                            pass
+
+        if metrics is not None:
+            metrics.add("bytes_read", len(chunk))
+            metrics.add("frames_rejected", framer.rejected - rejected)
+        if framer.rejected != rejected and (display is None or display.can_print):
+            print(f"Rejected {framer.rejected - rejected} corrupt frame(s) "
+                  f"({framer.rejected} this session).")
+
+
+def write_messages(ser: serial.Serial, out_msg_queue, stop_flag, display: DisplayControl | None = None,
+                   metrics: PipelineMetrics | None = None):
+    """Sleeps on the outgoing queue and writes each message as it arrives."""
+    while not stop_flag.is_set():
+        try:
+            out_msg = out_msg_queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            continue
+        send_message(ser, out_msg, display, metrics)
+
+
+def send_message(ser: serial.Serial, out_msg: Message, display: DisplayControl | None = None,
+                 metrics: PipelineMetrics | None = None):
+    """Writes a message to the serial port, or reports that it timed out."""
+    if display is not None and display.verbose.is_set():
+        print(f"Sending '{out_msg.cmd_id.name}' to {out_msg.recipient.get_display_name()}.")
 
-def serial_reader(write_msg_queue, out_msg_queue, stop_flag, port):
-    """Handles incoming and outgoing serial messages."""
     try:
-        # use a write timeout of 1 second to avoid infinite blocking
-        with serial.Serial(port, baudrate=115200, write_timeout=1) as ser:
-            while not stop_flag.is_set():
-                # check for incoming messages
-                while ser.in_waiting >= MSG_SIZE:
-                    # block and read indefinitely, reading messages 11 bytes at a time
-                    new_msg_bytes = ser.read(MSG_SIZE)
-                    new_msg_hex = new_msg_bytes.hex()
-                    print(f"New Message: 0x{new_msg_hex}")
-                    new_msg = Message.deserialize(new_msg_bytes)
-                    new_msg.source = "port"
-                    write_msg_queue.put(new_msg)
-
-                # check for outgoing messages
-                try:
-                    out_msg = out_msg_queue.get(block=False)
-
-                    out_msg_cmd = out_msg.as_dict()["cmd"].name
-                    out_msg_recipient = out_msg.as_dict()["recipient-id"].get_display_name()
-                    print(f"Sending '{out_msg_cmd}' to {out_msg_recipient}.")
-
-                    # write the message to the serial device
-                    ser.write(out_msg.serialize())
-                except Empty:
-                    pass
-                except serial.SerialTimeoutException:
-                    print("Send Fail: Serial write timed out.")
-    except KeyboardInterrupt:
-        pass
\ No newline at end of file
+        # write the message to the serial device
+        ser.write(out_msg.serialize())
+        if metrics is not None:
+            metrics.add("frames_sent")
+    except serial.SerialTimeoutException:
+        print("Send Fail: Serial write timed out.")
+        if metrics is not None:
+            metrics.add("send_timeouts")
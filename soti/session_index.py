@@ -0,0 +1,422 @@
+"""
+An SQLite index of every message in the session logs, to search the whole archive at once.
+
+Each message's capture time, header and numeric body fields are indexed.
+Searches use the filter expressions of message_filter.py, plus a time
+range, e.g. to find every CDH_PROCESS_RUNTIME_ERROR with error-code 7 in
+September:
+
+python3 soti/session_index.py "cmd=CDH_PROCESS_RUNTIME_ERROR and error-code=7" --since 2026-09-01 --until 2026-10-01
+
+The index is brought up to date before each search. Only sessions which
+are new or have changed since the last update are read, and a binary log
+which has grown, or been compressed, is read from where the last update
+stopped. A session logged in both formats is indexed from its binary log,
+and the segments of long sessions (see log_segments.py) are indexed one by
+one, whether or not they have been compressed.
+"""
+
+import argparse
+import datetime
+import itertools
+import math
+import sqlite3
+import time
+from enum import Enum
+from pathlib import Path
+from utils.constants import MESSAGE_SOURCES, SESSIONS_DIR, SESSION_INDEX_PATH
+from message import Message
+from body_codec import CODECS, RAW_TYPE_RE, decode_body
+from binary_log import BinaryLogReader, BinaryLogStream, FormatError
+from frame_ring import RECORD
+from replay import read_yaml_log, is_binary_log
+from log_segments import open_log_file, is_compressed, uncompressed_name
+from message_filter import FilterError, compile_filter
+
+# Increase this whenever the tables change; an older index is rebuilt.
+INDEX_VERSION = 2
+# Messages are inserted this many at a time.
+INSERT_BATCH = 10_000
+
+_SCHEMA = """
+CREATE TABLE sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    port TEXT
+);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    time_ns INTEGER NOT NULL,
+    source INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    sender INTEGER NOT NULL,
+    recipient INTEGER NOT NULL,
+    cmd INTEGER NOT NULL,
+    raw BLOB NOT NULL
+);
+CREATE INDEX messages_time ON messages (time_ns);
+CREATE INDEX messages_cmd ON messages (cmd, time_ns);
+CREATE INDEX messages_sender ON messages (sender, time_ns);
+CREATE INDEX messages_recipient ON messages (recipient, time_ns);
+CREATE INDEX messages_session ON messages (session);
+CREATE TABLE fields (
+    name TEXT NOT NULL,
+    value NOT NULL,
+    message INTEGER NOT NULL,
+    PRIMARY KEY (name, value, message)
+) WITHOUT ROWID;
+CREATE INDEX fields_message ON fields (message);
+"""
+
+_COLUMNS = {"priority": "priority", "from": "sender", "to": "recipient", "cmd": "cmd"}
+
+# command value -> (body codec, [(field name, position in the unpacked body)]) of the numeric fields.
+_INDEXED_FIELDS = {
+    cmd_value: (codec, [(name, i) for i, name in enumerate(codec.names) if not RAW_TYPE_RE.match(codec.types[name])])
+    for cmd_value, codec in enumerate(CODECS) if codec
+}
+
+_NS_PER_DAY = 86_400_000_000_000
+
+
+def _read_binary(path: Path, start: int):
+    """Yields the port, then (time_ns, source, message bytes) for the records of a binary log from index `start`."""
+    if is_compressed(path):
+        with BinaryLogStream(path) as log:
+            yield ", ".join(log.ports)
+            # a stream can't seek, so the records before `start` are read and skipped.
+            for time_ns, _, source, _, msg_bytes in itertools.islice(log, start, None):
+                yield time_ns, source, msg_bytes
+        return
+
+    with BinaryLogReader(path) as log:
+        yield ", ".join(log.ports)
+        for time_ns, _, source, _, msg_bytes in RECORD.iter_unpack(log.raw(start)):
+            yield time_ns, source, msg_bytes
+
+
+def _read_yaml(path: Path):
+    """Yields the port, then (time_ns, source, message bytes) for the entries of a YAML log.
+
+    Entries only have a time of day, so the date comes from the header and
+    is moved on a day whenever the time goes back by more than half a day.
+    """
+    header = {}
+    with open_log_file(path, "rt") as file:
+        for line in file:
+            key, _, value = line.strip().partition(": ")
+            if key.startswith("messages"):
+                break
+            header[key] = value
+    start = datetime.datetime.strptime(f"{header['date']} {header['time']}", "%Y-%m-%d %H:%M:%S")
+    midnight_ns = int(datetime.datetime.combine(start.date(), datetime.time()).timestamp()) * 1_000_000_000
+    previous_ns = (start - start.replace(hour=0, minute=0, second=0)).seconds * 1_000_000_000
+
+    yield header.get("port")
+    day_ns = 0
+    for time_of_day_ns, source, msg_bytes in read_yaml_log(path):
+        if time_of_day_ns + day_ns < previous_ns - _NS_PER_DAY // 2:
+            day_ns += _NS_PER_DAY
+        previous_ns = time_of_day_ns + day_ns
+        yield midnight_ns + previous_ns, MESSAGE_SOURCES.index(source), msg_bytes
+
+
+def _body_fields(message_id: int, msg_bytes: bytes):
+    """The (name, value, message) rows of a message's numeric body fields."""
+    indexed = _INDEXED_FIELDS.get(msg_bytes[3])
+    if indexed is None:
+        return []
+    codec, fields = indexed
+    values = codec.struct.unpack_from(msg_bytes, 4)
+    rows = []
+    for name, i in fields:
+        value = values[i]
+        if isinstance(value, float) and math.isnan(value):
+            continue # SQLite stores NaN as NULL
+        rows.append((name, int(value) if isinstance(value, bool) else value, message_id))
+    return rows
+
+
+def _compare(column: str, op: str, target) -> tuple[str, list]:
+    if op == "~":
+        return f"{column} IN ({', '.join('?' * len(target))})", sorted(target)
+    return f"{column} {op} ?", [target]
+
+
+def _sql_condition(node) -> tuple[str | None, list, bool]:
+    """Turns a parsed filter expression into an SQL condition on the messages table.
+
+    Returns the condition (None for "anything"), its parameters and
+    whether it is exact. Comparisons with raw (hex or binary) body fields
+    aren't indexed, so they are left out; the condition then selects a
+    superset of the matching messages, and the filter itself must be
+    applied to what it selects.
+    """
+    if node.kind == "term":
+        field, op, target = node.term
+        if field in _COLUMNS:
+            condition, params = _compare(_COLUMNS[field], op, target)
+            return condition, params, True
+        if isinstance(target, bytes):
+            return None, [], False
+        condition, params = _compare("value", op, target)
+        return f"id IN (SELECT message FROM fields WHERE name = ? AND {condition})", [field, *params], True
+
+    if node.kind == "not":
+        condition, params, exact = _sql_condition(node.children[0])
+        if condition is None or not exact:
+            return None, [], False
+        return f"NOT ({condition})", params, True
+
+    (left, left_params, left_exact), (right, right_params, right_exact) = map(_sql_condition, node.children)
+    exact = left_exact and right_exact
+    if node.kind == "and":
+        if left is None:
+            return right, right_params, exact
+        if right is None:
+            return left, left_params, exact
+        return f"({left} AND {right})", left_params + right_params, exact
+    if left is None or right is None:
+        return None, [], False
+    return f"({left} OR {right})", left_params + right_params, exact
+
+
+def _parse_time(s: str) -> int:
+    """Nanoseconds since the epoch of an ISO date or date and time, in local time."""
+    try:
+        return int(datetime.datetime.fromisoformat(s).timestamp() * 1e9)
+    except ValueError as exc:
+        raise ValueError(f"Invalid time '{s}'. Use e.g. 2026-09-01 or 2026-09-01T12:00") from exc
+
+
+class SessionIndex:
+    """The index at `path` of the session logs in `sessions_dir`."""
+
+    def __init__(self, path: Path = SESSION_INDEX_PATH, sessions_dir: Path = SESSIONS_DIR):
+        self.path = Path(path)
+        self.sessions_dir = Path(sessions_dir)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            with self._db:
+                for table in ("sessions", "messages", "fields"):
+                    self._db.execute(f"DROP TABLE IF EXISTS {table}")
+                self._db.executescript(_SCHEMA)
+                self._db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def _session_files(self) -> dict[str, Path]:
+        """The log to index for each session or segment, preferring binary logs to YAML ones.
+
+        Logs are keyed by their session and segment number, e.g.
+        2026-09-01_120000.0001, so they keep their key when compressed.
+        While a segment is being compressed, both files exist; the
+        compressed one is taken, as the other is about to be deleted.
+        """
+        files = {}
+        if self.sessions_dir.is_dir():
+            for path in sorted(self.sessions_dir.iterdir()):
+                name = Path(uncompressed_name(path))
+                if name.suffix not in (".bin", ".log"):
+                    continue
+                current = files.get(name.stem)
+                if current is None or name.suffix == ".bin" or Path(uncompressed_name(current)).suffix == ".log":
+                    files[name.stem] = path
+        return files
+
+    def update(self) -> tuple[int, int]:
+        """Indexes new and changed sessions and forgets deleted ones.
+
+        Returns the number of sessions read and of messages added.
+        """
+        known = {
+            row[1]: row for row in self._db.execute("SELECT id, name, size, mtime_ns, records, file FROM sessions")
+        }
+        files = self._session_files()
+
+        with self._db:
+            for name in known.keys() - files.keys():
+                self._forget(known[name][0])
+
+        sessions = 0
+        messages = 0
+        for name, path in files.items():
+            row = known.get(name)
+            try:
+                stat = path.stat()
+                if row and (row[5], row[2], row[3]) == (path.name, stat.st_size, stat.st_mtime_ns):
+                    continue
+                messages += self._index(name, path, stat, row)
+            except FileNotFoundError:
+                # compressed or deleted since the folder was listed; the next update picks it up.
+                continue
+            except (OSError, EOFError, FormatError, KeyError, ValueError) as e:
+                print(f"Couldn't index '{path}': {e}")
+                continue
+            sessions += 1
+        return sessions, messages
+
+    def _forget(self, session_id: int):
+        self._db.execute("DELETE FROM fields WHERE message IN (SELECT id FROM messages WHERE session = ?)",
+                         (session_id,))
+        self._db.execute("DELETE FROM messages WHERE session = ?", (session_id,))
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _index(self, name: str, path: Path, stat, row) -> int:
+        """Adds a session's messages in one transaction. Returns how many were added."""
+        is_binary = is_binary_log(path)
+        # binary logs are only ever appended to, so one which grew, or was
+        # compressed once finished, is read from where it was left.
+        grew = row and row[5] == path.name and not is_compressed(path) and stat.st_size >= row[2]
+        compressed = row and is_compressed(path) and row[5] == uncompressed_name(path)
+
+        with self._db:
+            if is_binary and (grew or compressed):
+                session_id, start = row[0], row[4]
+            else:
+                if row:
+                    self._forget(row[0])
+                session_id, start = None, 0
+
+            records = _read_binary(path, start) if is_binary else _read_yaml(path)
+            port = next(records)
+            if session_id is None:
+                session_id = self._db.execute(
+                    "INSERT INTO sessions (name, file, size, mtime_ns, records, port) VALUES (?, ?, 0, 0, 0, ?)",
+                    (name, path.name, port)
+                ).lastrowid
+
+            next_id = self._db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+            first_id = next_id
+            count = start
+            rows = []
+            fields = []
+            for time_ns, source, msg_bytes in records:
+                count += 1
+                try:
+                    Message.deserialize(msg_bytes)
+                except ValueError:
+                    continue
+                rows.append((next_id, session_id, time_ns, source, *msg_bytes[:4], msg_bytes))
+                fields.extend(_body_fields(next_id, msg_bytes))
+                next_id += 1
+                if len(rows) >= INSERT_BATCH:
+                    self._insert(rows, fields)
+            self._insert(rows, fields)
+
+            self._db.execute("UPDATE sessions SET file = ?, size = ?, mtime_ns = ?, records = ? WHERE id = ?",
+                             (path.name, stat.st_size, stat.st_mtime_ns, count, session_id))
+        return next_id - first_id
+
+    def _insert(self, rows: list, fields: list):
+        self._db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._db.executemany("INSERT OR IGNORE INTO fields VALUES (?, ?, ?)", fields)
+        rows.clear()
+        fields.clear()
+
+    def search(self, expression: str | None = None, since_ns: int | None = None, until_ns: int | None = None,
+               limit: int | None = None):
+        """Yields (log file name, Message) for each indexed message matching the filter expression.
+
+        Messages are in order of capture time, from `since_ns` up to but
+        not including `until_ns`. Raises FilterError if the expression is
+        invalid.
+        """
+        message_filter = compile_filter(expression)
+        condition, params, exact = _sql_condition(message_filter.tree) if message_filter else (None, [], True)
+
+        conditions = [condition] if condition else []
+        if since_ns is not None:
+            conditions.append("time_ns >= ?")
+            params.append(since_ns)
+        if until_ns is not None:
+            conditions.append("time_ns < ?")
+            params.append(until_ns)
+
+        query = "SELECT (SELECT file FROM sessions WHERE id = session), time_ns, source, raw FROM messages"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY time_ns, id"
+        if exact and limit is not None:
+            query += f" LIMIT {int(limit)}"
+
+        found = 0
+        for name, time_ns, source, raw in self._db.execute(query, params):
+            if not exact and not message_filter(raw):
+                continue
+            yield name, Message.deserialize(raw, MESSAGE_SOURCES[source], time_ns)
+            found += 1
+            if limit is not None and found >= limit:
+                return
+
+    @property
+    def message_count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def format_result(session: str, msg: Message) -> str:
+    """One line with the session, date, time, header and decoded body of a message."""
+    date = datetime.datetime.fromtimestamp(msg.time_ns / 1e9).strftime("%Y-%m-%d")
+    body = " ".join(
+        f"{name}={value.name if isinstance(value, Enum) else value}"
+        for name, value in decode_body(msg.cmd_id, msg.body).items()
+    )
+    return (f"{session:24} {date} {msg.time} {msg.sender.name:>4} -> {msg.recipient.name:4} "
+            f"{msg.cmd_id.name:32} {body}").rstrip()
+
+
+def search_sessions(expression: str | None = None, since: str | None = None, until: str | None = None,
+                    limit: int | None = None, index_path: Path = SESSION_INDEX_PATH,
+                    sessions_dir: Path = SESSIONS_DIR):
+    """Updates the index, then prints the matching messages and how long the search took."""
+    compile_filter(expression) # an invalid expression fails before the index is updated
+    since_ns = _parse_time(since) if since else None
+    until_ns = _parse_time(until) if until else None
+
+    with SessionIndex(index_path, sessions_dir) as index:
+        start = time.perf_counter()
+        sessions, messages = index.update()
+        if sessions:
+            print(f"Indexed {messages:,} message(s) from {sessions} session(s) in {time.perf_counter() - start:.1f} s.")
+
+        start = time.perf_counter()
+        found = 0
+        for session, msg in index.search(expression, since_ns, until_ns, limit):
+            print(format_result(session, msg))
+            found += 1
+        elapsed = time.perf_counter() - start
+        print(f"{found:,} message(s) found in {elapsed * 1000:.1f} ms, out of {index.message_count:,}.")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Searches the messages of every recorded session.")
+    arg_parser.add_argument("expression", nargs="?",
+                            help="a filter expression, e.g. \"cmd=CDH_PROCESS_RUNTIME_ERROR and error-code=7\" "
+                                 "(default: every message)")
+    arg_parser.add_argument("--since", help="the earliest capture time, e.g. 2026-09-01 or 2026-09-01T12:00")
+    arg_parser.add_argument("--until", help="the capture time to stop before")
+    arg_parser.add_argument("--limit", type=int, help="the most messages to print")
+    arg_parser.add_argument("--sessions", type=Path, default=SESSIONS_DIR, help="the folder of session logs")
+    arg_parser.add_argument("--index", type=Path, default=SESSION_INDEX_PATH, help="the index file")
+    args = arg_parser.parse_args()
+
+    try:
+        search_sessions(args.expression, args.since, args.until, args.limit, args.index, args.sessions)
+    except (FilterError, ValueError) as e:
+        print(e)
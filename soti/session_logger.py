@@ -1,74 +1,382 @@
-"""Parses messages from the input queue."""
+"""Parses messages from the ring buffer."""
 
 import datetime
 import os
-import string
-import struct
-from queue import Empty
-from enum import Enum
-from utils.constants import NodeID, CmdID, SAVE_DATA_DIR, SESSIONS_DIR, SESSION_FILE_FORMAT
-
-
-def datetime_to_filename(time: datetime):
+import signal
+import time
+from enum import Enum, auto
+from pathlib import Path
+from utils.constants import (
+    SAVE_DATA_DIR, SESSIONS_DIR, TELEMETRY_DIR, SESSION_FILE_FORMAT, POLL_INTERVAL, MESSAGE_SOURCES,
+    LOG_FLUSH_INTERVAL, LOG_FLUSH_SIZE, LOG_FORMATS, REPLY_TIMEOUT, SUMMARY_INTERVAL, DISPLAY_FPS,
+    LOG_SEGMENT_SIZE, LOG_SEGMENT_DURATION, LOG_COMPRESSION, LOG_RETAINED_SIZE
+)
+from frame_ring import FrameRing, iter_records, RECORD
+from binary_log import BinaryLogWriter
+from message import Message
+from telemetry_demux import TelemetryDemux
+from reply_tracker import ReplyTracker
+from live_display import DisplayControl, TrafficStats, SummaryPrinter
+from message_filter import FilterSettings, MessageFilter
+from pipeline_metrics import PipelineMetrics
+from log_segments import SessionManifest, SegmentCompressor, FORMAT_SUFFIXES, MANIFEST_SUFFIX
+
+
+def datetime_to_filename(time: datetime, extension: str = ".log"):
     file_format = time.strftime(SESSION_FILE_FORMAT)
-    return f"{file_format}.log"
+    return f"{file_format}{extension}"
 
 
-def save_log(filename: str, start_time: datetime, end_time: datetime, port, msg_log: str):
-    if not os.path.exists(SAVE_DATA_DIR):
-        os.mkdir(SAVE_DATA_DIR)
-    if not os.path.exists(SESSIONS_DIR):
-        os.mkdir(SESSIONS_DIR)
-
-    session_length = end_time - start_time
-    hours, remainder = divmod(session_length.seconds, 3600)
+def format_session_length(session_length: datetime.timedelta) -> str:
+    """Formats a duration as HH:MM:SS. Hours keep counting past a day."""
+    hours, remainder = divmod(int(session_length.total_seconds()), 3600)
     minutes, seconds = divmod(remainder, 60)
-
-    formatted_date = start_time.strftime("%Y-%m-%d")
-    formatted_time = start_time.strftime("%H:%M:%S")
-    formatted_session_length = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-
-    log_dict = {
-        "date": formatted_date,
-        "time": formatted_time,
-        "session-length": formatted_session_length,
-        "port": port,
-        "messages": ""
-    }
-
-    log_yaml = dict_to_yaml(log_dict, 0)
-    log_yaml += msg_log
-
-    with open(SESSIONS_DIR / filename, 'w', encoding="utf_8") as history:
-        history.write(log_yaml)
-
-
-def log_messages(write_msg_queue, stop_flag, port):
-    """Writes messages from the queue to the output file."""
-    start_time = datetime.datetime.now()
-    msg_log = ""
-
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+class FsyncPolicy(Enum):
+    """When the session log is forced from the OS cache onto the disk."""
+    NEVER = auto()     # leave it to the OS. Survives a crash but not a power loss.
+    ON_FLUSH = auto()  # after every batch is written.
+    ON_CLOSE = auto()  # once, at the end of the session.
+
+
+class SessionLogWriter:
+    """Appends YAML message entries to a session log as they arrive.
+
+    The header is written when the log is opened and entries are written in
+    batches, so memory use doesn't grow with the length of the session and a
+    killed process loses at most the batch it hadn't flushed yet. The
+    session length in the header is filled in when the log is closed.
+    """
+
+    # room for the session length to be patched in, even for very long sessions.
+    SESSION_LENGTH_WIDTH = 12
+
+    def __init__(self, path: Path, start_time: datetime.datetime, port,
+                 flush_interval: float = LOG_FLUSH_INTERVAL,
+                 flush_size: int = LOG_FLUSH_SIZE,
+                 fsync_policy: FsyncPolicy = FsyncPolicy.ON_FLUSH):
+        self.start_time = start_time
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync_policy = fsync_policy
+
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, 'wb')
+
+        log_dict = {
+            "date": start_time.strftime("%Y-%m-%d"),
+            "time": start_time.strftime("%H:%M:%S"),
+            "session-length": format_session_length(datetime.timedelta()).ljust(self.SESSION_LENGTH_WIDTH),
+            "port": port,
+            "messages": ""
+        }
+        header = dict_to_yaml(log_dict, 0).encode("utf_8")
+        self._session_length_offset = header.index(b"session-length: ") + len(b"session-length: ")
+
+        self._file.write(header)
+        self.flush()
+
+    @property
+    def size(self) -> int:
+        """The length of the log in bytes, including entries not yet written out."""
+        return self._file.tell() + self._pending_size
+
+    def write(self, entry: str):
+        """Queues an entry and writes out the batch if it is due."""
+        self._pending.append(entry)
+        self._pending_size += len(entry)
+
+        if self._pending_size >= self.flush_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Writes out the pending entries if the flush interval has passed."""
+        if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes out the pending entries."""
+        if self._pending:
+            self._file.write("".join(self._pending).encode("utf_8"))
+            self._pending.clear()
+            self._pending_size = 0
+
+        self._file.flush()
+        if self.fsync_policy is FsyncPolicy.ON_FLUSH:
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self, end_time: datetime.datetime):
+        """Writes out everything and records the session length in the header."""
+        self.flush()
+
+        self._file.seek(self._session_length_offset)
+        session_length = format_session_length(end_time - self.start_time)
+        self._file.write(session_length.ljust(self.SESSION_LENGTH_WIDTH).encode("utf_8"))
+
+        self._file.flush()
+        if self.fsync_policy is not FsyncPolicy.NEVER:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+
+class SessionLog:
+    """The logs of a session in each of `log_formats`, split into segments.
+
+    The segments of every format are started together, once the largest
+    reaches `segment_size` bytes or `segment_duration` seconds have
+    passed, so each segment covers the same messages in every format.
+    Finished segments are handed to a SegmentCompressor, and the manifest
+    lists them all. `port` is the port the session is captured from, or a
+    list of them if there are several.
+    """
+
+    def __init__(self, sessions_dir: Path, start_time: datetime.datetime, port, log_formats=LOG_FORMATS,
+                 segment_size: int = LOG_SEGMENT_SIZE, segment_duration: float | None = LOG_SEGMENT_DURATION,
+                 compression: str | None = LOG_COMPRESSION, retained_size: int | None = LOG_RETAINED_SIZE):
+        self.sessions_dir = sessions_dir
+        self.start_time = start_time
+        self.ports = [port] if isinstance(port, str) else list(port)
+        self.port = ", ".join(self.ports)
+        self.log_formats = log_formats
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+
+        self.manifest = SessionManifest(sessions_dir / datetime_to_filename(start_time, MANIFEST_SUFFIX),
+                                        start_time, self.port)
+        self._compressor = SegmentCompressor(self.manifest, compression, retained_size)
+        self.yaml: SessionLogWriter | None = None
+        self.binary: BinaryLogWriter | None = None
+        self.segment = 0
+        self._paths = []
+        self._segment_start = 0.0
+
+        self._open_segment(start_time)
+
+    def _open_segment(self, start_time: datetime.datetime):
+        self.segment += 1
+        self._segment_start = time.monotonic()
+        self._paths = []
+        for log_format in ("yaml", "binary"):
+            if log_format not in self.log_formats:
+                continue
+            path = self.sessions_dir / datetime_to_filename(
+                self.start_time, f".{self.segment:04d}{FORMAT_SUFFIXES[log_format]}"
+            )
+            if log_format == "yaml":
+                self.yaml = SessionLogWriter(path, start_time, self.port)
+            else:
+                self.binary = BinaryLogWriter(path, start_time, self.ports)
+            self.manifest.add(path, log_format, start_time)
+            self._paths.append(path)
+
+    def _close_segment(self, end_time: datetime.datetime):
+        if self.yaml:
+            self.yaml.close(end_time)
+        if self.binary:
+            self.binary.close()
+        for path in self._paths:
+            self.manifest.finish(path, end_time)
+
+    @property
+    def size(self) -> int:
+        """The size of the current segment's largest file."""
+        return max(writer.size for writer in (self.yaml, self.binary) if writer)
+
+    def flush_if_due(self):
+        """Writes out pending messages if they are due, and starts a new segment if the current one is full."""
+        if self.yaml:
+            self.yaml.flush_if_due()
+        if self.binary:
+            self.binary.flush_if_due()
+
+        if not self._paths:
+            return
+        if self.size >= self.segment_size or (
+                self.segment_duration is not None and time.monotonic() - self._segment_start >= self.segment_duration):
+            self.rotate()
+
+    def rotate(self):
+        """Finishes the current segment and starts the next."""
+        now = datetime.datetime.now()
+        self._close_segment(now)
+        for path in self._paths:
+            self._compressor.submit(path)
+        self._open_segment(now)
+
+    def close(self, end_time: datetime.datetime):
+        """Finishes the last segment, which is left uncompressed, and waits for the others to be compressed."""
+        self._close_segment(end_time)
+        self._compressor.close()
+        self.manifest.close(end_time)
+
+
+def log_messages(frame_ring: FrameRing, stop_flag, port, log_formats=LOG_FORMATS, save_dir: Path = SAVE_DATA_DIR,
+                 display: DisplayControl | None = None, filters: FilterSettings | None = None,
+                 metrics: PipelineMetrics | None = None):
+    """Writes messages from the ring buffer to the output files in `save_dir`.
+
+    To log several ports as one session, give a frame_merge.FrameMerger of
+    their rings and the list of ports. With a `display`, live traffic
+    statistics are published to it and summarized on the terminal.
+    `filters` select which messages are logged and which are shown. What
+    is logged, and how long it took to get there, is counted in `metrics`,
+    if given.
+    """
+    # Ctrl+C reaches every process on the terminal, but only the CLI acts
+    # on it (e.g. to cancel an update). It stops this process with stop_flag.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    recorder = SessionRecorder(port, log_formats, save_dir, display, filters, metrics)
     try:
         while not stop_flag.is_set():
-            try:
-                new_msg = write_msg_queue.get(block=False)
+            recorder.log(frame_ring.read(timeout=POLL_INTERVAL))
 
-                new_msg_dict = new_msg.as_dict()
-                if new_msg.source == "port":
-                    print(f"Message Parsed: {new_msg_dict}")
-
-                # append the new message
-                msg_log += dict_to_yaml(new_msg_dict, 1, True) + "\n"
-
-            except Empty: # No item from queue.
-                pass
-    except KeyboardInterrupt:
-        pass
+        # pick up anything which arrived while stopping.
+        recorder.log(frame_ring.take())
 
     finally:
-        filename = datetime_to_filename(start_time)
-        end_time = datetime.datetime.now()
-        save_log(filename, start_time, end_time, port, msg_log)
+        recorder.close(frame_ring.dropped)
+
+
+class SessionRecorder:
+    """What log_messages() logs a session with: its logs, telemetry, reply latencies and traffic statistics.
+
+    The arguments are log_messages()'s. log() is given each batch taken
+    from the ring buffer, however it was taken, so the asyncio runtime
+    logs a session the same way. A `quiet` recorder prints nothing, e.g.
+    so as not to interrupt the results of test scripts.
+    """
+
+    def __init__(self, port, log_formats=LOG_FORMATS, save_dir: Path = SAVE_DATA_DIR,
+                 display: DisplayControl | None = None, filters: FilterSettings | None = None,
+                 metrics: PipelineMetrics | None = None, quiet: bool = False):
+        self.start_time = datetime.datetime.now()
+        self.sessions_dir = save_dir / SESSIONS_DIR.name
+        self.display = display
+        self.filters = filters
+        self.metrics = metrics
+        self.quiet = quiet
+
+        self.session_log = SessionLog(self.sessions_dir, self.start_time, port, log_formats) if log_formats else None
+        self.demux = TelemetryDemux(save_dir / TELEMETRY_DIR.name / datetime_to_filename(self.start_time, ""),
+                                    ports=self.session_log.ports if self.session_log else None)
+        self.tracker = ReplyTracker()
+        self.stats = TrafficStats()
+        self.summary = SummaryPrinter(SUMMARY_INTERVAL)
+        self._last_snapshot = 0.0
+
+    def log(self, batch: bytes):
+        """Logs a batch of records, which may be empty, and publishes the traffic statistics if they are due."""
+        current = self.filters.current() if self.filters else {}
+        if self.metrics is not None and batch:
+            self.metrics.observe_batch("dequeue", batch, time.monotonic_ns())
+        log_batch(batch, self.session_log, self.demux, self.tracker, self.stats, self.display,
+                  current.get("log"), current.get("display"), self.metrics, self.quiet)
+
+        display = self.display
+        if display is not None and time.monotonic() - self._last_snapshot >= 1 / DISPLAY_FPS:
+            self._last_snapshot = time.monotonic()
+            snapshot = self.stats.snapshot()
+            display.publish(snapshot)
+            if display.can_print and display.summary.is_set() and not display.verbose.is_set():
+                self.summary.update(snapshot)
+
+    def close(self, dropped: int = 0):
+        """Finishes the session and reports what went wrong, given how many records were `dropped` on the way."""
+        if dropped and not self.quiet:
+            print(f"{dropped} message(s) were dropped because the logger fell behind.")
+        if self.session_log:
+            self.session_log.close(datetime.datetime.now())
+        self.demux.close()
+        if self.demux.gaps and not self.quiet:
+            print(f"{self.demux.gaps} telemetry report(s) had missing packets or followed missed reports.")
+        if self.tracker.by_command or self.tracker.timeouts:
+            if not self.quiet:
+                print(self.tracker.report())
+            self.tracker.save(self.sessions_dir / datetime_to_filename(self.start_time, ".latency.json"))
+
+
+def log_batch(batch: bytes, session_log: SessionLog | None, demux: TelemetryDemux | None = None, tracker: ReplyTracker | None = None,
+              stats: TrafficStats | None = None, display: DisplayControl | None = None,
+              log_filter: MessageFilter | None = None, display_filter: MessageFilter | None = None,
+              metrics: PipelineMetrics | None = None, quiet: bool = False):
+    """Decodes a batch of records from the ring buffer and logs each message.
+
+    Only messages which pass `log_filter` are logged, and only those which
+    pass `display_filter` are counted and shown. Messages are only
+    printed one by one if the display is verbose, and nothing is printed
+    if `quiet`.
+    """
+    verbose = display is not None and display.verbose.is_set() and not quiet
+    can_print = not quiet and (display is None or display.can_print)
+    writer = session_log.yaml if session_log else None
+    binary_writer = session_log.binary if session_log else None
+    # each message only says which port it came from if there are several.
+    ports = session_log.ports if session_log and len(session_log.ports) > 1 else None
+
+    if binary_writer and log_filter is None:
+        # the ring's records are already in the binary log's layout.
+        binary_writer.write_records(batch)
+    logged_records = []
+
+    for i, (capture_time, capture_mono, source, port, msg_bytes) in enumerate(iter_records(batch)):
+        logged = log_filter is None or log_filter(msg_bytes)
+        shown = stats is not None and (display_filter is None or display_filter(msg_bytes))
+        if not (logged or shown):
+            continue
+        if logged and log_filter is not None:
+            logged_records.append(batch[i * RECORD.size:(i + 1) * RECORD.size])
+
+        try:
+            new_msg = Message.deserialize(msg_bytes, MESSAGE_SOURCES[source], capture_time, capture_mono)
+        except ValueError as e:
+            if can_print:
+                print(f"Discarded message 0x{msg_bytes.hex()}: {e}")
+            if metrics is not None:
+                metrics.add("decode_failures")
+            continue
+
+        if shown:
+            stats.add(new_msg)
+            if verbose and new_msg.source == "port":
+                print(f"Message Parsed: {new_msg.as_dict()}")
+
+        if not logged:
+            continue
+        # append the new message
+        if writer:
+            msg_dict = {**new_msg.as_dict(), "port": ports[port]} if ports else new_msg.as_dict()
+            writer.write(dict_to_yaml(msg_dict, 1, True) + "\n")
+        if demux:
+            demux.feed(new_msg, port)
+        if tracker:
+            tracker.feed(new_msg)
+
+    if binary_writer and logged_records:
+        binary_writer.write_records(b"".join(logged_records))
+    if metrics is not None and batch:
+        metrics.add("batches_logged")
+        # only what passed the log filter was written.
+        metrics.add("records_logged", len(batch) // RECORD.size if log_filter is None else len(logged_records))
+        metrics.observe_batch("logged", batch, time.monotonic_ns())
+
+    if session_log:
+        session_log.flush_if_due()
+    if demux:
+        demux.flush_if_due()
+    if tracker:
+        for node, cmd_id in tracker.expire():
+            if can_print:
+                print(f"No reply to {cmd_id.name} from {node.get_display_name()} within {REPLY_TIMEOUT:g} s.")
 
 
 def dict_to_yaml(d: dict, level: int, listItem: bool = False, recursive: bool = False) -> str:
@@ -103,105 +411,3 @@ def dict_to_yaml(d: dict, level: int, listItem: bool = False, recursive: bool =
         text += "\n"
 
     return text
-
-
-def extract_int(data: bytes, index: int, size: int, signed: bool = False) -> int:
-    """Extracts an integer of any width from a bytes object."""
-    return int.from_bytes(data[index:(size+index)], byteorder='little', signed=signed)
-
-
-def extract_float(data: bytes, index: int) -> float:
-    """Extracts a 32-bit float from a bytes object."""
-    return struct.unpack('<f', data[index:(4+index)])[0]
-
-
-def to_hex_str(data: bytes) -> str:
-    """Returns a hexadecimal representation of the provided data."""
-    return "0x" + data.hex()
-
-
-def to_bin_str(data: bytes) -> str:
-    """Returns a binary representation of the provided data."""
-    bit_string = ''
-    for byte in data:
-        bits = str(bin(byte))[2:]  # remove '0b' prefix
-        bit_string += bits.zfill(8)  # pad with zeros to 8 bits
-    return "0b" + bit_string
-
-
-def parse_msg_body(cmd_id: CmdID, body: bytes) -> dict:
-    """Returns relevant data about the provided message."""
-    output = {}
-
-    match cmd_id:
-        # Common
-        case CmdID.COMM_GET_TELEMETRY:
-            output['telemetry-key'] = body[0]
-        case CmdID.COMM_SET_TELEMETRY_INTERVAL:
-            output['telemetry-key'] = body[0]
-            output['interval'] = extract_int(body, 1, 2)
-        case CmdID.COMM_GET_TELEMETRY_INTERVAL:
-            output['telemetry-key'] = body[0]
-        case CmdID.COMM_UPDATE_START:
-            output['address'] = extract_int(body, 0, 4)
-        case CmdID.COMM_UPDATE_LOAD:
-            output['data'] = to_hex_str(body)
-
-        # CDH
-        case CmdID.CDH_PROCESS_RUNTIME_ERROR:
-            output['error-code'] = body[0]
-            output['context-code'] = body[1]
-            output['debug-data'] = to_hex_str(body[2:7])
-        case CmdID.CDH_PROCESS_COMMAND_ERROR:
-            output['error-code'] = body[0]
-            output['command-id'] = CmdID(body[1])
-            output['debug-data'] = to_hex_str(body[2:7])
-        case CmdID.CDH_PROCESS_NOTIFICATION:
-            output['notification-id'] = body[0]
-        case CmdID.CDH_PROCESS_TELEMETRY_REPORT:
-            output['telemetry-key'] = body[0]
-            output['sequence-number'] = body[1]
-            output['packet-number'] = body[2]
-            output['telemetry'] = to_hex_str(body[3:7])
-        case CmdID.CDH_PROCESS_RETURN:
-            output['command-id'] = CmdID(body[0])
-            output['data'] = to_hex_str(body[1:7])
-        case CmdID.CDH_PROCESS_LED_TEST:
-            output['bitmap'] = to_bin_str(body[:2])
-        case CmdID.CDH_SET_RTC:
-            output['unix-timestamp'] = extract_int(body, 0, 4)
-        case CmdID.CDH_RESET_SUBSYSTEM:
-            output['subsystem-id'] = NodeID(body[0])
-
-        # Power
-        case CmdID.PWR_SET_SUBSYSTEM_POWER:
-            output['subsystem-id'] = NodeID(body[0])
-            output['power'] = bool(body[1])
-        case CmdID.PWR_GET_SUBSYSTEM_POWER:
-            output['subsystem-id'] = NodeID(body[0])
-        case CmdID.PWR_SET_BATTERY_HEATER_POWER:
-            output['heater-power'] = bool(body[0])
-        case CmdID.PWR_SET_BATTERY_ACCESS:
-            output['battery-access'] = bool(body[0])
-
-        # ADCS
-        case CmdID.ADCS_SET_MAGNETORQUER_DIRECTION:
-            output['magnetorquer-id'] = body[0]
-            output['direction'] = extract_int(body, 1, 1, signed=True)
-        case CmdID.ADCS_GET_MAGNETORQUER_DIRECTION:
-            output['magnetorquer-id'] = body[0]
-        case CmdID.ADCS_SET_OPERATING_MODE:
-            output['mode'] = body[0]
-
-        # Payload
-        case CmdID.PLD_SET_ACTIVE_ENVS:
-            output['bitmap'] = to_bin_str(body[:2])
-        case CmdID.PLD_GET_SETPOINT:
-            output['well-id'] = body[0]
-            output['setpoint'] = extract_float(body, 1)
-        case CmdID.PLD_GET_SETPOINT:
-            output['well-id'] = body[0]
-        case CmdID.PLD_SET_TOLERANCE:
-            output['tolerance'] = extract_float(body, 0)
-
-    return output
@@ -0,0 +1,229 @@
+"""
+A simulated SOTI board for virtual mode. POSIX only.
+
+The simulator owns one end of a pseudo-terminal and the serial reader opens
+the other end like any serial port, so virtual sessions go through the same
+receive, decode and logging path as a real board. Traffic is paced at the
+UART's line rate and generated from a seeded random number generator, so a
+given seed always produces the same sequence of messages.
+
+To run it on its own and point another program at it, run from the root folder:
+
+python3 soti/simulator.py [--seed N] [--heartbeat HZ] [--telemetry HZ] [--error HZ]
+
+A rate of "inf" keeps the line saturated.
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import select
+import signal
+import struct
+import time
+from utils.constants import (
+    CmdID, NodeID, COMM_INFO, MSG_SIZE, BAUD_RATE, POLL_INTERVAL, SIMULATOR_RATES
+)
+from message import Message
+from body_codec import encode_body
+from framing import encode_frame
+from capture_clock import FRAME_TIME_NS
+
+# Subsystems which send events and telemetry to CDH.
+SUBSYSTEMS = (NodeID.PWR, NodeID.ADCS, NodeID.PLD)
+# Telemetry keys each subsystem reports on.
+TELEMETRY_KEYS = range(4)
+# Frames held for a reader which isn't keeping up. Anything beyond this is
+# lost, like bytes sent down a UART with nothing listening.
+MAX_PENDING_BYTES = 64 * 1024
+
+
+class SimulatedBoard:
+    """Generates the traffic of a SOTI board and answers commands sent to it.
+
+    `rates` gives the average number of heartbeats, telemetry reports and
+    runtime errors per second. Heartbeats are periodic; reports and errors
+    arrive at random intervals.
+    """
+
+    def __init__(self, seed: int = 0, rates: dict = SIMULATOR_RATES, baud_rate: int = BAUD_RATE):
+        self.random = random.Random(seed)
+        self.frame_time_ns = FRAME_TIME_NS * BAUD_RATE // baud_rate
+        self.sent = 0
+
+        # (subsystem, telemetry key) -> sequence number of the next report.
+        self._sequence = {}
+        # slowly drifting value behind each telemetry key.
+        self._readings = {}
+
+        # [next deadline, rate, generator, periodic] for each kind of traffic.
+        now = time.monotonic_ns()
+        self._generators = [
+            [now, rates["heartbeat"], self.heartbeat, True],
+            [now, rates["telemetry"], self.telemetry_report, False],
+            [now, rates["error"], self.runtime_error, False],
+        ]
+        for generator in self._generators:
+            generator[0] += self._interval_ns(generator)
+
+    def _interval_ns(self, generator) -> float:
+        _, rate, _, periodic = generator
+        if rate <= 0:
+            return math.inf
+        if math.isinf(rate):
+            return 0
+        if periodic:
+            return 1e9 / rate
+        return self.random.expovariate(rate) * 1e9
+
+    @staticmethod
+    def _message(sender: NodeID, recipient: NodeID, cmd_id: CmdID, values: dict | None = None) -> bytes:
+        body = encode_body(cmd_id, values) if values else bytes()
+        return Message(COMM_INFO[cmd_id]["priority"], sender, recipient, cmd_id, body).serialize()
+
+    def heartbeat(self) -> list[bytes]:
+        return [self._message(self.random.choice(SUBSYSTEMS), NodeID.CDH, CmdID.CDH_PROCESS_HEARTBEAT)]
+
+    def telemetry_report(self) -> list[bytes]:
+        """A report of one to three packets carrying float readings."""
+        sender = self.random.choice(SUBSYSTEMS)
+        key = self.random.choice(TELEMETRY_KEYS)
+        stream = (sender, key)
+        sequence = self._sequence.get(stream, 0)
+        self._sequence[stream] = (sequence + 1) % 256
+
+        packets = []
+        for packet in range(self.random.randint(1, 3)):
+            reading = self._readings.get(stream, 20.0) + self.random.gauss(0, 0.5)
+            self._readings[stream] = reading
+            packets.append(self._message(sender, NodeID.CDH, CmdID.CDH_PROCESS_TELEMETRY_REPORT, {
+                "telemetry-key": key,
+                "sequence-number": sequence,
+                "packet-number": packet,
+                "telemetry": struct.pack("<f", reading),
+            }))
+        return packets
+
+    def runtime_error(self) -> list[bytes]:
+        return [self._message(self.random.choice(SUBSYSTEMS), NodeID.CDH, CmdID.CDH_PROCESS_RUNTIME_ERROR, {
+            "error-code": self.random.randrange(1, 16),
+            "context-code": self.random.randrange(0, 8),
+            "debug-data": self.random.randbytes(5),
+        })]
+
+    def reply(self, command: bytes) -> list[bytes]:
+        """Acknowledges a command with CDH_PROCESS_RETURN, echoing the start of its body."""
+        try:
+            msg = Message.deserialize(command)
+        except ValueError:
+            return []
+        return [self._message(msg.recipient, msg.sender, CmdID.CDH_PROCESS_RETURN, {
+            "command-id": msg.cmd_id,
+            "data": msg.body[:6],
+        })]
+
+    def run(self, fd: int, stop_flag):
+        """Exchanges messages over the controlling end of a pseudo-terminal until stop_flag is set."""
+        pending = bytearray()
+        received = bytearray()
+        # when the frames already sent will have finished crossing the line.
+        line_free_ns = time.monotonic_ns()
+
+        def send(messages: list[bytes]):
+            nonlocal line_free_ns
+            for msg_bytes in messages:
+                if len(pending) < MAX_PENDING_BYTES:
+                    pending.extend(encode_frame(msg_bytes))
+            line_free_ns = max(line_free_ns, time.monotonic_ns()) + len(messages) * self.frame_time_ns
+            self.sent += len(messages)
+
+        while not stop_flag.is_set():
+            now = time.monotonic_ns()
+            wake_ns = line_free_ns
+            if line_free_ns <= now:
+                generator = min(self._generators, key=lambda g: g[0])
+                if generator[0] <= now:
+                    send(generator[2]())
+                    # a generator which fell behind the line doesn't send a burst to catch up.
+                    generator[0] = max(generator[0], now - self.frame_time_ns) + self._interval_ns(generator)
+                    wake_ns = line_free_ns
+                else:
+                    wake_ns = generator[0]
+
+            timeout = min(max(wake_ns - time.monotonic_ns(), 0) / 1e9, POLL_INTERVAL)
+            readable, _, _ = select.select([fd], [fd] if pending else [], [], timeout)
+
+            if readable:
+                received += os.read(fd, 4096)
+                while len(received) >= MSG_SIZE:
+                    send(self.reply(bytes(received[:MSG_SIZE])))
+                    del received[:MSG_SIZE]
+
+            if pending:
+                try:
+                    written = os.write(fd, pending)
+                    del pending[:written]
+                except BlockingIOError:
+                    pass
+
+
+def simulate_board(port_conn, stop_flag, seed: int = 0, rates: dict = SIMULATOR_RATES, baud_rate: int = BAUD_RATE):
+    """Runs a simulated board on a new pseudo-terminal until stop_flag is set.
+
+    The device name of the terminal is sent through `port_conn` once it can
+    be opened.
+    """
+    # Ctrl+C reaches every process on the terminal, but the board keeps
+    # running until whatever started it sets stop_flag.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # imported here, as tty is POSIX only and the rest of this module isn't.
+    import tty
+
+    controller_fd, device_fd = os.openpty()
+    # raw mode, so frames aren't echoed or altered before the reader opens the port.
+    tty.setraw(device_fd)
+    os.set_blocking(controller_fd, False)
+
+    port_conn.send(os.ttyname(device_fd))
+    port_conn.close()
+
+    board = SimulatedBoard(seed, rates, baud_rate)
+    try:
+        board.run(controller_fd, stop_flag)
+    finally:
+        os.close(controller_fd)
+        os.close(device_fd)
+
+
+def start_simulator(stop_flag, seed: int = 0, rates: dict = SIMULATOR_RATES, baud_rate: int = BAUD_RATE):
+    """Starts simulate_board() in a new process. Returns the process and the port to open."""
+    port_receiver, port_sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=simulate_board,
+        args=(port_sender, stop_flag, seed, rates, baud_rate),
+        daemon=True
+    )
+    process.start()
+    return process, port_receiver.recv()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Runs a simulated SOTI board on a pseudo-terminal.")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--baud", type=int, default=BAUD_RATE, help=f"baud rate to simulate (default {BAUD_RATE})")
+    for name, rate in SIMULATOR_RATES.items():
+        arg_parser.add_argument(f"--{name}", type=float, default=rate, metavar="HZ",
+                                help=f"average {name} messages per second (default {rate})")
+    args = arg_parser.parse_args()
+
+    stop = multiprocessing.Event()
+    simulator, port = start_simulator(stop, args.seed, {name: getattr(args, name) for name in SIMULATOR_RATES},
+                                      args.baud)
+    print(f"Simulating a SOTI board on {port}. Press Ctrl+C to stop.")
+    try:
+        simulator.join()
+    except KeyboardInterrupt:
+        stop.set()
+        simulator.join()
@@ -0,0 +1,138 @@
+"""Reassembles telemetry reports and writes each telemetry key to its own file."""
+
+import re
+import time
+from pathlib import Path
+from utils.constants import CmdID, LOG_FLUSH_INTERVAL, LOG_FLUSH_SIZE, TELEMETRY_REPORT_TIMEOUT
+from message import Message
+
+
+class _Report:
+    """A telemetry report whose packets are still arriving."""
+
+    __slots__ = ("time", "mono_ns", "sequence", "packets")
+
+    def __init__(self, msg: Message, sequence: int):
+        self.time = msg.time
+        self.mono_ns = msg.mono_ns
+        self.sequence = sequence
+        # packet number -> payload, as packets may arrive out of order.
+        self.packets: dict[int, bytes] = {}
+
+    @property
+    def missing_packets(self) -> int:
+        """The packets numbered below the last one received which haven't arrived."""
+        return max(self.packets) + 1 - len(self.packets)
+
+
+class TelemetryDemux:
+    """Streams CDH_PROCESS_TELEMETRY_REPORT messages into one text file per telemetry key.
+
+    A report is made of packets which share a sequence number, numbered
+    from 0. It is written out once a packet with a new sequence number
+    arrives, or once no packet has arrived for TELEMETRY_REPORT_TIMEOUT,
+    with its packets in order of their numbers; repeats of a packet are
+    ignored. Missing packets and skipped sequence numbers are noted on the
+    line.
+
+    Files stay open for the whole session and are written through their
+    own buffers, which are flushed every `flush_interval` seconds.
+
+    If a session has several `ports`, each one's reports are assembled
+    separately and written in a folder named after it.
+    """
+
+    def __init__(self, directory: Path, flush_interval: float = LOG_FLUSH_INTERVAL, ports: list[str] | None = None):
+        self.directory = Path(directory)
+        self.ports = ports
+        self.flush_interval = flush_interval
+        self.reports = 0
+        self.gaps = 0
+
+        self._files = {}
+        # (port, sender, key) -> the report being assembled
+        self._pending: dict[tuple, _Report] = {}
+        # (port, sender, key) -> the sequence number of the last report
+        self._last_sequence = {}
+        self._last_flush = time.monotonic()
+
+    def feed(self, msg: Message, port: int = 0):
+        """Adds a message read from the port with index `port`. Anything other than a telemetry report is ignored."""
+        if msg.cmd_id is not CmdID.CDH_PROCESS_TELEMETRY_REPORT:
+            return
+
+        body = msg.body
+        stream = (port, msg.sender, body[0])
+        sequence = body[1]
+        packet = body[2]
+
+        report = self._pending.get(stream)
+        if report is not None and report.sequence != sequence:
+            self._write(stream, report)
+            report = None
+        if report is None:
+            report = self._pending[stream] = _Report(msg, sequence)
+
+        report.packets.setdefault(packet, body[3:7])
+        report.mono_ns = msg.mono_ns
+
+    def _write(self, stream: tuple, report: _Report):
+        del self._pending[stream]
+
+        data = b"".join(report.packets[packet] for packet in sorted(report.packets))
+        line = (f"{report.time} sequence-number={report.sequence} "
+                f"packets={len(report.packets)} telemetry=0x{data.hex()}")
+
+        notes = []
+        last_sequence = self._last_sequence.get(stream)
+        if last_sequence is not None:
+            skipped = (report.sequence - last_sequence - 1) % 256
+            if skipped:
+                notes.append(f"missed-reports={skipped}")
+        if report.missing_packets:
+            notes.append(f"missing-packets={report.missing_packets}")
+        if notes:
+            self.gaps += 1
+            line += " GAP " + " ".join(notes)
+
+        self._last_sequence[stream] = report.sequence
+        self._file(stream).write(line + "\n")
+        self.reports += 1
+
+    def _file(self, stream: tuple):
+        file = self._files.get(stream)
+        if file is None:
+            port, sender, key = stream
+            directory = self.directory
+            if self.ports and len(self.ports) > 1:
+                # e.g. dev_ttyACM0 for /dev/ttyACM0.
+                directory /= re.sub(r"[^\w.-]+", "_", self.ports[port]).strip("_")
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{sender.name}-key-{key:03d}.txt"
+            file = self._files[stream] = open(path, 'a', encoding="utf_8", buffering=LOG_FLUSH_SIZE)
+        return file
+
+    def flush_if_due(self):
+        """Completes stale reports and flushes the files if the flush interval has passed."""
+        if time.monotonic() - self._last_flush < self.flush_interval:
+            return
+
+        cutoff = time.monotonic_ns() - int(TELEMETRY_REPORT_TIMEOUT * 1e9)
+        for stream, report in list(self._pending.items()):
+            if report.mono_ns < cutoff:
+                self._write(stream, report)
+
+        self.flush()
+
+    def flush(self):
+        for file in self._files.values():
+            file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Writes out every report still being assembled and closes the files."""
+        for stream, report in list(self._pending.items()):
+            self._write(stream, report)
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
@@ -9,14 +9,131 @@ SAVE_DATA_DIR = ROOT_DIR / "save-data"
 
 SESSIONS_DIR = SAVE_DATA_DIR / "sessions"
 
+# Each session's telemetry is split into one file per key in a folder here.
+TELEMETRY_DIR = SAVE_DATA_DIR / "telemetry"
+
+# An index of every session's messages, to search them all at once (see session_index.py).
+SESSION_INDEX_PATH = SAVE_DATA_DIR / "sessions.sqlite"
+# The most messages `search` prints unless told otherwise.
+SEARCH_LIMIT = 100
+
 # Used to name session files with datetime.strftime()
 SESSION_FILE_FORMAT = "%Y-%m-%d_%H%M%S"
 
+# The formats each session is logged in: "yaml" is human-readable, "binary"
+# is compact and can be exported to YAML later (see binary_log.py).
+LOG_FORMATS = ("yaml", "binary")
+
+# Session logs are split into segments of at most about this size...
+LOG_SEGMENT_SIZE = 64 * 1024 * 1024 # bytes
+# ...or this long (None for no limit). A manifest lists the segments of
+# each session (see log_segments.py).
+LOG_SEGMENT_DURATION = 3600.0 # seconds
+# Finished segments are compressed in the background with "gzip" or
+# "lzma", or left as they are with None.
+LOG_COMPRESSION = "gzip"
+# The oldest finished segments of a session are deleted once its segments
+# take up more than this, e.g. 10 * 1024**3 for 10 GiB. None keeps them all.
+LOG_RETAINED_SIZE = None # bytes
+
+# Session logs are written out at least this often...
+LOG_FLUSH_INTERVAL = 1.0 # seconds
+# ...or as soon as this much text is waiting to be written.
+LOG_FLUSH_SIZE = 64 * 1024 # bytes
+
+# When several ports are captured at once, each record is held this long
+# after it is read so the ports' records can be logged in capture order
+# (see frame_merge.py).
+REORDER_WINDOW = 0.05 # seconds
+
+# A telemetry report which hasn't received a packet for this long is
+# written out as it is (see telemetry_demux.py).
+TELEMETRY_REPORT_TIMEOUT = 1.0 # seconds
+
+# How long a blocking read or queue wait may last before a stop flag is
+# checked again. This bounds shutdown latency, not throughput.
+POLL_INTERVAL = 0.1 # seconds
+
+# How a session runs unless --runtime says otherwise: "processes" reads
+# each port and logs in processes of their own, which keeps up with the
+# busiest links, and "asyncio" runs everything on one event loop in a
+# single process, which starts faster and uses less memory (POSIX only,
+# see async_runtime.py).
+RUNTIME = "processes"
+
+# A command which hasn't been answered with CDH_PROCESS_RETURN or
+# CDH_PROCESS_COMMAND_ERROR after this long is counted as timed out
+# (see reply_tracker.py).
+REPLY_TIMEOUT = 1.0 # seconds
+
+# The most COMM_UPDATE_LOAD messages in flight at once during a firmware
+# update (see firmware_update.py).
+UPDATE_WINDOW = 32
+
+# The most replies to commands kept for the CLI. Replies arrive all session
+# but are only read during an update, so any more are dropped.
+REPLY_QUEUE_SIZE = 1024
+
+# How long a test script waits for an expected message by default
+# (see script_engine.py).
+SCRIPT_TIMEOUT = 1.0 # seconds
+
+# Incoming traffic is summarized on one line at most this often, rather
+# than printing every message (see live_display.py)...
+SUMMARY_INTERVAL = 5.0 # seconds
+# ...and the dashboard is redrawn this many times a second.
+DISPLAY_FPS = 10
+# The number of recent messages the dashboard shows.
+DISPLAY_RECENT = 20
+# Rates are averaged over this long.
+DISPLAY_RATE_WINDOW = 5.0 # seconds
+
+# Filter expressions selecting the messages which are logged and shown
+# live (see message_filter.py), e.g. "from=PLD and cmd~PLD_*". None
+# selects every message.
+LOG_FILTER = None
+DISPLAY_FILTER = None
+# The longest filter expression, in bytes, which can be shared between processes.
+MAX_FILTER_LENGTH = 1024
+
+# Profiles of each process, written with --profile (see profiling.py).
+PROFILES_DIR = SAVE_DATA_DIR / "profiles"
+# How often the sampling profiler records the stacks of each thread.
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds
+# The number of frames tracemalloc keeps for each allocation.
+PROFILE_TRACEBACK_DEPTH = 16
+
+# Pipeline metrics are served for Prometheus at http://127.0.0.1:METRICS_PORT/metrics
+# (see pipeline_metrics.py). None turns the endpoint off.
+METRICS_PORT = 9464
+
+# The baud rate of the SOTI board's UART (see MX_USART3_UART_Init).
+BAUD_RATE = 115200
+
+# Average messages per second sent by the simulated board in virtual mode
+# (see simulator.py). Use math.inf to saturate the line.
+SIMULATOR_RATES = {
+    "heartbeat": 1.0,
+    "telemetry": 5.0,
+    "error": 0.1,
+}
+
 # The length of a serialized message in bytes.
 MSG_SIZE = 11
 # The length of a message's data payload in bytes.
 DATA_SIZE = 7
 
+# Where a message came from. Stored as an index into this tuple where
+# messages are packed into binary records, so new sources go at the end.
+MESSAGE_SOURCES = ("unspecified", "port", "user", "replay", "script")
+
+# Bytes which mark the start of each frame sent by the SOTI board.
+SYNC_MARKER = b"\xa5\x5a"
+# The initial value of the CRC-16/CCITT-FALSE checksum which ends each frame.
+CRC_INIT = 0xFFFF
+# The length of a frame on the wire: sync marker, message and checksum.
+FRAME_SIZE = len(SYNC_MARKER) + MSG_SIZE + 2
+
 
 class NodeID(Enum):
     """Associates a subsystem id with a human-readable name for message history."""
@@ -182,3 +299,62 @@ COMM_INFO = {
     CmdID.PLD_GET_TOLERANCE:               {"priority": 32, "dest": NodeID.PLD},
     CmdID.PLD_TEST_LEDS:                   {"priority": 4, "dest": NodeID.PLD}
 }
+
+
+# Layout of each command's body, as (field name, type, offset in the body).
+# Types are u8, u16, u32, i8, i16, i32 and f32 (little-endian numbers), bool,
+# node (a NodeID), cmd (a CmdID), and hexN/binN (N raw bytes displayed in
+# hexadecimal/binary). Commands without an entry have no body.
+# body_codec.py compiles this table into the message decoders and encoders.
+BODY_SCHEMA = {
+    ############################################
+    ### COMMON
+    ############################################
+    CmdID.COMM_GET_TELEMETRY:              (("telemetry-key", "u8", 0),),
+    CmdID.COMM_SET_TELEMETRY_INTERVAL:     (("telemetry-key", "u8", 0), ("interval", "u16", 1)),
+    CmdID.COMM_GET_TELEMETRY_INTERVAL:     (("telemetry-key", "u8", 0),),
+    CmdID.COMM_UPDATE_START:               (("address", "u32", 0),),
+    CmdID.COMM_UPDATE_LOAD:                (("data", "hex7", 0),),
+
+    ############################################
+    ### CDH
+    ############################################
+    ## Event Processing.
+    CmdID.CDH_PROCESS_RUNTIME_ERROR:       (("error-code", "u8", 0), ("context-code", "u8", 1),
+                                            ("debug-data", "hex5", 2)),
+    CmdID.CDH_PROCESS_COMMAND_ERROR:       (("error-code", "u8", 0), ("command-id", "cmd", 1),
+                                            ("debug-data", "hex5", 2)),
+    CmdID.CDH_PROCESS_NOTIFICATION:        (("notification-id", "u8", 0),),
+    CmdID.CDH_PROCESS_TELEMETRY_REPORT:    (("telemetry-key", "u8", 0), ("sequence-number", "u8", 1),
+                                            ("packet-number", "u8", 2), ("telemetry", "hex4", 3)),
+    CmdID.CDH_PROCESS_RETURN:              (("command-id", "cmd", 0), ("data", "hex6", 1)),
+    CmdID.CDH_PROCESS_LED_TEST:            (("bitmap", "bin2", 0),),
+
+    ## Clock
+    CmdID.CDH_SET_RTC:                     (("unix-timestamp", "u32", 0),),
+
+    CmdID.CDH_RESET_SUBSYSTEM:             (("subsystem-id", "node", 0),),
+
+    ############################################
+    ### POWER
+    ############################################
+    CmdID.PWR_SET_SUBSYSTEM_POWER:         (("subsystem-id", "node", 0), ("power", "bool", 1)),
+    CmdID.PWR_GET_SUBSYSTEM_POWER:         (("subsystem-id", "node", 0),),
+    CmdID.PWR_SET_BATTERY_HEATER_POWER:    (("heater-power", "bool", 0),),
+    CmdID.PWR_SET_BATTERY_ACCESS:          (("battery-access", "bool", 0),),
+
+    ############################################
+    ### ADCS
+    ############################################
+    CmdID.ADCS_SET_MAGNETORQUER_DIRECTION: (("magnetorquer-id", "u8", 0), ("direction", "i8", 1)),
+    CmdID.ADCS_GET_MAGNETORQUER_DIRECTION: (("magnetorquer-id", "u8", 0),),
+    CmdID.ADCS_SET_OPERATING_MODE:         (("mode", "u8", 0),),
+
+    ############################################
+    ### PAYLOAD
+    ############################################
+    CmdID.PLD_SET_ACTIVE_ENVS:             (("bitmap", "bin2", 0),),
+    CmdID.PLD_SET_SETPOINT:                (("well-id", "u8", 0), ("setpoint", "f32", 1)),
+    CmdID.PLD_GET_SETPOINT:                (("well-id", "u8", 0),),
+    CmdID.PLD_SET_TOLERANCE:               (("tolerance", "f32", 0),),
+}
@@ -1,5 +1,6 @@
 """Includes strings used in help messages."""
 
+import functools
 from utils.constants import CmdID
 
 
@@ -8,12 +9,21 @@ send: sends a command to the satellite
 iamnow: sets the default sender ID of sent commands
 help: displays this message
 list: lists the available commands for each subsystem
+replay: sends the messages of a recorded session to the satellite
+update: uploads a binary image to a subsystem
+dashboard: shows live message counts, rates and recent messages
+verbose: turns printing every received message on or off
+summary: turns printing a summary of the message rates on or off
+filter: selects which messages are logged or shown
+search: finds messages in every recorded session
+stats: shows the rates, queue depths, drops and latencies of the pipeline
 exit: exits the program
 """
 
 
-def generate_command_list() -> str:
-    """Generates a formatted list of commands based off the CmdID enum."""
+@functools.cache
+def command_list() -> str:
+    """Generates a formatted list of commands based off the CmdID enum, the first time it is needed."""
     # Friendlier category names.
     category_names = {
         "COMM": "Common",
@@ -23,7 +33,7 @@ def generate_command_list() -> str:
         "PLD": "Payload"
     }
 
-    command_list = "\nAvailable Commands:\n"
+    text = "\nAvailable Commands:\n"
     current_category = None
     for cmd_id in CmdID:
         category = cmd_id.name.split('_', 1)[0] # Extract the prefix in the name.
@@ -36,14 +46,11 @@ def generate_command_list() -> str:
             else:
                 category_name = category # Default to the prefix
 
-            command_list += "\n=== " + category_name + " ===\n"
+            text += "\n=== " + category_name + " ===\n"
 
         hex_code = f'0x{cmd_id.value:02x}'
-        command_list += f"{hex_code}:\t{cmd_id.name}\n"
+        text += f"{hex_code}:\t{cmd_id.name}\n"
 
-    command_list += "\n"
+    text += "\n"
 
-    return command_list
-
-
-COMMAND_LIST = generate_command_list()
+    return text